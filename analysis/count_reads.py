@@ -0,0 +1,778 @@
+"""Count sgRNAs of screen FASTQ files against a library
+
+Reads are streamed in large binary blocks. The offset of the spacer is
+detected once from a sample of reads; the reads of a block are then sliced at
+that offset as one byte array and checked against the constant sequences
+around the spacer. Only the reads failing the check are searched with the
+anchored regex. Spacers are looked up in the sorted library and counted with
+np.bincount, so memory is proportional to the library and a block, not to
+the number of reads.
+
+count_fastq_parallel splits the work across processes, each producing a
+partial count vector and optionally partial QC metrics: plain files by byte
+ranges aligned to records, gzip files by blocks of a pigz or gzip
+decompression pipe. count_paired_fastq
+reads both mates in lockstep and keeps the map ratios as running counters.
+"""
+import collections
+import contextlib
+import gzip
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import regex
+
+from genome_editing.utils.parallel import limit_threads
+
+BLOCK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+SAMPLE_SIZE = 10000
+# ACCG + 20bp spacer + GTTTA, as analysis.screen_data.get_reads_info
+PREFIX = 'ACCG'
+SUFFIX = 'GTTTA'
+SPACER_LEN = 20
+PAIRED_POLICIES = ('first', 'second', 'single', 'agree')
+# 1-mismatch neighbors, N of reads is corrected too
+NEIGHBOR_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+AMBIGUOUS_INDEX = -2
+EXACT, CORRECTED, AMBIGUOUS, UNMAPPED = range(4)
+ASSIGNMENT_NAMES = ('exact', 'corrected', 'ambiguous', 'unmapped')
+
+
+def gzip_command():
+    """The command decompressing gzip to stdout, None if not available"""
+    for name in ('pigz', 'gzip'):
+        path = shutil.which(name)
+        if path is not None:
+            return [path, '-dc']
+    return None
+
+
+@contextlib.contextmanager
+def open_fastq(path):
+    """Open a FASTQ file in binary mode, gzip files end with .gz and are
+    decompressed by a pigz or gzip process when available"""
+    if not path.endswith('.gz'):
+        with open(path, 'rb') as f:
+            yield f
+        return
+    command = gzip_command()
+    if command is None:
+        with gzip.open(path, 'rb') as f:
+            yield f
+        return
+    proc = subprocess.Popen(command + [path], stdout=subprocess.PIPE,
+                            bufsize=BUFFER_SIZE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def record_end(data):
+    """The position after the last complete record of data, 0 if there is
+    none"""
+    line_num = data.count(b'\n')
+    keep_num = line_num // 4 * 4
+    if keep_num == 0:
+        return 0
+    pos = data.rfind(b'\n')
+    for _ in range(line_num - keep_num):
+        pos = data.rfind(b'\n', 0, pos)
+    return pos + 1
+
+
+def iter_record_chunks(f, block_size=BLOCK_SIZE, size=None):
+    """Read a FASTQ file in chunks of complete records
+
+    Args:
+        f: the FASTQ file object in binary mode, at the start of a record
+        block_size: the number of bytes read at a time
+        size: the number of bytes to read, to the end if None
+
+    Returns:
+        generator of bytes
+    """
+    remainder = b''
+    while size is None or size > 0:
+        data = f.read(block_size if size is None else min(block_size, size))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        data = remainder + data
+        end = record_end(data)
+        remainder = data[end:]
+        if end > 0:
+            yield data[:end]
+    if len(remainder) > 0:
+        yield remainder
+
+
+def split_records(chunk):
+    """Split a chunk of FASTQ records into lines, 4 lines per record, an
+    incomplete record at the end is dropped"""
+    lines = chunk.split(b'\n')
+    return lines[:(len(lines) // 4 * 4)]
+
+
+def iter_fastq_blocks(path, block_size=BLOCK_SIZE):
+    """Read a FASTQ file in blocks of complete records
+
+    Args:
+        path: the FASTQ file
+        block_size: the number of bytes read at a time
+
+    Returns:
+        generator of lists of lines, 4 lines per record, without line breaks
+    """
+    with open_fastq(path) as f:
+        for chunk in iter_record_chunks(f, block_size):
+            yield split_records(chunk)
+
+
+def to_byte_array(seqs):
+    """Convert sequences to a uint8 array, shorter sequences are padded with
+    0
+
+    Args:
+        seqs: list of bytes
+
+    Returns:
+        np.ndarray, uint8, shape (n, max length)
+    """
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    fixed = np.array(seqs)
+    return fixed.view(np.uint8).reshape(len(seqs), fixed.dtype.itemsize)
+
+
+class SpacerExtractor:
+    """Extract spacers between constant sequences of reads"""
+
+    def __init__(self, prefix=PREFIX, suffix=SUFFIX, spacer_len=SPACER_LEN,
+                 offset=None):
+        """
+
+        Args:
+            prefix: the constant sequence before the spacer
+            suffix: the constant sequence after the spacer
+            spacer_len: the length of spacer
+            offset: the position of spacer in reads, detected from the first
+             block if None
+        """
+        self.prefix = prefix.encode('ascii')
+        self.suffix = suffix.encode('ascii')
+        self.spacer_len = spacer_len
+        self.offset = offset
+        self.pattern = regex.compile(
+            self.prefix + b'(.{' + str(spacer_len).encode('ascii') + b'})' +
+            self.suffix)
+        self.prefix_codes = np.frombuffer(self.prefix, dtype=np.uint8)
+        self.suffix_codes = np.frombuffer(self.suffix, dtype=np.uint8)
+
+    def __repr__(self):
+        return 'SpacerExtractor({}, {}, {}, offset={})'.format(
+            self.prefix, self.spacer_len, self.suffix, self.offset)
+
+    def detect_offset(self, seqs, sample_size=SAMPLE_SIZE):
+        """Detect the most common position of spacer in a sample of reads
+
+        Args:
+            seqs: list of bytes
+            sample_size: the number of reads used
+
+        Returns:
+            int, the offset, None if no read has the constant sequences
+        """
+        offsets = collections.Counter()
+        for seq in seqs[:sample_size]:
+            match = self.pattern.search(seq)
+            if match is not None:
+                offsets[match.start(1)] += 1
+        if len(offsets) == 0:
+            return None
+        return offsets.most_common(1)[0][0]
+
+    def extract(self, seqs, return_offsets=False):
+        """Extract spacers
+
+        Args:
+            seqs: list of bytes
+            return_offsets: whether return the offset of spacer of each read
+
+        Returns:
+            np.ndarray of spacers (bytes, S{spacer_len}), np.ndarray of
+            whether the spacer is found, and np.ndarray of whether the spacer
+            is at the offset (fast path); with return_offsets, also
+            np.ndarray of offsets, -1 if the spacer is not found
+        """
+        n = len(seqs)
+        spacers = np.zeros(n, dtype='S{}'.format(self.spacer_len))
+        fast = np.zeros(n, dtype=bool)
+        if self.offset is None:
+            self.offset = self.detect_offset(seqs)
+        codes = to_byte_array(seqs)
+        start = -1 if self.offset is None else \
+            self.offset - len(self.prefix_codes)
+        end = -1 if self.offset is None else \
+            self.offset + self.spacer_len + len(self.suffix_codes)
+        if 0 <= start and end <= codes.shape[1]:
+            suffix_start = self.offset + self.spacer_len
+            fast = np.all(codes[:, start:self.offset] == self.prefix_codes,
+                          axis=1) & \
+                np.all(codes[:, suffix_start:end] == self.suffix_codes,
+                       axis=1)
+            spacer_codes = np.ascontiguousarray(
+                codes[fast, self.offset:suffix_start])
+            spacers[fast] = spacer_codes.view(spacers.dtype).ravel()
+        found = fast.copy()
+        offsets = np.full(n, -1, dtype=np.int64)
+        if fast.any():
+            offsets[fast] = self.offset
+        # the anchored search for shifted reads
+        for i in np.where(~fast)[0]:
+            match = self.pattern.search(seqs[i])
+            if match is not None:
+                spacers[i] = match.group(1)
+                found[i] = True
+                offsets[i] = match.start(1)
+        if return_offsets:
+            return spacers, found, fast, offsets
+        return spacers, found, fast
+
+
+def search_keys(keys, index, spacers):
+    """Look up spacers in sorted keys
+
+    Args:
+        keys: sorted np.ndarray of bytes
+        index: np.ndarray of the value of each key
+        spacers: np.ndarray of bytes
+
+    Returns:
+        np.ndarray, int64, the value of spacers, -1 if not in keys
+    """
+    spacers = np.asarray(spacers, dtype=keys.dtype)
+    if len(keys) == 0:
+        return np.full(len(spacers), -1, dtype=np.int64)
+    pos = np.searchsorted(keys, spacers)
+    pos[pos == len(keys)] = 0
+    hit = keys[pos] == spacers
+    return np.where(hit, index[pos], -1).astype(np.int64)
+
+
+def neighbor_keys(keys, index):
+    """The 1-mismatch neighbors of spacers
+
+    Args:
+        keys: np.ndarray of spacers, bytes
+        index: np.ndarray of the library index of spacers
+
+    Returns:
+        sorted np.ndarray of neighbors and np.ndarray of the library index of
+        neighbors, AMBIGUOUS_INDEX if the neighbor of more than one spacer
+    """
+    spacer_len = keys.dtype.itemsize
+    codes = keys.view(np.uint8).reshape(len(keys), spacer_len)
+    neighbors = []
+    neighbor_index = []
+    for pos in range(spacer_len):
+        for base in NEIGHBOR_BASES:
+            changed = codes[:, pos] != base
+            neighbor = codes[changed].copy()
+            neighbor[:, pos] = base
+            neighbors.append(neighbor.view(keys.dtype).ravel())
+            neighbor_index.append(index[changed])
+    neighbors = np.concatenate(neighbors)
+    neighbor_index = np.concatenate(neighbor_index)
+    # neighbors of one spacer are unique, so a repeated neighbor is ambiguous
+    neighbors, first, neighbor_num = np.unique(
+        neighbors, return_index=True, return_counts=True)
+    neighbor_index = np.where(neighbor_num > 1, AMBIGUOUS_INDEX,
+                              neighbor_index[first])
+    return neighbors, neighbor_index
+
+
+class LibraryIndex:
+    """Look up spacers in a sgRNA library
+
+    With mismatches=1 every 1-mismatch neighbor of a spacer is also mapped to
+    the spacer, neighbors shared by several spacers are ambiguous. Spacers are
+    searched among the exact keys first, then among the neighbors.
+    """
+
+    def __init__(self, seqs, mismatches=0):
+        """
+
+        Args:
+            seqs: array of spacers of the library, the same length
+            mismatches: (0, 1), the number of mismatches tolerated
+        """
+        assert mismatches in (0, 1), 'Wrong mismatches'
+        self.seqs = np.asarray([x.upper() for x in seqs], dtype=object)
+        self.mismatches = mismatches
+        keys = np.array([x.encode('ascii') for x in self.seqs])
+        # the first of duplicated spacers is used
+        self.keys, first = np.unique(keys, return_index=True)
+        self.index = first
+        self.spacer_len = keys.dtype.itemsize
+        if mismatches == 1:
+            self.neighbors, self.neighbor_index = neighbor_keys(self.keys,
+                                                                self.index)
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __repr__(self):
+        return 'LibraryIndex(n={}, mismatches={})'.format(len(self),
+                                                          self.mismatches)
+
+    def assign(self, spacers):
+        """Assign spacers to the library
+
+        Args:
+            spacers: np.ndarray of bytes
+
+        Returns:
+            np.ndarray, int64, the library index, -1 if not assigned, and
+            np.ndarray of the status, (EXACT, CORRECTED, AMBIGUOUS, UNMAPPED)
+        """
+        spacers = np.asarray(spacers, dtype=self.keys.dtype)
+        index = search_keys(self.keys, self.index, spacers)
+        status = np.where(index >= 0, EXACT, UNMAPPED)
+        if self.mismatches == 1:
+            missed = np.where(index < 0)[0]
+            neighbor_index = search_keys(self.neighbors, self.neighbor_index,
+                                         spacers[missed])
+            corrected = neighbor_index >= 0
+            index[missed[corrected]] = neighbor_index[corrected]
+            status[missed[corrected]] = CORRECTED
+            status[missed[neighbor_index == AMBIGUOUS_INDEX]] = AMBIGUOUS
+        return index, status
+
+    def lookup(self, spacers):
+        """Find the library index of spacers
+
+        Args:
+            spacers: np.ndarray of bytes
+
+        Returns:
+            np.ndarray, int64, -1 if not assigned
+        """
+        return self.assign(spacers)[0]
+
+
+def assignment_stats(status):
+    """The number of spacers of each assignment status"""
+    status_num = np.bincount(status, minlength=len(ASSIGNMENT_NAMES))
+    return {x: int(status_num[i]) for i, x in enumerate(ASSIGNMENT_NAMES)}
+
+
+def assignment_report(sample_stats):
+    """The assignment of reads of samples
+
+    Args:
+        sample_stats: dict, sample: read numbers of count_fastq
+
+    Returns:
+        DataFrame, the number and ratio of exact, corrected, ambiguous and
+        unmapped spacers and reads without spacer of each sample
+    """
+    cols = list(ASSIGNMENT_NAMES) + ['no_spacer']
+    report = pd.DataFrame([[sample_stats[x].get(y, 0) for y in cols]
+                           for x in sample_stats],
+                          index=list(sample_stats), columns=cols)
+    report.loc[:, 'reads'] = report.loc[:, cols].sum(axis=1)
+    for col in cols:
+        report.loc[:, col + '_ratio'] = report.loc[:, col] / report.reads
+    return report
+
+
+def count_block(lines, extractor, library, qc=None):
+    """Count the spacers of a block of FASTQ lines
+
+    Args:
+        lines: lines of complete records
+        extractor: SpacerExtractor
+        library: LibraryIndex
+        qc: screen_qc.ScreenQC updated with the block, None for no QC
+
+    Returns:
+        np.ndarray of counts of the library, and dict of read numbers
+    """
+    seqs = lines[1::4]
+    spacers, found, fast, offsets = extractor.extract(seqs,
+                                                      return_offsets=True)
+    index, status = library.assign(spacers[found])
+    counts = np.bincount(index[index >= 0], minlength=len(library))
+    stats = {'reads': len(found), 'fast': int(fast.sum()),
+             'shifted': int(found.sum() - fast.sum()),
+             'no_spacer': int(len(found) - found.sum()),
+             'not_in_library': int(np.sum(index < 0))}
+    stats.update(assignment_stats(status))
+    if qc is not None:
+        qc.update(seqs, offsets, counts[:, np.newaxis], {0: stats})
+    return counts, stats
+
+
+def add_stats(total, stats):
+    for key in stats:
+        total[key] = total.get(key, 0) + stats[key]
+    return total
+
+
+def count_fastq(fq_path, library_seqs, prefix=PREFIX, suffix=SUFFIX,
+                offset=None, block_size=BLOCK_SIZE, mismatches=0, qc=None):
+    """Count sgRNAs of a FASTQ file
+
+    Args:
+        fq_path: the FASTQ file, .gz for gzip file
+        library_seqs: array of spacers of the library
+        prefix: the constant sequence before the spacer
+        suffix: the constant sequence after the spacer
+        offset: the position of spacer in reads, detected if None
+        block_size: the number of bytes read at a time
+        mismatches: (0, 1), the number of mismatches tolerated
+        qc: screen_qc.ScreenQC of the library with one sample, updated with
+         every block and written at the end, None for no QC
+
+    Returns:
+        DataFrame of sgrna_seq and counts in the library order, and dict of
+        read numbers
+    """
+    library = LibraryIndex(library_seqs, mismatches)
+    extractor = SpacerExtractor(prefix, suffix, library.spacer_len, offset)
+    counts = np.zeros(len(library), dtype=np.int64)
+    stats = {}
+    for lines in iter_fastq_blocks(fq_path, block_size):
+        block_counts, block_stats = count_block(lines, extractor, library,
+                                                qc)
+        counts += block_counts
+        add_stats(stats, block_stats)
+        print('{} reads, spacer offset {}'.format(stats['reads'],
+                                                  extractor.offset))
+    stats['offset'] = extractor.offset
+    if qc is not None:
+        qc.write()
+    out = pd.DataFrame({'sgrna_seq': library.seqs, 'counts': counts},
+                       columns=['sgrna_seq', 'counts'])
+    return out, stats
+
+
+def read_ids(headers):
+    """The read IDs of header lines, without comments and /1 or /2"""
+    ids = [x.split(b' ', 1)[0] for x in headers]
+    return [x[:-2] if x[-2:] in (b'/1', b'/2') else x for x in ids]
+
+
+def iter_paired_blocks(fq_1, fq_2, block_size=BLOCK_SIZE):
+    """Read two FASTQ files of paired reads in lockstep
+
+    Args:
+        fq_1: the FASTQ file of read 1
+        fq_2: the FASTQ file of read 2
+        block_size: the number of bytes read at a time from each file
+
+    Returns:
+        generator of two lists of lines with the same number of records
+    """
+    blocks_1 = iter_fastq_blocks(fq_1, block_size)
+    blocks_2 = iter_fastq_blocks(fq_2, block_size)
+    lines_1 = []
+    lines_2 = []
+    while True:
+        if len(lines_1) == 0:
+            lines_1 = next(blocks_1, [])
+        if len(lines_2) == 0:
+            lines_2 = next(blocks_2, [])
+        line_num = min(len(lines_1), len(lines_2))
+        if line_num == 0:
+            break
+        yield lines_1[:line_num], lines_2[:line_num]
+        lines_1 = lines_1[line_num:]
+        lines_2 = lines_2[line_num:]
+    if len(lines_1) > 0 or len(lines_2) > 0:
+        raise ValueError('{} and {} have different numbers of reads'.format(
+            fq_1, fq_2))
+
+
+def count_paired_block(lines_1, lines_2, extractors, library, policy='first',
+                       record_num=0):
+    """Count the spacers of paired blocks of FASTQ lines
+
+    Args:
+        lines_1: lines of read 1
+        lines_2: lines of read 2, the same records as lines_1
+        extractors: SpacerExtractor of read 1 and read 2
+        library: LibraryIndex
+        policy: how the spacer of a pair is resolved
+         'first': read 1, read 2 if not found in read 1
+         'second': read 2, read 1 if not found in read 2
+         'single': pairs with the spacer found in only one read, as
+          screen_data.count_sgrna
+         'agree': either read, pairs with different spacers are not counted
+        record_num: the number of records before the blocks, for errors
+
+    Returns:
+        np.ndarray of counts of the library, and dict of read numbers
+    """
+    assert policy in PAIRED_POLICIES, 'Wrong policy'
+    ids_1 = read_ids(lines_1[0::4])
+    ids_2 = read_ids(lines_2[0::4])
+    if ids_1 != ids_2:
+        i = next(i for i in range(len(ids_1)) if ids_1[i] != ids_2[i])
+        raise ValueError('Read IDs differ at read {}: {} and {}'.format(
+            record_num + i + 1, ids_1[i].decode(), ids_2[i].decode()))
+    spacers_1, found_1, _ = extractors[0].extract(lines_1[1::4])
+    spacers_2, found_2, _ = extractors[1].extract(lines_2[1::4])
+    conflict = found_1 & found_2 & (spacers_1 != spacers_2)
+    if policy == 'second':
+        spacers = np.where(found_2, spacers_2, spacers_1)
+    else:
+        spacers = np.where(found_1, spacers_1, spacers_2)
+    if policy == 'single':
+        found = found_1 ^ found_2
+    elif policy == 'agree':
+        found = (found_1 | found_2) & ~conflict
+    else:
+        found = found_1 | found_2
+    index, status = library.assign(spacers[found])
+    counts = np.bincount(index[index >= 0], minlength=len(library))
+    stats = {'reads': len(found), 'mapped_1': int(found_1.sum()),
+             'mapped_2': int(found_2.sum()),
+             'mapped': int(np.sum(found_1 | found_2)),
+             'double_mapped': int(np.sum(found_1 & found_2)),
+             'conflict': int(conflict.sum()),
+             'counted': int(np.sum(index >= 0)),
+             'no_spacer': int(len(found) - found.sum()),
+             'not_in_library': int(np.sum(index < 0))}
+    stats.update(assignment_stats(status))
+    return counts, stats
+
+
+def count_paired_fastq(fq_1, fq_2, library_seqs, prefix=PREFIX, suffix=SUFFIX,
+                       policy='first', block_size=BLOCK_SIZE, mismatches=0):
+    """Count sgRNAs of paired FASTQ files, the files are read in lockstep and
+    the read IDs are verified for every pair
+
+    Args:
+        fq_1: the FASTQ file of read 1, .gz for gzip file
+        fq_2: the FASTQ file of read 2, .gz for gzip file
+        library_seqs: array of spacers of the library
+        prefix: the constant sequence before the spacer
+        suffix: the constant sequence after the spacer
+        policy: ('first', 'second', 'single', 'agree'), see count_paired_block
+        block_size: the number of bytes read at a time from each file
+        mismatches: (0, 1), the number of mismatches tolerated
+
+    Returns:
+        DataFrame of sgrna_seq and counts in the library order, and dict of
+        read numbers with map_ratio and double_map_ratio as
+        screen_data.decode_summary
+    """
+    assert policy in PAIRED_POLICIES, 'Wrong policy'
+    library = LibraryIndex(library_seqs, mismatches)
+    extractors = [SpacerExtractor(prefix, suffix, library.spacer_len),
+                  SpacerExtractor(prefix, suffix, library.spacer_len)]
+    counts = np.zeros(len(library), dtype=np.int64)
+    stats = {'reads': 0}
+    for lines_1, lines_2 in iter_paired_blocks(fq_1, fq_2, block_size):
+        block_counts, block_stats = count_paired_block(
+            lines_1, lines_2, extractors, library, policy, stats['reads'])
+        counts += block_counts
+        add_stats(stats, block_stats)
+        print('{} read pairs, map ratio {:.4f}'.format(
+            stats['reads'], stats['mapped'] / stats['reads']))
+    stats['offset_1'] = extractors[0].offset
+    stats['offset_2'] = extractors[1].offset
+    stats['map_ratio'] = stats['mapped'] / stats['reads'] \
+        if stats['reads'] > 0 else np.nan
+    stats['double_map_ratio'] = stats['double_mapped'] / stats['mapped'] \
+        if stats.get('mapped', 0) > 0 else np.nan
+    out = pd.DataFrame({'sgrna_seq': library.seqs, 'counts': counts},
+                       columns=['sgrna_seq', 'counts'])
+    return out, stats
+
+
+def find_record_start(f, pos):
+    """The position of the first record starting at or after pos
+
+    A record starts with a line beginning with @ followed two lines later by a
+    line beginning with +, so quality lines beginning with @ are skipped.
+    """
+    if pos == 0:
+        return 0
+    f.seek(pos - 1)
+    # the rest of the line containing pos - 1
+    line_start = pos - 1 + len(f.readline())
+    starts = []
+    lines = []
+    for _ in range(8):
+        line = f.readline()
+        if not line:
+            break
+        starts.append(line_start)
+        lines.append(line)
+        line_start += len(line)
+    for i in range(len(lines) - 2):
+        if lines[i].startswith(b'@') and lines[i + 2].startswith(b'+'):
+            return starts[i]
+    return line_start
+
+
+def record_ranges(path, chunk_num):
+    """Split a plain FASTQ file into byte ranges aligned to records
+
+    Args:
+        path: the FASTQ file
+        chunk_num: the number of ranges
+
+    Returns:
+        list of (start, end)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        bounds = [find_record_start(f, size * i // chunk_num)
+                  for i in range(chunk_num)] + [size]
+    return [(bounds[i], bounds[i + 1]) for i in range(chunk_num)
+            if bounds[i] < bounds[i + 1]]
+
+
+_counter = {}
+
+
+def _init_counter(library_seqs, prefix, suffix, offset, mismatches, qc):
+    library = LibraryIndex(library_seqs, mismatches)
+    _counter['library'] = library
+    _counter['extractor'] = SpacerExtractor(prefix, suffix,
+                                            library.spacer_len, offset)
+    _counter['qc'] = qc
+
+
+def _new_metrics():
+    """ReadMetrics of a task if QC is on, else None"""
+    if not _counter['qc']:
+        return None
+    from genome_editing.analysis.screen_qc import ReadMetrics
+    return ReadMetrics()
+
+
+def _count_chunk(chunk, metrics=None):
+    return count_block(split_records(chunk), _counter['extractor'],
+                       _counter['library'], metrics)
+
+
+def _count_gzip_chunk(chunk):
+    """Count a decompressed chunk, with its ReadMetrics or None"""
+    metrics = _new_metrics()
+    counts, stats = _count_chunk(chunk, metrics)
+    return counts, stats, metrics
+
+
+def _count_range(args):
+    """Count the records in a byte range of a plain FASTQ file"""
+    path, start, end, block_size = args
+    counts = np.zeros(len(_counter['library']), dtype=np.int64)
+    stats = {}
+    metrics = _new_metrics()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for chunk in iter_record_chunks(f, block_size, end - start):
+            chunk_counts, chunk_stats = _count_chunk(chunk, metrics)
+            counts += chunk_counts
+            add_stats(stats, chunk_stats)
+    return counts, stats, metrics
+
+
+def _iter_chunk_counts(pool, chunks, max_pending):
+    """Count chunks in the pool, at most max_pending chunks are held in
+    memory"""
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_count_gzip_chunk, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def count_fastq_parallel(fq_path, library_seqs, prefix=PREFIX, suffix=SUFFIX,
+                         offset=None, processes=None, block_size=BLOCK_SIZE,
+                         chunk_num=None, mismatches=0, qc=None):
+    """Count sgRNAs of a FASTQ file with multiple processes, same output as
+    count_fastq
+
+    Plain files are split into byte ranges aligned to records and each worker
+    reads its own ranges. Gzip files are decompressed by one pigz or gzip
+    process and the decompressed blocks are counted by the workers.
+
+    Args:
+        fq_path: the FASTQ file, .gz for gzip file
+        library_seqs: array of spacers of the library
+        prefix: the constant sequence before the spacer
+        suffix: the constant sequence after the spacer
+        offset: the position of spacer in reads, detected if None
+        processes: the number of worker processes, the number of CPUs if None
+        block_size: the number of bytes read at a time
+        chunk_num: the number of byte ranges of plain files, 4 times the
+         number of processes if None
+        mismatches: (0, 1), the number of mismatches tolerated
+        qc: screen_qc.ScreenQC of the library with one sample, merged with
+         the metrics of every chunk and written at the end, None for no QC
+
+    Returns:
+        DataFrame of sgrna_seq and counts in the library order, and dict of
+        read numbers
+    """
+    library_seqs = [x.upper() for x in library_seqs]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if offset is None:
+        # all workers use the offset detected from the start of the file
+        extractor = SpacerExtractor(prefix, suffix, len(library_seqs[0]))
+        for lines in iter_fastq_blocks(fq_path, BUFFER_SIZE):
+            offset = extractor.detect_offset(lines[1::4])
+            break
+    counts = np.zeros(len(library_seqs), dtype=np.int64)
+    stats = {}
+
+    def add_chunk(chunk_counts, chunk_stats, metrics):
+        counts[:] += chunk_counts
+        add_stats(stats, chunk_stats)
+        if qc is not None:
+            qc.merge(chunk_counts[:, np.newaxis], {0: chunk_stats}, metrics)
+
+    start_time = time.time()
+    context = multiprocessing.get_context('spawn')
+    with limit_threads(1), \
+            context.Pool(processes, initializer=_init_counter,
+                         initargs=(library_seqs, prefix, suffix, offset,
+                                   mismatches, qc is not None)) as pool:
+        if fq_path.endswith('.gz'):
+            with open_fastq(fq_path) as f:
+                results = _iter_chunk_counts(
+                    pool, iter_record_chunks(f, block_size), 2 * processes)
+                for result in results:
+                    add_chunk(*result)
+        else:
+            if chunk_num is None:
+                chunk_num = 4 * processes
+            tasks = [(fq_path, start, end, block_size)
+                     for start, end in record_ranges(fq_path, chunk_num)]
+            for result in pool.imap_unordered(_count_range, tasks):
+                add_chunk(*result)
+                print('{} reads, {:.0f} reads/s'.format(
+                    stats['reads'], stats['reads'] / (time.time() -
+                                                      start_time)))
+    stats['offset'] = offset
+    if qc is not None:
+        qc.write()
+    out = pd.DataFrame({'sgrna_seq': library_seqs, 'counts': counts},
+                       columns=['sgrna_seq', 'counts'])
+    return out, stats
@@ -0,0 +1,203 @@
+"""Demultiplex a sequencing lane into a guides x samples count matrix
+
+Sample barcodes are read from the FASTQ headers, from an index read file or
+inline from the reads, and assigned to samples with a LibraryIndex of the
+sample sheet. Spacers are extracted and assigned as in
+analysis.count_reads, and the counts of all samples are accumulated in one
+pass with np.bincount over sample * guide_num + guide.
+"""
+import numpy as np
+import pandas as pd
+
+from genome_editing.analysis.count_reads import ASSIGNMENT_NAMES
+from genome_editing.analysis.count_reads import BLOCK_SIZE
+from genome_editing.analysis.count_reads import LibraryIndex
+from genome_editing.analysis.count_reads import PREFIX
+from genome_editing.analysis.count_reads import SUFFIX
+from genome_editing.analysis.count_reads import SpacerExtractor
+from genome_editing.analysis.count_reads import add_stats
+from genome_editing.analysis.count_reads import iter_fastq_blocks
+from genome_editing.analysis.count_reads import iter_paired_blocks
+from genome_editing.analysis.count_reads import read_ids
+
+BARCODE_SOURCES = ('header', 'index_read', 'inline')
+UNDETERMINED = 'undetermined'
+
+
+def read_sample_sheet(sample_sheet):
+    """Read a sample sheet
+
+    Args:
+        sample_sheet: DataFrame or csv file with columns sample and barcode,
+         dual indexes are written as i7+i5, as in the FASTQ headers
+
+    Returns:
+        DataFrame
+    """
+    if isinstance(sample_sheet, str):
+        sample_sheet = pd.read_csv(sample_sheet)
+    assert 'sample' in sample_sheet.columns, 'No sample in sample sheet'
+    assert 'barcode' in sample_sheet.columns, 'No barcode in sample sheet'
+    sample_sheet = sample_sheet.loc[:, ['sample', 'barcode']].copy()
+    sample_sheet.loc[:, 'barcode'] = [x.upper() for x in
+                                      sample_sheet.barcode.values]
+    assert len(set(len(x) for x in sample_sheet.barcode.values)) == 1, \
+        'Barcodes have different lengths'
+    assert not sample_sheet.barcode.duplicated().any(), 'Duplicated barcodes'
+    assert not sample_sheet.loc[:, 'sample'].duplicated().any(), \
+        'Duplicated samples'
+    return sample_sheet
+
+
+def header_barcodes(headers):
+    """The barcodes in Illumina headers, e.g. @id 1:N:0:ACGTACGT+GTTAGCCA"""
+    return [x.rsplit(b':', 1)[-1].strip() for x in headers]
+
+
+def inline_barcodes(seqs, offset, length):
+    return [x[offset:(offset + length)] for x in seqs]
+
+
+def demultiplex_block(lines, barcodes, barcode_index, extractor, library,
+                      qc=None):
+    """Count the spacers of a block for each sample
+
+    Args:
+        lines: lines of complete records
+        barcodes: list of the barcodes of records
+        barcode_index: LibraryIndex of sample barcodes
+        extractor: SpacerExtractor
+        library: LibraryIndex of guides
+        qc: screen_qc.ScreenQC updated with the block, None for no QC
+
+    Returns:
+        np.ndarray of counts, guides x samples, and dict of sample index: read
+        numbers, the last index is for undetermined reads
+    """
+    sample_num = len(barcode_index)
+    guide_num = len(library)
+    sample, _ = barcode_index.assign(np.array(barcodes, dtype=np.bytes_))
+    sample[sample < 0] = sample_num
+    seqs = lines[1::4]
+    spacers, found, _, offsets = extractor.extract(seqs, return_offsets=True)
+    guide, status = library.assign(spacers[found])
+    sample_found = sample[found]
+    counted = (guide >= 0) & (sample_found < sample_num)
+    counts = np.bincount(sample_found[counted] * guide_num + guide[counted],
+                         minlength=sample_num * guide_num)
+    counts = counts.reshape(sample_num, guide_num).T
+
+    read_num = np.bincount(sample, minlength=sample_num + 1)
+    no_spacer_num = np.bincount(sample[~found], minlength=sample_num + 1)
+    status_num = np.bincount(sample_found * len(ASSIGNMENT_NAMES) + status,
+                             minlength=(sample_num + 1) *
+                             len(ASSIGNMENT_NAMES))
+    status_num = status_num.reshape(sample_num + 1, len(ASSIGNMENT_NAMES))
+    stats = {}
+    for i in range(sample_num + 1):
+        stats[i] = {'reads': int(read_num[i]),
+                    'no_spacer': int(no_spacer_num[i])}
+        for j, name in enumerate(ASSIGNMENT_NAMES):
+            stats[i][name] = int(status_num[i, j])
+    if qc is not None:
+        qc.update(seqs, offsets, counts, stats)
+    return counts, stats
+
+
+def demultiplex_counts(fq_path, sample_sheet, library, barcode_source='header',
+                       index_fq=None, barcode_offset=0, prefix=PREFIX,
+                       suffix=SUFFIX, mismatches=0, barcode_mismatches=0,
+                       block_size=BLOCK_SIZE, qc=None):
+    """Count the guides of all samples of a lane in one pass
+
+    Args:
+        fq_path: the FASTQ file of the lane, .gz for gzip file
+        sample_sheet: DataFrame or csv file with columns sample and barcode,
+         longer barcodes of reads are compared by their first bases
+        library: DataFrame with column sgrna_seq, the other columns such as
+         gene_symbol are kept as metadata, or array of spacers
+        barcode_source: where the sample barcodes are
+         'header': the last field of FASTQ headers
+         'index_read': the reads of index_fq
+         'inline': the reads at barcode_offset
+        index_fq: the FASTQ file of index reads, for 'index_read'
+        barcode_offset: the position of barcodes in reads, for 'inline'
+        prefix: the constant sequence before the spacer
+        suffix: the constant sequence after the spacer
+        mismatches: (0, 1), the number of mismatches of spacers tolerated
+        barcode_mismatches: (0, 1), the number of mismatches of barcodes
+         tolerated
+        block_size: the number of bytes read at a time
+        qc: screen_qc.ScreenQC of the library and the samples of the sample
+         sheet, updated with every block and written at the end, None for no
+         QC
+
+    Returns:
+        DataFrame, guide metadata and the counts of each sample, and dict of
+        sample: read numbers, see count_reads.assignment_report
+    """
+    assert barcode_source in BARCODE_SOURCES, 'Wrong barcode_source'
+    assert barcode_source != 'index_read' or index_fq is not None, \
+        'No index_fq'
+    sample_sheet = read_sample_sheet(sample_sheet)
+    if not isinstance(library, pd.DataFrame):
+        library = pd.DataFrame({'sgrna_seq': list(library)})
+    samples = list(sample_sheet.loc[:, 'sample'].values)
+    overlap = set(samples) & set(library.columns)
+    assert len(overlap) == 0, \
+        'Samples named as library columns: {}'.format(', '.join(
+            str(x) for x in overlap))
+    barcode_index = LibraryIndex(sample_sheet.barcode.values,
+                                 barcode_mismatches)
+    guide_index = LibraryIndex(library.sgrna_seq.values, mismatches)
+    extractor = SpacerExtractor(prefix, suffix, guide_index.spacer_len)
+
+    counts = np.zeros((len(guide_index), len(samples)), dtype=np.int64)
+    stats = {i: {} for i in range(len(samples) + 1)}
+    if barcode_source == 'index_read':
+        blocks = iter_paired_blocks(fq_path, index_fq, block_size)
+    else:
+        blocks = ((x, None) for x in iter_fastq_blocks(fq_path, block_size))
+    read_num = 0
+    for lines, index_lines in blocks:
+        if barcode_source == 'header':
+            barcodes = header_barcodes(lines[0::4])
+        elif barcode_source == 'index_read':
+            if read_ids(lines[0::4]) != read_ids(index_lines[0::4]):
+                raise ValueError('Read IDs of {} and {} differ after read '
+                                 '{}'.format(fq_path, index_fq, read_num))
+            barcodes = index_lines[1::4]
+        else:
+            barcodes = inline_barcodes(lines[1::4], barcode_offset,
+                                       barcode_index.spacer_len)
+        block_counts, block_stats = demultiplex_block(
+            lines, barcodes, barcode_index, extractor, guide_index, qc)
+        counts += block_counts
+        for i in block_stats:
+            add_stats(stats[i], block_stats[i])
+        read_num += len(barcodes)
+        print('{} reads, {} undetermined'.format(
+            read_num, stats[len(samples)]['reads']))
+
+    if qc is not None:
+        qc.write()
+    out = library.reset_index(drop=True).copy()
+    for i, sample in enumerate(samples):
+        out.loc[:, sample] = counts[:, i]
+    sample_stats = {x: stats[i] for i, x in enumerate(samples)}
+    sample_stats[UNDETERMINED] = stats[len(samples)]
+    return out, sample_stats
+
+
+def to_sparse(counts, samples):
+    """The counts of samples as a sparse guides x samples matrix
+
+    Args:
+        counts: the output of demultiplex_counts
+        samples: the sample columns
+
+    Returns:
+        scipy.sparse.csr_matrix
+    """
+    import scipy.sparse
+    return scipy.sparse.csr_matrix(counts.loc[:, samples].values)
@@ -0,0 +1,319 @@
+"""Gene-level enrichment statistics of screen counts
+
+Counts are normalized by median ratio or total count, and each comparison of
+treatment and control samples gives a log fold change and variance of every
+guide. Guides are ranked by log fold change and each gene is scored by robust
+rank aggregation (RRA): the smallest probability that the j-th best of its k
+percentiles is as small under uniform percentiles,
+
+    rho = min_j P(U_(j) <= u_(j)) = min_j betainc(j, k - j + 1, u_(j))
+
+Genes with the same guide number k are scored as one percentile matrix, so a
+large gene such as a control group does not pad the others. The null
+distribution of rho only depends on k, so it is simulated once per gene size
+from a matrix of random percentiles, cached and shared by all comparisons and
+directions. Nulls and comparisons are run in a process pool.
+"""
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from genome_editing.utils.parallel import limit_threads
+
+PSEUDO_COUNT = 0.5
+PERM_NUM = 10000
+DIRECTIONS = ('neg', 'pos')
+# (guide number, perm_num, seed): sorted null RRA scores
+_NULLS = {}
+
+
+def size_factors(counts, method='median'):
+    """Compute the size factors of samples
+
+    Args:
+        counts: np.ndarray, guides x samples
+        method: 'median', median ratio to the geometric mean of guides with
+         counts in all samples; 'total', total counts
+
+    Returns:
+        np.ndarray, the size factor of each sample
+    """
+    assert method in ('median', 'total'), 'Wrong method'
+    counts = np.asarray(counts, dtype=np.float64)
+    if method == 'total':
+        total = counts.sum(axis=0)
+        return total / np.mean(total)
+    expressed = np.all(counts > 0, axis=1)
+    assert expressed.any(), 'No guide with counts in all samples'
+    log_counts = np.log(counts[expressed])
+    log_ratio = log_counts - log_counts.mean(axis=1, keepdims=True)
+    return np.exp(np.median(log_ratio, axis=0))
+
+
+def normalize_counts(counts, method='median'):
+    """Divide counts by the size factors of samples"""
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts / size_factors(counts, method)
+
+
+def guide_lfc(norm_counts, control, treatment, pseudo_count=PSEUDO_COUNT):
+    """Compute the log2 fold change and its variance of guides
+
+    Args:
+        norm_counts: np.ndarray of normalized counts, guides x samples
+        control: column indices of control samples
+        treatment: column indices of treatment samples
+        pseudo_count: added to counts before log
+
+    Returns:
+        np.ndarray of log2 fold changes and np.ndarray of variances, the
+        variance is NaN without replicates
+    """
+    log_counts = np.log2(norm_counts + pseudo_count)
+    log_control = log_counts[:, control]
+    log_treatment = log_counts[:, treatment]
+    lfc = log_treatment.mean(axis=1) - log_control.mean(axis=1)
+    if len(control) < 2 or len(treatment) < 2:
+        return lfc, np.full(len(lfc), np.nan)
+    variance = np.var(log_control, axis=1, ddof=1) / len(control) + \
+        np.var(log_treatment, axis=1, ddof=1) / len(treatment)
+    return lfc, variance
+
+
+def group_guides(genes):
+    """Group guides by gene, genes with the same guide number form a matrix
+
+    Args:
+        genes: array of the gene of each guide
+
+    Returns:
+        np.ndarray of gene names, np.ndarray of the guide number of genes, and
+        dict, guide number k: (np.ndarray of gene indices, np.ndarray of guide
+        indices, genes x k)
+    """
+    gene_names, gene_codes = np.unique(np.asarray(genes), return_inverse=True)
+    guide_num = np.bincount(gene_codes)
+    order = np.argsort(gene_codes, kind='mergesort')
+    bounds = np.concatenate(([0], np.cumsum(guide_num)))
+    groups = {}
+    for k in np.unique(guide_num):
+        gene_index = np.flatnonzero(guide_num == k)
+        members = order[bounds[gene_index][:, np.newaxis] + np.arange(k)]
+        groups[int(k)] = (gene_index, members)
+    return gene_names, guide_num, groups
+
+
+def gene_medians(values, groups, gene_num):
+    """The median of guide values of each gene
+
+    Args:
+        values: np.ndarray, a value of each guide
+        groups: dict, see group_guides
+        gene_num: the number of genes
+
+    Returns:
+        np.ndarray
+    """
+    out = np.empty(gene_num)
+    for k, (gene_index, members) in groups.items():
+        out[gene_index] = np.median(values[members], axis=1)
+    return out
+
+
+def rra_scores(percentiles, guide_num):
+    """Compute the RRA score of genes
+
+    Args:
+        percentiles: np.ndarray, genes x max guide number, padded with NaN
+        guide_num: np.ndarray, the guide number of each gene
+
+    Returns:
+        np.ndarray, rho of each gene
+    """
+    percentiles = np.sort(percentiles, axis=1)
+    j = np.arange(1, percentiles.shape[1] + 1)[np.newaxis, :]
+    k = np.asarray(guide_num)[:, np.newaxis]
+    valid = j <= k
+    # padded positions get b <= 0, they are masked
+    b = np.where(valid, k - j + 1, 1)
+    prob = scipy.stats.beta.cdf(np.where(valid, percentiles, 1), j, b)
+    return np.min(np.where(valid, prob, 1), axis=1)
+
+
+def rra_null(guide_num, perm_num=PERM_NUM, rng=None):
+    """Simulate the RRA score of genes with k guides of uniform percentiles
+
+    Args:
+        guide_num: k
+        perm_num: the number of permutations
+        rng: np.random.RandomState
+
+    Returns:
+        sorted np.ndarray of null RRA scores
+    """
+    if rng is None:
+        rng = np.random.RandomState(0)
+    percentiles = rng.random_sample((perm_num, guide_num))
+    return np.sort(rra_scores(percentiles,
+                              np.full(perm_num, guide_num, dtype=np.int64)))
+
+
+def _run_null(args):
+    guide_num, perm_num, seed = args
+    return rra_null(guide_num, perm_num,
+                    np.random.RandomState([seed, guide_num]))
+
+
+def rra_nulls(sizes, perm_num=PERM_NUM, seed=0, pool=None):
+    """The null RRA scores of each gene size, simulated once per process
+
+    Args:
+        sizes: the guide numbers of genes
+        perm_num: the number of permutations
+        seed: the random seed, the null of k is seeded by (seed, k)
+        pool: multiprocessing pool simulating the missing nulls, None for
+         this process
+
+    Returns:
+        dict, guide number: sorted np.ndarray of null RRA scores
+    """
+    keys = [(int(k), perm_num, seed) for k in np.unique(sizes)]
+    missing = [x for x in keys if x not in _NULLS]
+    if pool is None:
+        results = [_run_null(x) for x in missing]
+    else:
+        # the largest genes first, so they do not finish last
+        missing.sort(reverse=True)
+        results = pool.map(_run_null, missing, chunksize=1)
+    for key, null in zip(missing, results):
+        _NULLS[key] = null
+    return {x[0]: _NULLS[x] for x in keys}
+
+
+def fdr_bh(p_values):
+    """Benjamini-Hochberg adjusted p-values"""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    n = len(p_values)
+    if n == 0:
+        return p_values
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    out = np.empty(n)
+    out[order] = np.minimum(adjusted, 1)
+    return out
+
+
+def gene_rra(lfc, guide_num, groups, direction='neg', perm_num=PERM_NUM,
+             seed=0, nulls=None):
+    """Score genes by the ranks of their guides
+
+    Args:
+        lfc: np.ndarray, log2 fold change of guides
+        guide_num: np.ndarray, the guide number of genes
+        groups: dict, guide indices of genes by guide number, see
+         group_guides
+        direction: 'neg' for depletion, 'pos' for enrichment
+        perm_num: the number of permutations of the null distribution
+        seed: the random seed
+        nulls: dict, guide number: null RRA scores, see rra_nulls, simulated
+         if None
+
+    Returns:
+        np.ndarray of RRA scores and np.ndarray of permutation p-values
+    """
+    assert direction in DIRECTIONS, 'Wrong direction'
+    values = lfc if direction == 'neg' else -lfc
+    percentiles = (scipy.stats.rankdata(values) - 0.5) / len(values)
+    scores = np.empty(len(guide_num))
+    p_values = np.empty(len(guide_num))
+    if nulls is None:
+        nulls = rra_nulls(list(groups), perm_num, seed)
+    for k in sorted(groups):
+        gene_index, members = groups[k]
+        scores[gene_index] = rra_scores(percentiles[members],
+                                        np.full(len(gene_index), k))
+        null = nulls[k]
+        p_values[gene_index] = (np.searchsorted(null, scores[gene_index],
+                                                side='right') + 1) / \
+            (perm_num + 1)
+    return scores, p_values
+
+
+def _run_direction(args):
+    lfc, guide_num, groups, direction, perm_num, nulls = args
+    return gene_rra(lfc, guide_num, groups, direction, perm_num,
+                    nulls=nulls)
+
+
+def compare_samples(counts, comparisons, gene_col='gene_symbol',
+                    method='median', pseudo_count=PSEUDO_COUNT,
+                    perm_num=PERM_NUM, processes=None, seed=0):
+    """Compute guide and gene statistics of comparisons
+
+    Args:
+        counts: DataFrame, guide metadata with gene_col and the counts of each
+         sample, e.g. the output of demultiplex.demultiplex_counts
+        comparisons: dict, name: (control samples, treatment samples)
+        gene_col: the gene column
+        method: ('median', 'total'), the normalization method
+        pseudo_count: added to normalized counts before log
+        perm_num: the number of permutations of the null distribution
+        processes: the number of worker processes, the number of CPUs if None,
+         1 runs in this process
+        seed: the random seed of the nulls, shared by all comparisons
+
+    Returns:
+        dict, name: (DataFrame of guides, DataFrame of genes)
+    """
+    samples = []
+    for name in comparisons:
+        for sample in list(comparisons[name][0]) + \
+                list(comparisons[name][1]):
+            assert sample in counts.columns, 'No sample {}'.format(sample)
+            if sample not in samples:
+                samples.append(sample)
+    norm_counts = normalize_counts(counts.loc[:, samples].values, method)
+    gene_names, guide_num, groups = group_guides(counts.loc[:, gene_col]
+                                                  .values)
+
+    names = list(comparisons)
+    guide_stats = {}
+    for name in names:
+        control = [samples.index(x) for x in comparisons[name][0]]
+        treatment = [samples.index(x) for x in comparisons[name][1]]
+        guide_stats[name] = guide_lfc(norm_counts, control, treatment,
+                                      pseudo_count)
+    if processes == 1:
+        nulls = rra_nulls(list(groups), perm_num, seed)
+        tasks = [(guide_stats[x][0], guide_num, groups, y, perm_num, nulls)
+                 for x in names for y in DIRECTIONS]
+        results = [_run_direction(x) for x in tasks]
+    else:
+        context = multiprocessing.get_context('spawn')
+        with limit_threads(1), context.Pool(processes) as pool:
+            nulls = rra_nulls(list(groups), perm_num, seed, pool)
+            tasks = [(guide_stats[x][0], guide_num, groups, y, perm_num,
+                      nulls) for x in names for y in DIRECTIONS]
+            results = pool.map(_run_direction, tasks, chunksize=1)
+
+    out = {}
+    for i, name in enumerate(names):
+        lfc, variance = guide_stats[name]
+        guides = counts.loc[:, [x for x in counts.columns
+                                if x not in samples]].reset_index(drop=True)
+        guides.loc[:, 'lfc'] = lfc
+        guides.loc[:, 'variance'] = variance
+        genes = pd.DataFrame({gene_col: gene_names, 'guide_num': guide_num,
+                              'lfc': gene_medians(lfc, groups,
+                                                  len(gene_names))},
+                             columns=[gene_col, 'guide_num', 'lfc'])
+        for j, direction in enumerate(DIRECTIONS):
+            scores, p_values = results[2 * i + j]
+            genes.loc[:, direction + '_score'] = scores
+            genes.loc[:, direction + '_p'] = p_values
+            genes.loc[:, direction + '_fdr'] = fdr_bh(p_values)
+        out[name] = (guides, genes.sort_values('neg_score')
+                     .reset_index(drop=True))
+    return out
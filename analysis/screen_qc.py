@@ -0,0 +1,217 @@
+"""Streaming QC metrics of screen sequencing
+
+ScreenQC is updated with every block during counting, so the metrics need no
+second pass over the reads: reads and counts per sample, spacer offset
+histogram and per-position base composition are accumulated as arrays, and
+mapped ratios, zero-count guides, Gini index and top guides are derived from
+them when the report is built. The report is written as JSON at the end and
+optionally every report_interval reads. Counting workers accumulate the read
+metrics of their chunks in ReadMetrics, which are merged into the ScreenQC of
+the parent.
+"""
+import json
+import os
+import numpy as np
+
+from genome_editing.analysis.count_reads import to_byte_array
+
+BASES = 'ACGTN'
+TOP_NUM = 10
+
+
+def gini_index(counts):
+    """The Gini index of counts, 0 for even counts and (n - 1) / n when all
+    counts are of one of n guides"""
+    counts = np.sort(np.asarray(counts, dtype=np.float64))
+    n = len(counts)
+    total = counts.sum()
+    if n == 0 or total == 0:
+        return np.nan
+    return 2 * np.sum(np.arange(1, n + 1) * counts) / (n * total) - \
+        (n + 1) / n
+
+
+def base_composition(seqs):
+    """Count the bases of reads at each position
+
+    Args:
+        seqs: list of bytes
+
+    Returns:
+        np.ndarray, BASES x the max read length, other bytes are N
+    """
+    codes = to_byte_array(seqs)
+    composition = np.zeros((len(BASES), codes.shape[1]), dtype=np.int64)
+    padding = np.sum(codes == 0, axis=0)
+    for i, base in enumerate(BASES[:-1]):
+        composition[i] = np.sum(codes == ord(base), axis=0)
+    composition[-1] = len(seqs) - padding - composition[:-1].sum(axis=0)
+    return composition
+
+
+def add_columns(total, block):
+    """Add arrays with possibly fewer columns"""
+    if block.shape[-1] > total.shape[-1]:
+        padding = [(0, 0)] * (total.ndim - 1) + \
+            [(0, block.shape[-1] - total.shape[-1])]
+        total = np.pad(total, padding, mode='constant')
+    total[..., :block.shape[-1]] += block
+    return total
+
+
+class ReadMetrics:
+    """Spacer offset histogram and base composition of reads, the part of
+    ScreenQC computed from the reads"""
+
+    def __init__(self):
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.composition = np.zeros((len(BASES), 0), dtype=np.int64)
+        self.read_num = 0
+
+    def __repr__(self):
+        return 'ReadMetrics(reads={})'.format(self.read_num)
+
+    def update(self, seqs, offsets, counts=None, sample_stats=None):
+        """Add a block of reads, counts and sample_stats are not kept, so it
+        can be passed as qc to count_reads.count_block
+
+        Args:
+            seqs: list of read sequences, bytes
+            offsets: np.ndarray of spacer offsets of reads, -1 if not found
+            counts: ignored
+            sample_stats: ignored
+        """
+        offsets = np.asarray(offsets)
+        self.offsets = add_columns(self.offsets,
+                                   np.bincount(offsets[offsets >= 0]))
+        self.composition = add_columns(self.composition,
+                                       base_composition(seqs))
+        self.read_num += len(seqs)
+
+
+class ScreenQC:
+    """Accumulate QC metrics of screen sequencing
+
+    Example:
+        qc = ScreenQC(library.sgrna_seq.values, json_path='qc.json')
+        counts, stats = count_reads.count_fastq(fq_path, library.sgrna_seq,
+                                                qc=qc)
+    """
+
+    def __init__(self, guides, samples=('sample',), json_path=None,
+                 report_interval=None, top_num=TOP_NUM):
+        """
+
+        Args:
+            guides: array of guide names or spacers, in the library order
+            samples: sample names, in the order of count columns
+            json_path: the JSON output, None for no output
+            report_interval: if not None, the JSON is also written every
+             report_interval reads
+            top_num: the number of top guides reported of each sample
+        """
+        self.guides = list(guides)
+        self.samples = list(samples)
+        self.json_path = json_path
+        self.report_interval = report_interval
+        self.top_num = top_num
+        self.counts = np.zeros((len(self.guides), len(self.samples)),
+                               dtype=np.int64)
+        # the last is undetermined reads of demultiplexing
+        self.sample_stats = [{} for _ in range(len(self.samples) + 1)]
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.composition = np.zeros((len(BASES), 0), dtype=np.int64)
+        self.read_num = 0
+        self.next_report = report_interval
+
+    def __repr__(self):
+        return 'ScreenQC(guides={}, samples={}, reads={})'.format(
+            len(self.guides), len(self.samples), self.read_num)
+
+    def update(self, seqs, offsets, counts, sample_stats):
+        """Add a block of reads
+
+        Args:
+            seqs: list of read sequences, bytes
+            offsets: np.ndarray of spacer offsets of reads, -1 if not found
+            counts: np.ndarray of counts of the block, guides x samples
+            sample_stats: dict, sample index: read numbers of the block
+        """
+        metrics = ReadMetrics()
+        metrics.update(seqs, offsets)
+        self.merge(counts, sample_stats, metrics)
+
+    def merge(self, counts, sample_stats, metrics):
+        """Add reads counted elsewhere, e.g. by a worker process
+
+        Args:
+            counts: np.ndarray of counts of the reads, guides x samples
+            sample_stats: dict, sample index: read numbers of the reads
+            metrics: ReadMetrics of the reads
+        """
+        self.counts += counts
+        for i in sample_stats:
+            for key, value in sample_stats[i].items():
+                self.sample_stats[i][key] = \
+                    self.sample_stats[i].get(key, 0) + value
+        self.offsets = add_columns(self.offsets, metrics.offsets)
+        self.composition = add_columns(self.composition, metrics.composition)
+        self.read_num += metrics.read_num
+        if self.next_report is not None and self.read_num >= self.next_report:
+            self.write()
+            while self.next_report <= self.read_num:
+                self.next_report += self.report_interval
+
+    def sample_report(self, i):
+        """The QC metrics of the i-th sample"""
+        counts = self.counts[:, i]
+        stats = self.sample_stats[i]
+        read_num = stats.get('reads', 0)
+        counted = int(counts.sum())
+        top = np.argsort(-counts, kind='mergesort')[:self.top_num]
+        report = {
+            'reads': read_num,
+            'counted_reads': counted,
+            'mapped_ratio': counted / read_num if read_num > 0 else None,
+            'zero_count_guides': int(np.sum(counts == 0)),
+            'zero_count_ratio': float(np.mean(counts == 0))
+            if len(counts) > 0 else None,
+            'gini_index': float(gini_index(counts)) if counted > 0 else None,
+            'top_guides': [{'guide': str(self.guides[x]),
+                            'counts': int(counts[x]),
+                            'ratio': counts[x] / counted}
+                           for x in top if counts[x] > 0],
+            'read_numbers': stats}
+        return report
+
+    def report(self):
+        """Build the QC report
+
+        Returns:
+            dict, JSON serializable
+        """
+        composition = self.composition / np.maximum(
+            self.composition.sum(axis=0), 1)
+        report = {
+            'reads': self.read_num,
+            'samples': {x: self.sample_report(i)
+                        for i, x in enumerate(self.samples)},
+            'spacer_offsets': {str(i): int(x) for i, x in
+                               enumerate(self.offsets) if x > 0},
+            'base_composition': {x: [round(y, 4) for y in composition[i]]
+                                 for i, x in enumerate(BASES)}}
+        undetermined = self.sample_stats[-1]
+        if len(undetermined) > 0:
+            report['undetermined'] = undetermined
+        return report
+
+    def write(self, json_path=None):
+        """Write the report as JSON, the file is replaced only when it is
+        complete"""
+        json_path = self.json_path if json_path is None else json_path
+        if json_path is None:
+            return
+        temp_path = json_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(temp_path, json_path)
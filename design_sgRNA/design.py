@@ -1,24 +1,36 @@
 """Design sgRNAs for CRISPR/Cas9 Knock-out gene editing
 Reference Genome: igenome UCSC hg19, start is 0-based
 """
+import collections
 import os
 import numpy as np
 import pandas as pd
 import regex
 import sqlalchemy
-from Bio.Alphabet import IUPAC
-from Bio.Seq import Seq
 
-from genome_editing.score_sgrna.rs2 import compute_rs2
-import genome_editing.score_sgrna.deep_rank as deep_rank
+from genome_editing.score_sgrna.rs2 import compute_rs2, get_rs2_scorer
+import genome_editing.score_sgrna.deep_rank_numpy as deep_rank_numpy
+import genome_editing.score_sgrna.microhomology as microhomology
 import genome_editing.score_sgrna.off_targets as off_targets
 from genome_editing.score_sgrna.off_targets import sgrna_off_targets
+from genome_editing.score_sgrna.score_cache import cached_scores
+from genome_editing.utils.sequence import gc_content, has_homopolymer, \
+    reverse_complement_batch
 from ..utils import alignment
 import genome_editing.utils.utilities as util
 
 GENOME_EDITING_URI = os.environ.get('GENOME_EDITING_URI')
 CHROMS = ['chr' + str(x) for x in range(1, 23)]
 CHROMS += ['chrX', 'chrY', 'chrM']
+OUTPUT_COLUMNS = ['gene_symbol', 'refseq_id', 'exon_id', 'chrom', 'strand',
+                  'start', 'end', 'raw_sequence', 'pam_type',
+                  'cutting_site_type', 'cutting_site', 'sgrna_seq',
+                  'sgrna_full_seq', 'percent_cds', 'sgrna_id']
+# the max parameters of DesignCache, and of the single mode form
+MAX_UPSTREAM = 10
+MAX_DOWNSTREAM = 10
+MAX_SGRNA_LENGTH = 30
+MAX_FLANK = 100
 
 
 class Designer:
@@ -28,7 +40,7 @@ class Designer:
                  ref_genome='hg38',
                  sgrna_upstream=4, sgrna_downstream=7,
                  sgrna_length=20, flank=30, overlapped=True,
-                 filter_tttt=False):
+                 filter_tttt=False, chrom_seq=None):
         """
 
         Args:
@@ -40,15 +52,17 @@ class Designer:
             flank: the length of flank aroung each exon
             overlapped: whether find overlopped sgRNAs
             filter_tttt: whether filter sgRNAs containing TTTT
+            chrom_seq: the sequence of the chromosome of the target, queried
+             from the database if None
         """
         assert ref_genome in ('hg19', 'hg38', 'mm10'), 'Wrong reference genome'
 
         if refseq_id is not None:
             self.target_gene = Transcript(refseq_id, ref_genome=ref_genome)
-            self.target_gene.get_sequence(flank)
+            self.target_gene.get_sequence(flank, chrom_seq)
         elif gene_symbol is not None:
             self.target_gene = Gene(gene_symbol.upper(), ref_genome=ref_genome)
-            self.target_gene.get_sequence(flank)
+            self.target_gene.get_sequence(flank, chrom_seq)
         # else:
         #     raise BaseException('Error: please provide either gene symbol or'
         #                         'refseq ID')
@@ -217,7 +231,7 @@ class Designer:
         Returns:
             str, the reverse complement of input sequence
         """
-        return str(Seq(sgrna_seq).reverse_complement())
+        return util.reverse_complement(sgrna_seq)
 
     def get_cds_info(self):
         """Compute peptide percentage of cutting site"""
@@ -297,14 +311,69 @@ class Designer:
                 flag = False
             else:
                 df = df.append([df_row])
-        df.columns = ['gene_symbol', 'refseq_id', 'exon_id', 'chrom', 'strand',
-                      'start', 'end', 'raw_sequence', 'pam_type',
-                      'cutting_site_type', 'cutting_site', 'sgrna_seq',
-                      'sgrna_full_seq', 'percent_cds']
+        df.columns = OUTPUT_COLUMNS[:-1]
         df.loc[:, 'cutting_site'] = df.cutting_site.astype(np.float)
         df.loc[:, 'sgrna_id'] = np.arange(0, df.shape[0])
         return df
 
+    def get_deep_rank_scores(self, scorer=None, cache=None):
+        """Score sgRNAs by deep rank, the sgRNA sequences have to include 4bp
+        upstream and 7bp downstream (the default)
+
+        Args:
+            scorer: DeepRankScorer, the shared scorer is used if None
+            cache: ScoreCache, the shared cache (if any) is used if None
+
+        Returns:
+            pd.DataFrame, the output with deep_rank_score
+        """
+        df = self.output()
+        df.loc[:, 'deep_rank_score'] = score_deep_rank(df, scorer, cache)
+        return df
+
+    def get_cut_contexts(self, design_output, window=30):
+        """Get the sequences around cutting sites from exon sequences with
+        flank, bases beyond the flank are N
+
+        Args:
+            design_output: the output of Designer
+            window: the length of sequence on each side of cutting sites
+
+        Returns:
+            list of sequences with length 2 * window, on the plus strand
+        """
+        exons = self.target_gene.exons
+        exon_index = dict(zip(exons.exon_id.values, range(exons.shape[0])))
+        padding = 'N' * window
+        padded_seqs = [padding + seq + padding
+                       for seq in exons.seq_with_flank.values]
+        offsets = exons.start.values - self.flank
+        # the cutting site is between two bases, e.g. end - 2.5
+        cuts = (design_output.cutting_site.values + 0.5).astype(np.int64)
+        contexts = []
+        for exon_id, cut in zip(design_output.exon_id.values, cuts):
+            i = exon_index[exon_id]
+            start = cut - offsets[i]
+            contexts.append(padded_seqs[i][start:(start + 2 * window)])
+        return contexts
+
+    def get_microhomology_scores(self, window=30):
+        """Score sgRNAs by microhomology and out-of-frame scores, the scores
+        are symmetric so both strands are scored on the plus strand
+
+        Args:
+            window: the length of sequence on each side of cutting sites
+
+        Returns:
+            pd.DataFrame, the output with mh_score and oof_score
+        """
+        df = self.output()
+        mh_score, oof_score = microhomology.microhomology_scores(
+            self.get_cut_contexts(df, window), window)
+        df.loc[:, 'mh_score'] = mh_score
+        df.loc[:, 'oof_score'] = oof_score
+        return df
+
     # def print_cutting_site(self):
     #     sgrnas_df = self.output()
     #     cutting_site_coding = sgrnas_df[
@@ -531,19 +600,21 @@ class Gene:
 
         return exons
 
-    def get_sequence(self, flank):
+    def get_sequence(self, flank, chrom_seq=None):
         """Get exons' sequences with flank
 
         Args:
             flank: length of flank
+            chrom_seq: the sequence of self.chrom, queried from the database
+             if None
 
         Returns:
             None, the results are stored in self.exons
         """
         self.exons.loc[:, 'seq_with_flank'] = ''
         self.exons.loc[:, 'flank'] = flank
-        table_name = 'igenome_ucsc_{}_{}'.format(self.ref_genome, self.chrom)
-        chrom_seq = pd.read_sql(table_name, self.engine).iloc[0, 0]
+        if chrom_seq is None:
+            chrom_seq = get_chrom_seq(self.ref_genome, self.chrom, self.engine)
         for i in range(self.exons.shape[0]):
             # NOTE: start is 0-based but end  is 1-based
             start = self.exons.loc[:, 'start'].values[i] - flank
@@ -577,6 +648,9 @@ class Gene:
                    cds_start_exon_index:(cds_end_exon_index + 1)].copy()
         cds_starts[0] = cds_start
         cds_ends[-1] = cds_end
+        from Bio.Alphabet import IUPAC
+        from Bio.Seq import Seq
+
         table_name = 'igenome_ucsc_{}_{}'.format(self.ref_genome, self.chrom)
         chrom_seq = pd.read_sql(table_name, self.engine).iloc[0, 0]
         seq = ''
@@ -784,7 +858,7 @@ class SgRNA:
         Returns:
             str, the reverse complement of input sequence
         """
-        return str(Seq(self.sequence).reverse_complement())
+        return util.reverse_complement(self.sequence)
 
     # def print(self):
     #     """Print the SgRNA object
@@ -926,21 +1000,169 @@ class SeqDesigner(Designer):
         return df
 
 
+class DesignCache:
+    """Superset designs of targets, one per (gene, PAM, reference genome)
+
+    The superset is scanned once with the max upstream, downstream, sgRNA
+    length and flank. A design with smaller parameters is derived by
+    slicing the superset, which gives the same output as a Designer run
+    with overlapped=True, without fetching or scanning the genome again.
+    """
+
+    def __init__(self, max_upstream=MAX_UPSTREAM,
+                 max_downstream=MAX_DOWNSTREAM,
+                 max_sgrna_length=MAX_SGRNA_LENGTH, max_flank=MAX_FLANK,
+                 max_size=64):
+        """
+
+        Args:
+            max_upstream: the max length of upstream base pairs
+            max_downstream: the max length of downstream base pairs
+            max_sgrna_length: the max length of sgRNA
+            max_flank: the max length of flank around each exon
+            max_size: the max number of supersets kept in memory
+        """
+        self.max_upstream = max_upstream
+        self.max_downstream = max_downstream
+        self.max_sgrna_length = max_sgrna_length
+        self.max_flank = max_flank
+        self.max_size = max_size
+        self.supersets = collections.OrderedDict()
+
+    def __repr__(self):
+        return 'DesignCache(size={})'.format(len(self.supersets))
+
+    def get_superset(self, pam, ref_genome='hg38', gene_symbol=None,
+                     refseq_id=None):
+        """The superset design of a target, scanned if not cached
+
+        Returns:
+            the output of Designer (None if there is no sgRNA), and a
+            DataFrame of exon_id, start and end
+        """
+        key = (gene_symbol, refseq_id, pam, ref_genome)
+        if key in self.supersets:
+            self.supersets.move_to_end(key)
+            return self.supersets[key]
+        # any window of smaller parameters inside the max flank is inside the
+        # scanned region
+        extend = self.max_upstream + self.max_sgrna_length + \
+            self.max_downstream
+        designer = Designer(gene_symbol=gene_symbol, refseq_id=refseq_id,
+                            ref_genome=ref_genome,
+                            sgrna_upstream=self.max_upstream,
+                            sgrna_downstream=self.max_downstream,
+                            sgrna_length=self.max_sgrna_length,
+                            flank=self.max_flank + extend, overlapped=True)
+        designer.get_sgrnas([pam])
+        superset = None
+        if len(designer.sgrnas) > 0:
+            superset = designer.output()
+        exons = designer.target_gene.exons.loc[:, ['exon_id', 'start', 'end']]
+        self.supersets[key] = (superset, exons)
+        if len(self.supersets) > self.max_size:
+            self.supersets.popitem(last=False)
+        return self.supersets[key]
+
+    def design(self, pam, ref_genome='hg38', gene_symbol=None,
+               refseq_id=None, sgrna_upstream=4, sgrna_downstream=7,
+               sgrna_length=20, flank=30, filter_tttt=False):
+        """Design sgRNAs from the superset, same arguments as Designer
+
+        Returns:
+            pd.DataFrame, same as Designer.output, empty if there is no sgRNA
+        """
+        assert sgrna_upstream <= self.max_upstream, 'Too long upstream'
+        assert sgrna_downstream <= self.max_downstream, 'Too long downstream'
+        assert sgrna_length <= self.max_sgrna_length, 'Too long sgRNA'
+        assert flank <= self.max_flank, 'Too long flank'
+        if gene_symbol is not None:
+            gene_symbol = gene_symbol.upper()
+        superset, exons = self.get_superset(pam, ref_genome, gene_symbol,
+                                            refseq_id)
+        if superset is None:
+            return pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+        # the window of each sgRNA on the plus strand
+        forward = (superset.strand == '+').values
+        pam_len = len(pam)
+        window_start = np.where(
+            forward,
+            superset.end.values + 1 - sgrna_length - sgrna_upstream,
+            superset.start.values - pam_len - sgrna_downstream)
+        window_end = np.where(
+            forward,
+            superset.end.values + 1 + pam_len + sgrna_downstream,
+            superset.start.values + sgrna_length + sgrna_upstream)
+        exon_starts = superset.exon_id.map(
+            dict(zip(exons.exon_id, exons.start))).values
+        exon_ends = superset.exon_id.map(
+            dict(zip(exons.exon_id, exons.end))).values
+        keep = (window_start >= exon_starts - flank) & \
+            (window_end <= exon_ends + flank)
+
+        # full sequences are oriented, upstream + sgRNA + PAM + downstream
+        head = self.max_upstream + self.max_sgrna_length - \
+            sgrna_length - sgrna_upstream
+        full_len = sgrna_upstream + sgrna_length + pam_len + sgrna_downstream
+        df = superset.loc[keep, :].copy()
+        forward = forward[keep]
+        df.loc[:, 'sgrna_full_seq'] = df.sgrna_full_seq.str.slice(
+            head, head + full_len)
+        df.loc[:, 'sgrna_seq'] = df.sgrna_full_seq.str.slice(
+            sgrna_upstream, sgrna_upstream + sgrna_length)
+        raw_sequence = df.sgrna_seq.values.copy()
+        raw_sequence[~forward] = reverse_complement_batch(
+            raw_sequence[~forward])
+        df.loc[:, 'raw_sequence'] = raw_sequence
+        df.loc[:, 'start'] = np.where(forward,
+                                      df.end.values - sgrna_length + 1,
+                                      df.start.values)
+        df.loc[:, 'end'] = np.where(forward, df.end.values,
+                                    df.start.values + sgrna_length - 1)
+        if filter_tttt:
+            df = df[~has_homopolymer(df.sgrna_seq.values, 'T', 4)]
+        df.index = range(df.shape[0])
+        df.loc[:, 'sgrna_id'] = np.arange(0, df.shape[0])
+        return df
+
+
+_DESIGN_CACHE = None
+
+
+def get_design_cache():
+    """The DesignCache shared by the process"""
+    global _DESIGN_CACHE
+    if _DESIGN_CACHE is None:
+        _DESIGN_CACHE = DesignCache()
+    return _DESIGN_CACHE
+
+
 def build_screen_library(inputs, sgrna_num=3, ref_genome='hg38',
                          mode='gene_symbol', off_target_tol='standard',
-                         pam='NGG'):
+                         pam='NGG', scorer=None, cache=None,
+                         score_col='deep_rank_score', gc_range=(0.2, 0.8),
+                         max_off_targets=0):
     """Build screen library for a gene list. In gene_symbol mode, for gene that
     have multiple transcripts, we will design sgRNAs for each transcript.
 
     Args:
         inputs:
-        sgrna_num:
+        sgrna_num: the number of sgRNAs of each transcript
         ref_genome:
         pam:
         mode: ('gene_symbol', 'refseq_id')
+        off_target_tol: ('high', 'standard', 'low', False), the seed length of
+         off-target search
+        scorer: DeepRankScorer, the shared scorer is used if None
+        cache: ScoreCache, the shared cache (if any) is used if None
+        score_col: the on-target score used to rank sgRNAs
+        gc_range: the range of GC content passing the filter
+        max_off_targets: sgRNAs with more off-targets are removed, None keeps
+         them ranked last
 
     Returns:
-
+        DataFrame, the top sgRNAs of each transcript with their rank
     """
     engine = sqlalchemy.create_engine(GENOME_EDITING_URI)
 
@@ -953,65 +1175,229 @@ def build_screen_library(inputs, sgrna_num=3, ref_genome='hg38',
     # get the refseq IDs of the input
     if mode == 'gene_symbol':
         table_name = 'igenome_ucsc_{}_refgene'.format(ref_genome)
-        gene_info = pd.read_sql(table_name, engine)
-        refseq_ids = gene_info[gene_info.name2.isin(inputs)].name.values
+        transcripts, unresolved = util.resolve_genes(inputs, table_name,
+                                                     engine=engine)
+        if len(unresolved) > 0:
+            print('{} genes not found: {}'.format(len(unresolved),
+                                                  ', '.join(unresolved)))
+        refseq_ids = pd.unique(transcripts.refseq_id.values)
     else:
         refseq_ids = inputs
 
+    design_outputs = [design_coding_sgrnas(refseq_id, ref_genome, pam)
+                      for refseq_id in refseq_ids]
+    design_output = score_library(
+        pd.concat([x for x in design_outputs if x is not None],
+                  ignore_index=True),
+        off_target_tol=off_target_tol, pam=pam, scorer=scorer, cache=cache)
+
+    # Pick sgRNA
+    return pick_top_sgrna(design_output, sgrna_num, score_col=score_col,
+                          gc_range=gc_range, max_off_targets=max_off_targets)
+
+
+def get_chrom_seq(ref_genome, chrom, engine=None):
+    """Query the sequence of a chromosome
+
+    Args:
+        ref_genome: reference genome, e.g. hg38
+        chrom: chromosome, e.g. chr1
+        engine: sqlalchemy engine, created from GENOME_EDITING_URI if None
+
+    Returns:
+        str, the sequence of the chromosome
+    """
+    if engine is None:
+        engine = sqlalchemy.create_engine(GENOME_EDITING_URI)
+    table_name = 'igenome_ucsc_{}_{}'.format(ref_genome, chrom)
+    return pd.read_sql(table_name, engine).iloc[0, 0]
+
+
+def design_coding_sgrnas(refseq_id, ref_genome='hg38', pam='NGG',
+                         chrom_seq=None):
+    """Design the sgRNAs of a transcript cutting coding regions, with 4bp
+    upstream and 7bp downstream
+
+    Args:
+        refseq_id: refseq ID
+        ref_genome: reference genome
+        pam: PAM
+        chrom_seq: the sequence of the chromosome of the transcript, queried
+         from the database if None
+
+    Returns:
+        DataFrame, the output of Designer, None if there is no sgRNA
+    """
+    sgrna_designer = Designer(refseq_id=refseq_id,
+                              sgrna_upstream=4,
+                              ref_genome=ref_genome,
+                              sgrna_downstream=7, sgrna_length=20,
+                              flank=30, filter_tttt=False,
+                              chrom_seq=chrom_seq)
+    sgrna_designer.get_sgrnas([pam])
+    if len(sgrna_designer.sgrnas) == 0:
+        return None
+    design_output = sgrna_designer.output()
+    # remove sgRNAs don't target coding region
+    return design_output[
+        design_output.cutting_site_type.isin(['coding_region'])]
+
+
+def score_library(design_output, off_target_tol='standard', pam='NGG',
+                  scorer=None, cache=None):
+    """Add off-target flags, RS2 and deep rank scores to designed sgRNAs
+
+    Args:
+        design_output: the output of design_coding_sgrnas, may contain many
+         transcripts
+        off_target_tol: ('high', 'standard', 'low', False), the seed length of
+         off-target search
+        pam: PAM
+        scorer: DeepRankScorer, the shared scorer is used if None
+        cache: ScoreCache, the shared cache (if any) is used if None
+
+    Returns:
+        DataFrame, with off_target_num (if off_target_tol), rs2_score and
+        deep_rank_score
+    """
+    design_output = design_output.copy()
     # get the tolerance of off-targets
-    if off_targets == 'high':
+    if off_target_tol == 'high':
         seed_len = 20
-    elif off_targets == 'standard':
+    elif off_target_tol == 'standard':
         seed_len = 16
-    elif off_targets == 'low':
+    elif off_target_tol == 'low':
         seed_len = 12
     else:
         seed_len = False
 
-    flag = True
-    for refseq_id in refseq_ids:
-        # design all possible sgRNAs
-        # TODO: peptide percent and GC content
-        sgrna_designer = Designer(refseq_id=refseq_id,
-                                  sgrna_upstream=4,
-                                  ref_genome=ref_genome,
-                                  sgrna_downstream=3, sgrna_length=20,
-                                  flank=30, filter_tttt=False)
-        sgrna_designer.get_sgrnas(pam)
-        design_output = sgrna_designer.output()
-
-        # remove sgRNAs don't target coding region
-        design_output = design_output[
-            design_output.cutting_site_type.isin(['coding_region'])]
-
-        # remove sgRNAs with off-targets
-        if seed_len:
-            sgrna_seqs = design_output.sgrna_seq.values
-            have_off_target = []
-            for seq in sgrna_seqs:
-                have_off_target.append(
-                    off_targets.have_off_targets(seq, pam,
-                                                 upstream_len=seed_len,
-                                                 num_mismatch=0))
-            design_output = design_output.loc[~have_off_target, :]
-
-        # score
-        score_seqs = design_output.sgrna_full_seq.values
-        deep_rank_score = []
-        # TODO: function: input: seq and feats, output: score
-
-        # Pick sgRNA
-        sub_design_output = pick_top_sgrna(design_output, sgrna_num)
-        if flag:
-            screen_library = sub_design_output
-            flag = False
+    # sgRNAs with off-targets are removed or ranked last by rank_sgrnas
+    if seed_len:
+        design_output.loc[:, 'off_target_num'] = np.array(
+            [off_targets.have_off_targets(seq, pam, upstream_len=seed_len,
+                                          num_mismatch=0)
+             for seq in design_output.sgrna_seq.values], dtype=int)
+
+    rs2_seqs = [seq[:30] for seq in design_output.sgrna_full_seq.values]
+    rs2_scorer = get_rs2_scorer()
+    design_output.loc[:, 'rs2_score'] = cached_scores(
+        cache, 'rs2', rs2_scorer.version, rs2_seqs,
+        lambda index: rs2_scorer.score([rs2_seqs[i] for i in index]))
+    design_output.loc[:, 'deep_rank_score'] = score_deep_rank(
+        design_output, scorer, cache)
+    return design_output
+
+
+def score_deep_rank(design_output, scorer=None, cache=None):
+    """Deep rank scores of designed sgRNAs, all sgRNAs are scored by one
+    restored model. sgRNAs without percent CDS or with a different length of
+    sgrna_full_seq get NaN.
+
+    Args:
+        design_output: the output of Designer
+        scorer: DeepRankScorer or NumpyDeepRankScorer, if None, the shared
+         NumPy scorer is used when DEEP_RANK_NPZ is set, otherwise the shared
+         TensorFlow scorer
+        cache: ScoreCache, the shared cache (if any) is used if None
+
+    Returns:
+        np.ndarray, deep rank scores
+    """
+    if scorer is None:
+        if deep_rank_numpy.DEEP_RANK_NPZ is not None:
+            scorer = deep_rank_numpy.get_numpy_deep_rank_scorer()
         else:
-            screen_library = screen_library.append(sub_design_output)
-    return screen_library
+            # TensorFlow is imported only when the TensorFlow scorer is used
+            import genome_editing.score_sgrna.deep_rank as deep_rank
+
+            scorer = deep_rank.get_deep_rank_scorer()
+    seqs = design_output.sgrna_full_seq.values
+    pcds = design_output.percent_cds.astype(np.float64).values
+    valid = ~np.isnan(pcds) & \
+        np.array([len(x) == scorer.seq_len for x in seqs], dtype=bool)
+    scores = np.full(design_output.shape[0], np.nan)
+    if valid.any():
+        valid_seqs = seqs[valid]
+        valid_pcds = pcds[valid]
+        scores[valid] = cached_scores(
+            cache, 'deep_rank', scorer.version, valid_seqs,
+            lambda index: scorer.predict(valid_seqs[index], valid_pcds[index]),
+            extras=valid_pcds)
+    return scores
+
+
+def rank_sgrnas(design_output, score_col='deep_rank_score',
+                group_col='refseq_id', gc_range=(0.2, 0.8), max_off_targets=0):
+    """Rank sgRNAs of each group by a composite key, the whole table is
+    sorted at once. sgRNAs with more than max_off_targets off-targets are
+    removed first, then in each group, sgRNAs are ordered by
+
+        1. the number of failed filters (TTTT, GC content out of gc_range)
+        2. off_target_num, if the column exists
+        3. score_col, descending, NaN last
+        4. percent_cds, ascending, NaN last
 
+    Args:
+        design_output: the output of Designer, may contain many genes
+        score_col: the on-target score
+        group_col: sgRNAs are ranked within each group
+        gc_range: the range of GC content passing the filter
+        max_off_targets: the max off_target_num kept, None keeps all sgRNAs
+         and ranks those with off-targets last
 
-def pick_top_sgrna(design_output, sgrna_num):
-    return design_output.iloc[:sgrna_num]
+    Returns:
+        DataFrame, sorted by group and rank, with columns filter_num and rank
+        (0-based in each group)
+    """
+    if (max_off_targets is not None) and \
+            ('off_target_num' in design_output.columns):
+        design_output = design_output[
+            design_output.off_target_num.values <= max_off_targets]
+    if design_output.shape[0] == 0:
+        out = design_output.copy()
+        out.loc[:, 'filter_num'] = []
+        out.loc[:, 'rank'] = []
+        return out
+    spacers = design_output.sgrna_seq.values
+    gc = gc_content(spacers)
+    filter_num = has_homopolymer(spacers, 'T', 4).astype(int) + \
+        ((gc < gc_range[0]) | (gc > gc_range[1])).astype(int)
+    if 'off_target_num' in design_output.columns:
+        off_target_num = design_output.off_target_num.values.astype(
+            np.float64)
+    else:
+        off_target_num = np.zeros(design_output.shape[0])
+    scores = -design_output.loc[:, score_col].values.astype(np.float64)
+    scores[np.isnan(scores)] = np.inf
+    pcds = design_output.percent_cds.values.astype(np.float64)
+    pcds[np.isnan(pcds)] = np.inf
+    group_codes = pd.factorize(design_output.loc[:, group_col])[0]
+
+    # the last key is the primary key
+    order = np.lexsort((pcds, scores, off_target_num, filter_num,
+                        group_codes))
+    sorted_codes = group_codes[order]
+    positions = np.arange(len(order))
+    is_first = np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1]))
+    group_starts = np.maximum.accumulate(np.where(is_first, positions, 0))
+
+    out = design_output.iloc[order].copy()
+    out.loc[:, 'filter_num'] = filter_num[order]
+    out.loc[:, 'rank'] = positions - group_starts
+    out.index = range(out.shape[0])
+    return out
+
+
+def pick_top_sgrna(design_output, sgrna_num, score_col='deep_rank_score',
+                   group_col='refseq_id', gc_range=(0.2, 0.8),
+                   max_off_targets=0):
+    """Pick the top sgrna_num sgRNAs of each group, see rank_sgrnas"""
+    ranked = rank_sgrnas(design_output, score_col=score_col,
+                         group_col=group_col, gc_range=gc_range,
+                         max_off_targets=max_off_targets)
+    out = ranked[ranked.loc[:, 'rank'].values < sgrna_num]
+    out.index = range(out.shape[0])
+    return out
 
 
 def design_sgrna_with_offtargets(refseq_id, ref_genome='hg19', pam='NGG',
@@ -4,11 +4,8 @@ import numpy as np
 import pandas as pd
 import regex
 import sqlalchemy
-from Bio.Alphabet import IUPAC
-from Bio.Seq import Seq
 
 from genome_editing.score_sgrna.rs2 import compute_rs2
-import genome_editing.score_sgrna.deep_rank as deep_rank
 import genome_editing.score_sgrna.off_targets as off_targets
 from genome_editing.score_sgrna.off_targets import sgrna_off_targets
 from ..utils import alignment
@@ -195,7 +192,7 @@ class Designer:
         Returns:
             str, the reverse complement of input sequence
         """
-        return str(Seq(sgrna_seq).reverse_complement())
+        return util.reverse_complement(sgrna_seq)
 
     def get_cds_info(self):
         """Compute peptide percentage of cutting site"""
@@ -563,6 +560,9 @@ class Gene:
                    cds_start_exon_index:(cds_end_exon_index + 1)].copy()
         cds_starts[0] = cds_start
         cds_ends[-1] = cds_end
+        from Bio.Alphabet import IUPAC
+        from Bio.Seq import Seq
+
         table_name = 'igenome_ucsc_{}_{}'.format(self.ref_genome, self.chrom)
         chrom_seq = pd.read_sql(table_name, self.engine).iloc[0, 0]
         seq = ''
@@ -782,7 +782,7 @@ class SgRNA:
         Returns:
             str, the reverse complement of input sequence
         """
-        return str(Seq(self.sequence).reverse_complement())
+        return util.reverse_complement(self.sequence)
 
     # def print(self):
     #     """Print the SgRNA object
@@ -0,0 +1,271 @@
+"""Build genome-wide screen libraries in parallel
+
+Transcripts are grouped by chromosome and the groups are split into chunks
+of transcripts, the tasks of a process pool. A worker keeps the sequence of
+the last chromosome it queried, and the chunks of a chromosome are queued
+together, so each worker queries a chromosome about once. The top sgRNAs of
+each transcript are written to their own file as soon as they are ready, or
+an empty marker file if there is none; transcripts with a file are skipped
+when a build is resumed.
+"""
+import multiprocessing
+import os
+import time
+import pandas as pd
+import sqlalchemy
+
+from genome_editing.design_sgRNA.design import GENOME_EDITING_URI
+from genome_editing.design_sgRNA.design import design_coding_sgrnas
+from genome_editing.design_sgRNA.design import get_chrom_seq
+from genome_editing.design_sgRNA.design import pick_top_sgrna
+from genome_editing.design_sgRNA.design import score_library
+from genome_editing.utils.parallel import limit_threads
+from genome_editing.utils.parquet_io import ParquetTableWriter
+from genome_editing.utils.utilities import resolve_genes
+
+GENE_DIR = 'genes'
+EMPTY_SUFFIX = '.empty'
+# transcripts per task
+CHUNK_SIZE = 100
+
+
+def group_by_chrom(inputs, ref_genome='hg38', mode='gene_symbol',
+                   engine=None):
+    """Find the transcripts of input genes and group them by chromosome
+
+    Args:
+        inputs: list of gene symbols or refseq IDs
+        ref_genome: reference genome
+        mode: ('gene_symbol', 'refseq_id')
+        engine: sqlalchemy engine, created from GENOME_EDITING_URI if None
+
+    Returns:
+        dict, chromosome: list of refseq IDs, and list of unresolved inputs
+    """
+    assert mode in ('gene_symbol', 'refseq_id'), 'Wrong mode'
+    if engine is None:
+        engine = sqlalchemy.create_engine(GENOME_EDITING_URI)
+    table_name = 'igenome_ucsc_{}_refgene'.format(ref_genome)
+    column = 'name2' if mode == 'gene_symbol' else 'name'
+    transcripts, unresolved = resolve_genes(inputs, table_name, column,
+                                            engine=engine)
+    # as Transcript, the first record of a refseq ID is used
+    transcripts = transcripts.drop_duplicates(subset='refseq_id')
+    groups = {}
+    for chrom, refseq_id in zip(transcripts.chrom.values,
+                                transcripts.refseq_id.values):
+        groups.setdefault(chrom, []).append(refseq_id)
+    return groups, unresolved
+
+
+def gene_output_path(out_dir, refseq_id):
+    return os.path.join(out_dir, GENE_DIR, '{}.csv'.format(refseq_id))
+
+
+def empty_output_path(out_dir, refseq_id):
+    return os.path.join(out_dir, GENE_DIR, refseq_id + EMPTY_SUFFIX)
+
+
+def finished_transcripts(out_dir):
+    """The refseq IDs with output or an empty marker in out_dir"""
+    gene_dir = os.path.join(out_dir, GENE_DIR)
+    if not os.path.exists(gene_dir):
+        return set()
+    finished = set()
+    for name in os.listdir(gene_dir):
+        for suffix in ('.csv', EMPTY_SUFFIX):
+            if name.endswith(suffix):
+                finished.add(name[:-len(suffix)])
+    return finished
+
+
+def write_gene_output(out_dir, refseq_id, library):
+    """Write the sgRNAs of a transcript, the file appears only when it is
+    complete, a transcript without sgRNA gets an empty marker file"""
+    if library.shape[0] == 0:
+        open(empty_output_path(out_dir, refseq_id), 'w').close()
+        return
+    out_path = gene_output_path(out_dir, refseq_id)
+    temp_path = out_path + '.tmp'
+    library.to_csv(temp_path, index=False)
+    os.replace(temp_path, out_path)
+
+
+def split_chunks(groups, finished=(), chunk_size=CHUNK_SIZE):
+    """Split the unfinished transcripts of each chromosome into chunks
+
+    Args:
+        groups: dict, chromosome: list of refseq IDs
+        finished: the refseq IDs to skip
+        chunk_size: the max number of transcripts of a chunk
+
+    Returns:
+        list of (chromosome, list of refseq IDs), the full chunks first and
+        the chunks of a chromosome together
+    """
+    chunks = []
+    for chrom in groups:
+        todo = [x for x in groups[chrom] if x not in finished]
+        for start in range(0, len(todo), chunk_size):
+            chunks.append((chrom, todo[start:(start + chunk_size)]))
+    # stable, so the full chunks of a chromosome stay together
+    chunks.sort(key=lambda x: len(x[1]), reverse=True)
+    return chunks
+
+
+# the sequence of the last chromosome queried by the worker
+_chrom_seq = {}
+
+
+def load_chrom_seq(ref_genome, chrom):
+    """The sequence of a chromosome, only the last one is kept in memory"""
+    if (ref_genome, chrom) not in _chrom_seq:
+        _chrom_seq.clear()
+        _chrom_seq[(ref_genome, chrom)] = get_chrom_seq(ref_genome, chrom)
+    return _chrom_seq[(ref_genome, chrom)]
+
+
+def _build_chunk(args):
+    """Design, score and pick sgRNAs of a chunk of transcripts on a
+    chromosome"""
+    (chrom, refseq_ids, ref_genome, out_dir, sgrna_num, pam, off_target_tol,
+     score_col, gc_range) = args
+    chrom_seq = load_chrom_seq(ref_genome, chrom)
+    failed = []
+    for refseq_id in refseq_ids:
+        try:
+            design_output = design_coding_sgrnas(refseq_id, ref_genome, pam,
+                                                 chrom_seq=chrom_seq)
+            if design_output is None or design_output.shape[0] == 0:
+                library = pd.DataFrame()
+            else:
+                design_output = score_library(design_output,
+                                              off_target_tol=off_target_tol,
+                                              pam=pam)
+                library = pick_top_sgrna(design_output, sgrna_num,
+                                         score_col=score_col,
+                                         gc_range=gc_range)
+        except Exception as e:
+            print('Fail to design {}: {}'.format(refseq_id, e))
+            failed.append(refseq_id)
+            continue
+        write_gene_output(out_dir, refseq_id, library)
+    return chrom, len(refseq_ids) - len(failed), failed
+
+
+def merge_library(out_dir, refseq_ids=None):
+    """Read the outputs of transcripts into one DataFrame
+
+    Args:
+        out_dir: the output directory of build_library
+        refseq_ids: the transcripts to read, all finished ones if None
+
+    Returns:
+        DataFrame
+    """
+    if refseq_ids is None:
+        refseq_ids = sorted(finished_transcripts(out_dir))
+    libraries = []
+    for refseq_id in refseq_ids:
+        out_path = gene_output_path(out_dir, refseq_id)
+        if os.path.exists(out_path):
+            libraries.append(pd.read_csv(out_path))
+    if len(libraries) == 0:
+        return pd.DataFrame()
+    return pd.concat(libraries, ignore_index=True)
+
+
+def export_parquet(out_dir, parquet_path, refseq_ids=None):
+    """Stream the outputs of transcripts into one Parquet file, the
+    transcripts are written in the input order, e.g. grouped by chromosome
+
+    Args:
+        out_dir: the output directory of build_library
+        parquet_path: the path of the Parquet file
+        refseq_ids: the transcripts to write, all finished ones if None
+
+    Returns:
+        int, the number of sgRNAs written
+    """
+    if refseq_ids is None:
+        refseq_ids = sorted(finished_transcripts(out_dir))
+    with ParquetTableWriter(parquet_path) as writer:
+        for refseq_id in refseq_ids:
+            out_path = gene_output_path(out_dir, refseq_id)
+            if os.path.exists(out_path):
+                writer.write(pd.read_csv(out_path))
+    return writer.row_num
+
+
+def build_library(inputs, out_dir, sgrna_num=3, ref_genome='hg38',
+                  mode='gene_symbol', off_target_tol='standard', pam='NGG',
+                  score_col='deep_rank_score', gc_range=(0.2, 0.8),
+                  processes=None, threads_per_process=1, resume=True,
+                  parquet_path=None, chunk_size=CHUNK_SIZE):
+    """Build screen library in parallel, same output as
+    design.build_screen_library
+
+    Args:
+        inputs: list of gene symbols or refseq IDs
+        out_dir: the output directory, the sgRNAs of each transcript are
+         written into out_dir/genes/<refseq_id>.csv, or
+         out_dir/genes/<refseq_id>.empty if there is none
+        sgrna_num: the number of sgRNAs of each transcript
+        ref_genome: reference genome
+        mode: ('gene_symbol', 'refseq_id')
+        off_target_tol: ('high', 'standard', 'low', False)
+        pam: PAM
+        score_col: the on-target score used to rank sgRNAs
+        gc_range: the range of GC content passing the filter
+        processes: the number of worker processes, the number of CPUs if None
+        threads_per_process: the max number of CPU threads of each worker
+        resume: whether skip transcripts finished by a previous run
+        parquet_path: if not None, the library is also written into a Parquet
+         file grouped by chromosome
+        chunk_size: the max number of transcripts of a task
+
+    Returns:
+        DataFrame, the top sgRNAs of each transcript
+    """
+    assert off_target_tol in ('high', 'standard', 'low', False), \
+        'Wrong rm_off_target'
+    assert pam == 'NGG', 'Wrong PAM'
+    gene_dir = os.path.join(out_dir, GENE_DIR)
+    if not os.path.exists(gene_dir):
+        os.makedirs(gene_dir)
+
+    groups, unresolved = group_by_chrom(inputs, ref_genome, mode)
+    if len(unresolved) > 0:
+        print('{} inputs not found: {}'.format(len(unresolved),
+                                                ', '.join(unresolved)))
+    refseq_ids = [x for chrom in groups for x in groups[chrom]]
+    finished = finished_transcripts(out_dir) if resume else set()
+    tasks = [(chrom, chunk, ref_genome, out_dir, sgrna_num, pam,
+              off_target_tol, score_col, gc_range)
+             for chrom, chunk in split_chunks(groups, finished, chunk_size)]
+    total_num = sum(len(x[1]) for x in tasks)
+    print('{} transcripts on {} chromosomes, {} finished before, {} '
+          'tasks'.format(len(refseq_ids), len(groups),
+                         len(refseq_ids) - total_num, len(tasks)))
+
+    # TensorFlow and sqlalchemy engines are not fork-safe
+    context = multiprocessing.get_context('spawn')
+    start_time = time.time()
+    done_num = 0
+    failed = []
+    with limit_threads(threads_per_process), \
+            context.Pool(processes) as pool:
+        for chrom, gene_num, chunk_failed in pool.imap_unordered(
+                _build_chunk, tasks):
+            done_num += gene_num
+            failed += chunk_failed
+            elapsed = time.time() - start_time
+            print('Finish a chunk of {}: {} / {} transcripts, {:.2f} '
+                  'genes/s'.format(chrom, done_num, total_num,
+                                   done_num / elapsed))
+    if len(failed) > 0:
+        print('{} transcripts failed, rerun to retry: {}'.format(
+            len(failed), ', '.join(failed)))
+    if parquet_path is not None:
+        export_parquet(out_dir, parquet_path, refseq_ids)
+    return merge_library(out_dir, refseq_ids)
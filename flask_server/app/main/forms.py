@@ -1,7 +1,9 @@
 from flask_wtf import Form
 from wtforms import StringField, SubmitField, IntegerField, SelectField, \
     TextAreaField
-from wtforms.validators import DataRequired
+from wtforms.validators import DataRequired, NumberRange
+from genome_editing.design_sgRNA.design import MAX_DOWNSTREAM, MAX_FLANK, \
+    MAX_SGRNA_LENGTH, MAX_UPSTREAM
 
 
 class DesignSgrnaBase(Form):
@@ -32,19 +34,28 @@ class DesignSingleSgrnaForm(DesignSgrnaBase):
                                  validators=[DataRequired()])
     pam_seq = StringField('PAM Sequence', default='NGG',
                           validators=[DataRequired()])
+    # the maxima of the design cache
     upstream_len = IntegerField('Upstream Length', default=4,
                                 render_kw={'min': '0', 'step': '1',
-                                           'type': 'number'})
+                                           'max': str(MAX_UPSTREAM),
+                                           'type': 'number'},
+                                validators=[NumberRange(0, MAX_UPSTREAM)])
     downstream_len = IntegerField('Downstream Length', default=3,
                                   render_kw={'min': '0', 'step': '1',
-                                             'type': 'number'})
+                                             'max': str(MAX_DOWNSTREAM),
+                                             'type': 'number'},
+                                  validators=[NumberRange(0, MAX_DOWNSTREAM)])
     sgrna_len = IntegerField('sgRNA Length', default=20,
                              render_kw={'min': '1', 'step': '1',
+                                        'max': str(MAX_SGRNA_LENGTH),
                                         'type': 'number'},
-                             validators=[DataRequired()])
+                             validators=[DataRequired(),
+                                         NumberRange(1, MAX_SGRNA_LENGTH)])
     flank_len = IntegerField('Flank Length', default=30,
                              render_kw={'min': '0', 'step': '1',
-                                        'type': 'number'})
+                                        'max': str(MAX_FLANK),
+                                        'type': 'number'},
+                             validators=[NumberRange(0, MAX_FLANK)])
     filter_tttt = SelectField('Filter TTTT?',
                               choices=[('Yes', 'Yes'), ('No', 'No')])
 
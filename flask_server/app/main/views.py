@@ -49,31 +49,31 @@ def design_sgrna_single_mode():
         pam = form.pam_seq.data
         pam_rc = reverse_complement(pam)
         ref_genome = form.ref_genome.data
+        filter_tttt = form.filter_tttt.data == 'Yes'
 
         if input_type == 'Gene Symbol':
             gene_symbols = design_inputs.split('\n')
             gene_symbols = [x.strip() for x in gene_symbols]
             assert len(gene_symbols) == 1, "Too many inputs"
             gene_symbol = gene_symbols[0]
-            sgrna_design = dsr.Designer(gene_symbol=gene_symbol,
-                                        sgrna_upstream=upstream_len,
-                                        sgrna_downstream=downstream_len,
-                                        flank=flank_len,
-                                        sgrna_length=sgrna_len)
-            sgrna_design.get_sgrnas(pams=[pam])
-            sgrna_designer_out = sgrna_design.output()
+            # parameter changes are derived from the cached superset scan
+            sgrna_designer_out = dsr.get_design_cache().design(
+                pam, ref_genome, gene_symbol=gene_symbol,
+                sgrna_upstream=upstream_len,
+                sgrna_downstream=downstream_len,
+                sgrna_length=sgrna_len, flank=flank_len,
+                filter_tttt=filter_tttt)
         elif input_type == 'Refseq ID':
             refseq_ids = design_inputs.split('\n')
             refseq_ids = [x.strip() for x in refseq_ids]
             assert len(refseq_ids) == 1, "Too many inputs"
             refseq_id = refseq_ids[0]
-            sgrna_design = dsr.Designer(refseq_id=refseq_id,
-                                        sgrna_upstream=upstream_len,
-                                        sgrna_downstream=downstream_len,
-                                        flank=flank_len,
-                                        sgrna_length=sgrna_len)
-            sgrna_design.get_sgrnas(pams=[pam])
-            sgrna_designer_out = sgrna_design.output()
+            sgrna_designer_out = dsr.get_design_cache().design(
+                pam, ref_genome, refseq_id=refseq_id,
+                sgrna_upstream=upstream_len,
+                sgrna_downstream=downstream_len,
+                sgrna_length=sgrna_len, flank=flank_len,
+                filter_tttt=filter_tttt)
         else:
             seq = design_inputs.split('\n')
             assert len(seq) == 1, "Too many inputs"
@@ -144,7 +144,19 @@ def score_sgrna():
     if form.validate_on_submit():
         JOB_ID += 1
         seqs = [x.strip() for x in form.seqs.data.split('\n')]
-        score_sgrna_out = compute_rs2_batch(seqs)
+        if form.score_algo.data == 'Deep Rank':
+            # deep rank may import TensorFlow, only load it when requested
+            from genome_editing.score_sgrna.deep_rank import \
+                compute_deep_rank_batch
+
+            # each line is a sequence, optionally followed by percent peptide
+            records = [x.split(',') for x in seqs if x != '']
+            seqs = [x[0].strip() for x in records]
+            percent_peptide = [float(x[1]) if len(x) > 1 else 0.5
+                               for x in records]
+            score_sgrna_out = compute_deep_rank_batch(seqs, percent_peptide)
+        else:
+            score_sgrna_out = compute_rs2_batch(seqs)
         output_path = './results/score_sgrna_output_' + str(JOB_ID) + '.csv'
         score_sgrna_out.to_csv(output_path, index=None)
         return render_template('score_sgrna_output.html', job_id=JOB_ID)
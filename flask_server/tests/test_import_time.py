@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# seconds, pandas and sqlalchemy take most of it
+IMPORT_BUDGET = 1.0
+
+SCRIPT = '''
+import sys
+import time
+start = time.time()
+import genome_editing.design_sgRNA.design
+print(time.time() - start)
+print('tensorflow' in sys.modules)
+print('Bio' in sys.modules)
+'''
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def test_design_import(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(x for x in sys.path if x)
+        out = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                      env=env, universal_newlines=True)
+        elapsed, has_tf, has_bio = out.split()
+        self.assertEqual(has_tf, 'False')
+        self.assertEqual(has_bio, 'False')
+        self.assertLess(float(elapsed), IMPORT_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import unittest
+import numpy as np
+
+from genome_editing.score_sgrna import rs2
+
+# features and scores of real Azimuth 2.0 (model_comparison.predict with
+# the V3 models), see the docstring of load_azimuth
+AZIMUTH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'azimuth_rs2.npz')
+
+# 30mers of the Azimuth README
+SEQS = ['ACAGCTGATCTCCAGATATGACCATGGGTT',
+        'CAGCTGATCTCCAGATATGACCATGGGTTT',
+        'CCAGAAGTTTGAGCCACAAACCCATGGTCA']
+
+# Allawi and SantaLucia (1997), as Tm_staluc of Biopython
+NN = {'AA': (7.9, 22.2), 'TT': (7.9, 22.2), 'AT': (7.2, 20.4),
+      'TA': (7.2, 21.3), 'CA': (8.5, 22.7), 'TG': (8.5, 22.7),
+      'GT': (8.4, 22.4), 'AC': (8.4, 22.4), 'CT': (7.8, 21.0),
+      'AG': (7.8, 21.0), 'GA': (8.2, 22.2), 'TC': (8.2, 22.2),
+      'CG': (10.6, 27.2), 'GC': (9.8, 24.4), 'GG': (8.0, 19.9),
+      'CC': (8.0, 19.9)}
+
+
+def tm_staluc(s, dnac=50, saltc=50):
+    """DNA/DNA Tm_staluc of Biopython, one sequence at a time"""
+    dh = 0
+    ds = 0
+    for end in (s[0], s[-1]):
+        if end in 'GC':
+            dh -= 0.1
+            ds += 2.8
+        elif end in 'AT':
+            dh -= 2.3
+            ds -= 4.1
+    for i in range(len(s) - 1):
+        dh += NN[s[i:(i + 2)]][0]
+        ds += NN[s[i:(i + 2)]][1]
+    k = (dnac / 4.0) * 1e-9
+    ds -= 0.368 * (len(s) - 1) * np.log(saltc / 1e3)
+    return (1000 * (-dh)) / (-ds + 1.987 * np.log(k)) - 273.15
+
+
+def load_azimuth():
+    """30mers, aa_cut, percent_peptide, and the features and scores of the
+    nopos and full models, exported from Azimuth 2.0 under Python 2.7 with
+    featurize_data and concatenate_feature_sets: the 3 README 30mers and 17
+    random 30mers with GG at 25:27"""
+    data = dict(np.load(AZIMUTH_PATH))
+    data['seqs'] = [x.decode('ascii') for x in data['seqs']]
+    return data
+
+
+def _biopython_tm():
+    """Tm_staluc of Biopython, or Tm_NN with its default values, which gives
+    the same result in newer versions"""
+    try:
+        from Bio.SeqUtils import MeltingTemp
+    except ImportError:
+        return None
+    if hasattr(MeltingTemp, 'Tm_staluc'):
+        return lambda x: MeltingTemp.Tm_staluc(x, rna=False)
+    return MeltingTemp.Tm_NN
+
+
+class RS2FeatureTestCase(unittest.TestCase):
+    def test_melting_temperature(self):
+        codes = rs2.encode_30mers(SEQS)
+        for start, end in ((0, 30), (19, 24), (11, 19), (6, 11)):
+            tm = rs2.melting_temperature(codes[:, start:end])
+            expected = [tm_staluc(x[start:end]) for x in SEQS]
+            self.assertTrue(np.allclose(tm, expected))
+
+    @unittest.skipUnless(_biopython_tm(), 'Biopython')
+    def test_melting_temperature_biopython(self):
+        tm_biopython = _biopython_tm()
+        codes = rs2.encode_30mers(SEQS)
+        for start, end in ((0, 30), (19, 24), (11, 19), (6, 11)):
+            tm = rs2.melting_temperature(codes[:, start:end])
+            expected = [tm_biopython(x[start:end]) for x in SEQS]
+            self.assertTrue(np.allclose(tm, expected))
+
+    def test_featurize(self):
+        azimuth = load_azimuth()
+        features = rs2.featurize(azimuth['seqs'])
+        self.assertEqual(features.shape, azimuth['features_nopos'].shape)
+        self.assertTrue(np.allclose(features, azimuth['features_nopos']))
+
+    def test_featurize_position(self):
+        azimuth = load_azimuth()
+        features = rs2.featurize(azimuth['seqs'], azimuth['aa_cut'],
+                                 azimuth['percent_peptide'])
+        self.assertEqual(features.shape, azimuth['features_full'].shape)
+        self.assertTrue(np.allclose(features, azimuth['features_full']))
+
+    @unittest.skipUnless(rs2.RS2_MODEL_DIR, 'RS2_MODEL_DIR')
+    def test_score(self):
+        azimuth = load_azimuth()
+        scorer = rs2.RS2Scorer()
+        self.assertTrue(np.allclose(scorer.score(azimuth['seqs']),
+                                    azimuth['scores_nopos']))
+        self.assertTrue(np.allclose(
+            scorer.score(azimuth['seqs'], azimuth['aa_cut'],
+                         azimuth['percent_peptide']),
+            azimuth['scores_full']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Leave-one-gene-out cross validation of deep rank
+
+The test sets of all genes are built from the gene codes of a
+DeepRankDataset in one pass, and the folds are trained and evaluated in a
+process pool. Each worker builds the train mask of its fold and holds out a
+random set of the other genes for early stopping. The
+thread limit is set before the workers are spawned, and each TensorFlow
+session is capped too, so the pool does not oversubscribe the node.
+"""
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+
+from genome_editing.score_sgrna.deep_rank_dataset import DeepRankDataset
+from genome_editing.utils.parallel import limit_threads
+
+
+VALID_RATIO = 0.1
+
+
+def gene_splits(gene_codes):
+    """Build the test sets of the leave-one-gene-out splits of all genes
+
+    Args:
+        gene_codes: array of the gene code of each sgRNA
+
+    Returns:
+        list of (gene code, test index), the indices are positions in
+        gene_codes, the train sets are built by the workers
+    """
+    gene_codes = np.asarray(gene_codes)
+    order = np.argsort(gene_codes, kind='mergesort')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(gene_codes))))
+    return [(i, order[bounds[i]:bounds[i + 1]])
+            for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def fold_masks(gene_codes, code, valid_ratio=VALID_RATIO, seed=0):
+    """The train and validation masks of the fold of a held-out gene
+
+    Args:
+        gene_codes: array of the gene code of each sgRNA
+        code: the code of the held-out gene
+        valid_ratio: the ratio of the other genes held out for early stopping
+        seed: the random seed, the validation genes of a fold are seeded by
+         (seed, code)
+
+    Returns:
+        np.ndarray of bool of train and validation
+    """
+    others = np.setdiff1d(np.unique(gene_codes), [code])
+    valid_num = int(round(len(others) * valid_ratio))
+    rng = np.random.RandomState([seed, code])
+    valid_codes = rng.choice(others, valid_num, replace=False)
+    valid_mask = np.isin(gene_codes, valid_codes)
+    train_mask = ~valid_mask & (gene_codes != code)
+    return train_mask, valid_mask
+
+
+_fold = {}
+
+
+def _init_fold(dataset_path, index, model_dir, num_threads, valid_ratio,
+               seed, train_params):
+    _fold['dataset'] = DeepRankDataset(dataset_path, index)
+    _fold['gene_codes'] = np.asarray(_fold['dataset'].get_gene_codes())
+    _fold['model_dir'] = model_dir
+    _fold['num_threads'] = num_threads
+    _fold['valid_ratio'] = valid_ratio
+    _fold['seed'] = seed
+    _fold['train_params'] = train_params
+
+
+def _run_fold(args):
+    """Train on all genes but one and evaluate on the held-out gene"""
+    import genome_editing.score_sgrna.deep_rank as deep_rank
+
+    code, test_index = args
+    dataset = _fold['dataset']
+    model_dir = _fold['model_dir']
+    num_threads = _fold['num_threads']
+    gene = dataset.gene_names[code]
+    train_mask, valid_mask = fold_masks(_fold['gene_codes'], code,
+                                        _fold['valid_ratio'], _fold['seed'])
+    train_data = dataset.subset(np.flatnonzero(train_mask))
+    valid_data = dataset.subset(np.flatnonzero(valid_mask)) \
+        if valid_mask.any() else None
+    test_data = dataset.subset(test_index)
+
+    model_save_path = os.path.join(model_dir, '{}.ckpt'.format(gene))
+    deep_rank.deep_rank(train_data, valid_x=valid_data,
+                        model_save_path=model_save_path,
+                        log_dir=os.path.join(model_dir, 'log', str(gene)),
+                        num_threads=num_threads, **_fold['train_params'])
+
+    pearson = spearman = np.nan
+    if os.path.exists(model_save_path) or \
+            os.path.exists(model_save_path + '.index'):
+        with deep_rank.DeepRankScorer(
+                model_save_path, seq_len=dataset.seq_shape[1],
+                dnn_input_len=dataset.feat_len,
+                num_threads=num_threads) as scorer:
+            y_pred, y_true = scorer.predict_dataset(test_data)
+        if len(y_true) > 2:
+            pearson, spearman = deep_rank.evaluate(y_true, y_pred)
+    else:
+        print('No model saved for {}'.format(gene))
+    return [gene, len(train_data), int(valid_mask.sum()), len(test_data),
+            pearson, spearman, model_save_path]
+
+
+def cross_validate_by_gene(dataset, model_dir, genes=None, processes=None,
+                           threads_per_process=1, valid_ratio=VALID_RATIO,
+                           seed=0, **train_params):
+    """Leave-one-gene-out cross validation of deep rank
+
+    Args:
+        dataset: DeepRankDataset with genes
+        model_dir: the directory of the checkpoints of folds
+        genes: the held-out genes, all genes if None
+        processes: the number of worker processes, the number of CPUs if None
+        threads_per_process: the max number of CPU threads of each worker
+        valid_ratio: the ratio of the other genes of each fold held out for
+         early stopping, 0 stops on the training loss
+        seed: the random seed of the validation genes
+        train_params: passed to deep_rank.deep_rank, e.g. max_epoch
+
+    Returns:
+        DataFrame, one row per fold with pearson and spearman of the
+        held-out gene
+    """
+    assert 0 <= valid_ratio < 1, 'Wrong valid_ratio'
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    tasks = gene_splits(dataset.get_gene_codes())
+    if genes is not None:
+        genes = set(genes)
+        tasks = [x for x in tasks if dataset.gene_names[x[0]] in genes]
+
+    # TensorFlow is not fork-safe, workers are started fresh, and the dataset
+    # is sent once per worker instead of once per fold
+    context = multiprocessing.get_context('spawn')
+    with limit_threads(threads_per_process), \
+            context.Pool(processes, initializer=_init_fold,
+                         initargs=(dataset.path, dataset.index, model_dir,
+                                   threads_per_process, valid_ratio, seed,
+                                   train_params)) as pool:
+        results = []
+        for i, result in enumerate(pool.imap_unordered(_run_fold, tasks)):
+            results.append(result)
+            print('Finish {} / {} folds: {}'.format(i + 1, len(tasks),
+                                                    result[0]))
+
+    report = pd.DataFrame(results)
+    report.columns = ['gene', 'train_num', 'valid_num', 'test_num',
+                      'pearson', 'spearman', 'model_save_path']
+    report = report.sort_values(by='gene')
+    report.index = range(report.shape[0])
+    print('pearson: mean {:.4f}, median {:.4f}; spearman: mean {:.4f}, '
+          'median {:.4f}'.format(report.pearson.mean(),
+                                 report.pearson.median(),
+                                 report.spearman.mean(),
+                                 report.spearman.median()))
+    return report
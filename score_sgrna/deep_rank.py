@@ -5,32 +5,42 @@ Now we only use sequence as input, we could consider GC content, position on
 the protein, structure etc.
 """
 
+import os
 import numpy as np
+import pandas as pd
 import scipy.stats
 import tensorflow as tf
 
+from genome_editing.utils.sequence import gc_content, one_hot_encode
+from genome_editing.score_sgrna.deep_rank_dataset import DeepRankDataset
+from genome_editing.score_sgrna.score_cache import cached_scores
+from genome_editing.score_sgrna.score_cache import checkpoint_files
+from genome_editing.score_sgrna.score_cache import file_version
+from genome_editing.score_sgrna.deep_rank_numpy import SEQ_LEN, \
+    SPACER_START, SPACER_LEN, WEIGHT_NAMES, DEEP_RANK_NPZ, \
+    NumpyDeepRankScorer, get_numpy_deep_rank_scorer
+
+DEEP_RANK_MODEL = os.getenv('DEEP_RANK_MODEL')
+
 
 # Input
 def generate_input(seqs, feats, score):
-    dataset = []
-    for i, seq in enumerate(seqs):
-        encoding_seq = one_hot_encoding(seq)
-        dataset.append([encoding_seq, [x[i] for x in feats], score[i]])
-    return np.array(dataset)
+    encoding_seqs = one_hot_encode(seqs, alphabet='ATCG', dtype=np.float32)
+    dataset = np.empty((len(seqs), 3), dtype=object)
+    for i in range(len(seqs)):
+        dataset[i, 0] = encoding_seqs[i]
+        dataset[i, 1] = [x[i] for x in feats]
+        dataset[i, 2] = score[i]
+    return dataset
 
 
 def one_hot_encoding(seq):
-    encoding_dict = {'A': 0, 'T': 1, 'C': 2, 'G': 3, 'N': -1}
-    seq = seq.upper()
-    encoding_mat = np.zeros(shape=(4, len(seq)))
-    for i, bp in enumerate(seq):
-        if bp == 'N':
-            continue
-        encoding_mat[encoding_dict[bp]][i] = 1
-    return encoding_mat
+    return one_hot_encode([seq], alphabet='ATCG', dtype=np.float32)[0]
 
 
 def split_data_by_gene(dataset, test_gene):
+    if isinstance(dataset, DeepRankDataset):
+        return dataset.split_by_gene(test_gene)
     train_data = []
     test_data = []
     for record in dataset:
@@ -45,6 +55,8 @@ def split_data_by_gene(dataset, test_gene):
 
 def split_data_random(dataset, train_ratio=0.6, valid_ratio=0.2,
                       test_ratio=0.2):
+    if isinstance(dataset, DeepRankDataset):
+        return dataset.split_random(train_ratio, valid_ratio, test_ratio)
     assert train_ratio + valid_ratio + test_ratio == 1, 'Wrong ratio'
     total_num = dataset.shape[0]
     train_num = int(total_num * train_ratio)
@@ -68,6 +80,16 @@ def permute(x, y):
     return [x[0][permute_index], x[1][permute_index]], y[permute_index]
 
 
+def iterate_batches(x, y, batch_size):
+    """Permute in-memory data and iterate batches of cnn input, dnn input and
+    responses"""
+    x, y = permute(x, y)
+    batch_num = int(y.shape[0] / batch_size)
+    for i in range(batch_num):
+        batch = slice(i * batch_size, (i + 1) * batch_size)
+        yield x[0][batch], x[1][batch], y[batch]
+
+
 def get_gc_content(seq):
     return (seq.count('C') + seq.count('G')) / len(seq)
 
@@ -85,7 +107,7 @@ def transform(input_data, seq_len):
 def generate_ms_input(ms_data):
     seqs = ms_data.loc[:, 'sgrna_34mer'].values
     pp = ms_data.loc[:, 'Percent Peptide'].values / 100
-    gc = [get_gc_content(x[4:-10]) for x in seqs]
+    gc = gc_content([x[4:-10] for x in seqs])
     feats = [pp, gc]
     rank_score = ms_data.loc[:, 'score_drug_gene_rank'].values
     return generate_input(seqs, feats, rank_score)
@@ -174,17 +196,46 @@ def loss(y_hat, input_y):
     return cost_function
 
 
+def session_config(num_threads=None):
+    """Session config limiting the CPU threads, the default if None"""
+    if num_threads is None:
+        return None
+    return tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                          inter_op_parallelism_threads=num_threads)
+
+
 def train_step(cost_function, lr=1e-4,
                optimizer=tf.train.AdamOptimizer):
     step = optimizer(lr).minimize(cost_function)
     return step
 
 
-def deep_rank(train_x, train_y, valid_x=None, valid_y=None,
+def deep_rank(train_x, train_y=None, valid_x=None, valid_y=None,
               max_epoch=20, batch_size=100,
-              model_save_path='deep_rank_model.ckpt'):
-    cnn_input_height, cnn_input_width, cnn_input_channel = train_x[0][0].shape
-    dnn_input_len = len(train_x[1][0])
+              model_save_path='deep_rank_model.ckpt', log_dir='./log',
+              num_threads=None):
+    """Train deep rank
+
+    Args:
+        train_x: [cnn input, dnn input] from transform, or DeepRankDataset
+        train_y: responses from transform, None for DeepRankDataset
+        valid_x: the same as train_x, for early stopping
+        valid_y: the same as train_y
+        max_epoch: max number of epochs
+        batch_size: batch size
+        model_save_path: the path of checkpoint
+        log_dir: the directory of summaries
+        num_threads: the max number of CPU threads, the default if None
+    """
+    use_dataset = isinstance(train_x, DeepRankDataset)
+    if use_dataset:
+        cnn_input_height, cnn_input_width, cnn_input_channel = \
+            train_x.seq_shape
+        dnn_input_len = train_x.feat_len
+    else:
+        cnn_input_height, cnn_input_width, cnn_input_channel = \
+            train_x[0][0].shape
+        dnn_input_len = len(train_x[1][0])
 
     # early stopping parameters
     num_waiting = 10
@@ -225,33 +276,36 @@ def deep_rank(train_x, train_y, valid_x=None, valid_y=None,
         summary_op = tf.merge_all_summaries()
 
         # sess
-        sess = tf.Session()
+        sess = tf.Session(config=session_config(num_threads))
         sess.run(init)
-        summary_writer = tf.train.SummaryWriter('./log', sess.graph)
-
-        # train parameters
-        batch_num = int(train_y.shape[0] / batch_size)
+        summary_writer = tf.train.SummaryWriter(log_dir, sess.graph)
 
         # training
         for epoch in range(max_epoch):
-            train_x, train_y = permute(train_x, train_y)
-            for i in range(batch_num):
-                batch_x_cnn = train_x[0][
-                              (i * batch_size): ((i + 1) * batch_size)]
-                batch_x_dnn = train_x[1][
-                              (i * batch_size): ((i + 1) * batch_size)]
-                batch_y = train_y[(i * batch_size): ((i + 1) * batch_size)]
+            if use_dataset:
+                batches = train_x.batches(batch_size)
+            else:
+                batches = iterate_batches(train_x, train_y, batch_size)
+            for batch_x_cnn, batch_x_dnn, batch_y in batches:
                 feed_dict = {cnn_input: batch_x_cnn, dnn_input: batch_x_dnn,
                              y: batch_y, keep_prob: 0.5}
                 sess.run(train_op, feed_dict=feed_dict)
-            if (valid_x is not None) and (valid_y is not None):
-                valid_feed_dict = {cnn_input: valid_x[0], dnn_input: valid_x[1],
-                                   y: valid_y, keep_prob: 1}
+            if use_dataset:
+                valid_data = valid_x if valid_x is not None else train_x
+                valid_loss, summary_str = _dataset_loss(
+                    sess, valid_data, batch_size, cnn_input, dnn_input,
+                    keep_prob, y_hat)
             else:
-                valid_feed_dict = {cnn_input: train_x[0], dnn_input: train_x[1],
-                                   y: train_y, keep_prob: 1}
-            valid_loss, summary_str = sess.run([cost_function, summary_op],
-                                               feed_dict=valid_feed_dict)
+                if (valid_x is not None) and (valid_y is not None):
+                    valid_feed_dict = {cnn_input: valid_x[0],
+                                       dnn_input: valid_x[1],
+                                       y: valid_y, keep_prob: 1}
+                else:
+                    valid_feed_dict = {cnn_input: train_x[0],
+                                       dnn_input: train_x[1],
+                                       y: train_y, keep_prob: 1}
+                valid_loss, summary_str = sess.run(
+                    [cost_function, summary_op], feed_dict=valid_feed_dict)
             summary_writer.add_summary(summary_str, epoch)
             print(valid_loss[0])
 
@@ -274,6 +328,25 @@ def deep_rank(train_x, train_y, valid_x=None, valid_y=None,
         sess.close()
 
 
+def _dataset_loss(sess, dataset, batch_size, cnn_input, dnn_input, keep_prob,
+                  y_hat):
+    """Negative Pearson correlation on a DeepRankDataset, predicted batch by
+    batch"""
+    y_pred = []
+    y_true = []
+    for batch_x_cnn, batch_x_dnn, batch_y in dataset.batches(
+            batch_size, shuffle=False, drop_last=False):
+        feed_dict = {cnn_input: batch_x_cnn, dnn_input: batch_x_dnn,
+                     keep_prob: 1}
+        y_pred.append(sess.run(y_hat, feed_dict=feed_dict)[:, 0])
+        y_true.append(batch_y[:, 0])
+    cost = -scipy.stats.pearsonr(np.concatenate(y_true),
+                                 np.concatenate(y_pred))[0]
+    summary = tf.Summary(value=[tf.Summary.Value(tag='cost',
+                                                 simple_value=cost)])
+    return np.array([[cost]]), summary
+
+
 # Prediction and evaluation
 def predict(model_save_path, input_x, input_y=None):
     if input_y is None:
@@ -303,3 +376,202 @@ def predict(model_save_path, input_x, input_y=None):
 def evaluate(y_true, y_pred):
     return scipy.stats.pearsonr(y_true, y_pred)[0], \
            scipy.stats.spearmanr(y_true, y_pred)[0]
+
+
+class DeepRankScorer:
+    """Deep rank model restored once and kept in a session, sgRNAs are scored
+    in batches of fixed size"""
+
+    def __init__(self, model_save_path=DEEP_RANK_MODEL, seq_len=SEQ_LEN,
+                 dnn_input_len=2, batch_size=1000, num_threads=None,
+                 version=None):
+        """
+
+        Args:
+            model_save_path: the checkpoint of deep rank model
+            seq_len: the length of input sequences
+            dnn_input_len: the number of features, percent peptide and GC
+            batch_size: the number of sgRNAs fed to the model at a time
+            num_threads: the max number of CPU threads, the default if None
+            version: the model version used by score cache, the digest of the
+             checkpoint files if None
+        """
+        assert model_save_path is not None, 'Please set DEEP_RANK_MODEL'
+        self.model_save_path = model_save_path
+        if version is None:
+            version = file_version(checkpoint_files(model_save_path))
+        self.version = version
+        self.seq_len = seq_len
+        self.dnn_input_len = dnn_input_len
+        self.batch_size = batch_size
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.cnn_input = tf.placeholder(tf.float32,
+                                            [None, 4, seq_len, 1])
+            self.dnn_input = tf.placeholder(tf.float32, [None, dnn_input_len])
+            self.keep_prob = tf.placeholder(tf.float32)
+            self.y_hat = inference(self.cnn_input, self.dnn_input,
+                                   self.keep_prob)
+            saver = tf.train.Saver(tf.all_variables())
+            self.sess = tf.Session(config=session_config(num_threads))
+            saver.restore(self.sess, model_save_path)
+
+    def __repr__(self):
+        return 'DeepRankScorer({})'.format(self.model_save_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.sess.close()
+
+    def export(self, npz_path):
+        """Write the weights to an .npz file for
+        deep_rank_numpy.NumpyDeepRankScorer
+
+        Args:
+            npz_path: the output path
+        """
+        with self.graph.as_default():
+            variables = tf.trainable_variables()
+        # the variables are created in the order of inference()
+        weights = dict(zip(WEIGHT_NAMES, self.sess.run(variables)))
+        np.savez(npz_path, seq_len=self.seq_len, **weights)
+
+    def predict(self, seqs, percent_peptide, gc=None):
+        """Score sgRNAs
+
+        Args:
+            seqs: array of sequences, 4bp + 20bp spacer + PAM + 7bp
+            percent_peptide: array of percent peptide of cutting sites, 0 - 1
+            gc: array of GC content of spacers, computed from seqs if None
+
+        Returns:
+            np.ndarray, deep rank scores
+        """
+        seqs = np.asarray(seqs)
+        if gc is None:
+            gc = gc_content([x[SPACER_START:(SPACER_START + SPACER_LEN)]
+                             for x in seqs])
+        feats = np.column_stack((percent_peptide, gc)).astype(np.float32)
+        scores = np.zeros(len(seqs), dtype=np.float32)
+        for start in range(0, len(seqs), self.batch_size):
+            end = start + self.batch_size
+            cnn = one_hot_encode(seqs[start:end], alphabet='ATCG',
+                                 dtype=np.float32)
+            scores[start:end] = self.predict_encoded(
+                cnn.reshape((-1, 4, self.seq_len, 1)), feats[start:end])
+        return scores
+
+    def predict_encoded(self, cnn, feats):
+        """Score a batch of encoded sgRNAs
+
+        Args:
+            cnn: np.ndarray, encoded sequences, (n, 4, seq_len, 1)
+            feats: np.ndarray, features, (n, dnn_input_len)
+
+        Returns:
+            np.ndarray, deep rank scores
+        """
+        feed_dict = {self.cnn_input: cnn, self.dnn_input: feats,
+                     self.keep_prob: 1}
+        return self.sess.run(self.y_hat, feed_dict=feed_dict)[:, 0]
+
+    def predict_dataset(self, dataset):
+        """Score a DeepRankDataset batch by batch
+
+        Returns:
+            np.ndarray of deep rank scores and np.ndarray of labels, in the
+            order of sorted rows
+        """
+        y_pred = [np.zeros(0, dtype=np.float32)]
+        y_true = [np.zeros(0, dtype=np.float32)]
+        for cnn, feats, labels in dataset.batches(
+                self.batch_size, shuffle=False, drop_last=False):
+            y_pred.append(self.predict_encoded(cnn, feats))
+            y_true.append(labels[:, 0])
+        return np.concatenate(y_pred), np.concatenate(y_true)
+
+
+_SCORER = None
+
+
+def get_deep_rank_scorer(model_save_path=DEEP_RANK_MODEL):
+    """The DeepRankScorer shared by the process"""
+    global _SCORER
+    if (_SCORER is None) or (_SCORER.model_save_path != model_save_path):
+        if _SCORER is not None:
+            _SCORER.close()
+        _SCORER = DeepRankScorer(model_save_path)
+    return _SCORER
+
+
+def export_numpy_model(model_save_path, npz_path, seq_len=SEQ_LEN,
+                       check_num=1000, atol=1e-5, seed=0):
+    """Export the weights of a deep rank checkpoint to an .npz file, and check
+    the NumPy forward pass against TensorFlow on random sgRNAs
+
+    Args:
+        model_save_path: the checkpoint of deep rank model
+        npz_path: the output path
+        seq_len: the length of input sequences
+        check_num: the number of random sgRNAs to check
+        atol: the max absolute difference allowed
+        seed: the random seed of the sgRNAs checked
+
+    Returns:
+        float, the max absolute difference of scores
+    """
+    rng = np.random.RandomState(seed)
+    bps = np.array(['A', 'T', 'C', 'G'])
+    seqs = [''.join(x) for x in
+            rng.choice(bps, size=(check_num, seq_len), replace=True)]
+    percent_peptide = rng.uniform(size=check_num)
+    with DeepRankScorer(model_save_path, seq_len=seq_len) as scorer:
+        scorer.export(npz_path)
+        tf_scores = scorer.predict(seqs, percent_peptide)
+    np_scores = NumpyDeepRankScorer(npz_path).predict(seqs, percent_peptide)
+    max_diff = float(np.max(np.abs(tf_scores - np_scores)))
+    assert max_diff <= atol, \
+        'NumPy model differs from TensorFlow by {}'.format(max_diff)
+    return max_diff
+
+
+def compute_deep_rank_batch(seqs, percent_peptide=None, scorer=None,
+                            cache=None):
+    """Score sgRNAs by deep rank
+
+    Args:
+        seqs: list of sequences, 4bp + 20bp spacer + PAM + 7bp
+        percent_peptide: list of percent peptide, the middle of CDS (0.5) is
+         used if None
+        scorer: DeepRankScorer or NumpyDeepRankScorer, if None, the shared
+         NumPy scorer is used when DEEP_RANK_NPZ is set, otherwise the shared
+         TensorFlow scorer
+        cache: ScoreCache, the shared cache (if any) is used if None
+
+    Returns:
+        DataFrame, seqs and deep rank score
+    """
+    if scorer is None:
+        if DEEP_RANK_NPZ is not None:
+            scorer = get_numpy_deep_rank_scorer()
+        else:
+            scorer = get_deep_rank_scorer()
+    if percent_peptide is None:
+        percent_peptide = [0.5] * len(seqs)
+    keep = [i for i, seq in enumerate(seqs) if len(seq) == scorer.seq_len]
+    seqs = [seqs[i] for i in keep]
+    percent_peptide = np.array([percent_peptide[i] for i in keep])
+    scores = cached_scores(
+        cache, 'deep_rank', scorer.version, seqs,
+        lambda index: scorer.predict([seqs[i] for i in index],
+                                     percent_peptide[index]),
+        extras=percent_peptide)
+    out = pd.DataFrame({'seq': seqs, 'deep_rank_score': scores},
+                       columns=['seq', 'deep_rank_score'])
+    return out
@@ -0,0 +1,231 @@
+"""Training data of deep rank stored in memory-mapped arrays
+
+The encoded sequences (uint8), features and labels are written chunk by chunk
+into contiguous .npy files, so the size of training set is not limited by
+RAM. Subsets (splits) only hold an index array, and batches are read from
+the memory maps one window of batches at a time.
+"""
+import copy
+import json
+import os
+import numpy as np
+from genome_editing.utils.sequence import gc_content, one_hot_encode
+
+SEQS_FILE = 'seqs.npy'
+FEATS_FILE = 'feats.npy'
+LABELS_FILE = 'labels.npy'
+GENES_FILE = 'genes.npy'
+GENE_NAMES_FILE = 'gene_names.json'
+WINDOW_BATCHES = 64
+
+
+class DeepRankDataset:
+    """Memory-mapped deep rank dataset"""
+
+    def __init__(self, path, index=None):
+        """
+
+        Args:
+            path: the directory written by build_dataset
+            index: the rows in the dataset, all rows if None
+        """
+        self.path = path
+        self.seqs = np.load(os.path.join(path, SEQS_FILE), mmap_mode='r')
+        self.feats = np.load(os.path.join(path, FEATS_FILE), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, LABELS_FILE), mmap_mode='r')
+        self.genes = np.load(os.path.join(path, GENES_FILE), mmap_mode='r')
+        with open(os.path.join(path, GENE_NAMES_FILE)) as f:
+            self.gene_names = json.load(f)
+        if index is None:
+            index = np.arange(self.labels.shape[0])
+        self.index = np.asarray(index)
+
+    def __repr__(self):
+        return 'DeepRankDataset({}, n={})'.format(self.path, len(self))
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def seq_shape(self):
+        return self.seqs.shape[1:]
+
+    @property
+    def feat_len(self):
+        return self.feats.shape[1]
+
+    def subset(self, index):
+        """The subset of rows index[i] for i in index, memory maps are
+        shared"""
+        out = copy.copy(self)
+        out.index = self.index[index]
+        return out
+
+    def take(self, rows):
+        """Read rows of the dataset, a contiguous range is read as views of
+        the memory maps without copy
+
+        Args:
+            rows: sorted array of row numbers in the memory maps
+
+        Returns:
+            cnn input (uint8), dnn input and labels
+        """
+        if (len(rows) > 0) and (rows[-1] - rows[0] + 1 == len(rows)):
+            rows = slice(rows[0], rows[-1] + 1)
+        return self.seqs[rows], self.feats[rows], self.labels[rows]
+
+    def batches(self, batch_size, shuffle=True, drop_last=True,
+                window_batches=WINDOW_BATCHES):
+        """Iterate batches, only one window of batches is in memory at a time
+
+        With shuffle, the rows are read as contiguous windows of
+        window_batches batches from a random offset, the windows are visited
+        in random order and the rows of each window are permuted in memory,
+        so every epoch has new batches while the memory maps are read
+        sequentially. Rows are only mixed within windows, datasets written by
+        build_dataset(shuffle=False) should be read with a large
+        window_batches.
+
+        Args:
+            batch_size: batch size
+            shuffle: whether shuffle the rows
+            drop_last: whether drop the last incomplete batch
+            window_batches: the number of batches read at a time
+
+        Returns:
+            generator of cnn input, dnn input and labels
+        """
+        n = len(self.index)
+        if not shuffle:
+            end = n - n % batch_size if drop_last else n
+            for start in range(0, end, batch_size):
+                yield self.take(self.index[start:(start + batch_size)])
+            return
+        window = batch_size * window_batches
+        positions = np.roll(np.arange(n), -np.random.randint(max(n, 1)))
+        windows = [positions[i:(i + window)] for i in range(0, n, window)]
+        for i in np.random.permutation(len(windows)):
+            # one sequential read of the window, a copy in memory
+            data = [np.array(x) for x in
+                    self.take(np.sort(self.index[windows[i]]))]
+            order = np.random.permutation(len(windows[i]))
+            end = len(order) - len(order) % batch_size if drop_last \
+                else len(order)
+            for start in range(0, end, batch_size):
+                rows = order[start:(start + batch_size)]
+                yield tuple(x[rows] for x in data)
+
+    def load(self):
+        """Read all rows into memory"""
+        return self.take(np.sort(self.index))
+
+    def get_genes(self):
+        """Gene of each row"""
+        return np.asarray(self.gene_names)[self.genes[self.index]]
+
+    def get_gene_codes(self):
+        """Gene code of each row, the position in gene_names"""
+        return self.genes[self.index]
+
+    def split_by_gene(self, test_gene):
+        """Split the dataset into train and test, the test set contains the
+        sgRNAs of test_gene"""
+        test_mask = np.zeros(len(self.index), dtype=bool)
+        if test_gene in self.gene_names:
+            gene_code = self.gene_names.index(test_gene)
+            test_mask = self.genes[self.index] == gene_code
+        return self.subset(~test_mask), self.subset(test_mask)
+
+    def split_random(self, train_ratio=0.6, valid_ratio=0.2, test_ratio=0.2):
+        """Split the dataset into train, validation and test randomly"""
+        assert train_ratio + valid_ratio + test_ratio == 1, 'Wrong ratio'
+        total_num = len(self.index)
+        train_num = int(total_num * train_ratio)
+        valid_num = int(total_num * valid_ratio)
+        permute_index = np.random.permutation(total_num)
+        train_index = np.sort(permute_index[:train_num])
+        valid_index = np.sort(permute_index[train_num:(train_num + valid_num)])
+        test_index = np.sort(permute_index[(train_num + valid_num):])
+        return self.subset(train_index), self.subset(valid_index), \
+            self.subset(test_index)
+
+
+def build_dataset(path, seqs, feats, labels, genes=None, chunk_size=100000,
+                  shuffle=True):
+    """Write a deep rank dataset into memory-mapped arrays
+
+    Args:
+        path: output directory
+        seqs: array of sequences with the same length
+        feats: list of feature arrays, e.g. [percent peptide, GC]
+        labels: array of responses
+        genes: array of gene of each sgRNA, or None
+        chunk_size: the number of sgRNAs encoded at a time
+        shuffle: whether write the rows in random order, so that contiguous
+         batches are random samples
+
+    Returns:
+        DeepRankDataset
+    """
+    seqs = np.asarray(seqs)
+    feats = [np.asarray(x) for x in feats]
+    labels = np.asarray(labels)
+    total_num = seqs.shape[0]
+    seq_len = len(seqs[0])
+    if genes is None:
+        genes = np.repeat('', total_num)
+    gene_names, gene_codes = np.unique(np.asarray(genes, dtype=str),
+                                       return_inverse=True)
+    if shuffle:
+        order = np.random.permutation(total_num)
+    else:
+        order = np.arange(total_num)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    open_memmap = np.lib.format.open_memmap
+    seqs_out = open_memmap(os.path.join(path, SEQS_FILE), mode='w+',
+                           dtype=np.uint8, shape=(total_num, 4, seq_len, 1))
+    feats_out = open_memmap(os.path.join(path, FEATS_FILE), mode='w+',
+                            dtype=np.float32, shape=(total_num, len(feats)))
+    labels_out = open_memmap(os.path.join(path, LABELS_FILE), mode='w+',
+                             dtype=np.float32, shape=(total_num, 1))
+    genes_out = open_memmap(os.path.join(path, GENES_FILE), mode='w+',
+                            dtype=np.int32, shape=(total_num,))
+    for start in range(0, total_num, chunk_size):
+        end = min(start + chunk_size, total_num)
+        rows = order[start:end]
+        seqs_out[start:end, :, :, 0] = one_hot_encode(seqs[rows],
+                                                      dtype=np.uint8)
+        for i, feat in enumerate(feats):
+            feats_out[start:end, i] = feat[rows]
+        labels_out[start:end, 0] = labels[rows]
+        genes_out[start:end] = gene_codes[rows]
+    for out in (seqs_out, feats_out, labels_out, genes_out):
+        out.flush()
+    del seqs_out, feats_out, labels_out, genes_out
+
+    with open(os.path.join(path, GENE_NAMES_FILE), 'w') as f:
+        json.dump([str(x) for x in gene_names], f)
+    return DeepRankDataset(path)
+
+
+def build_ms_dataset(path, ms_data, gene_col=None, **kwargs):
+    """Dataset of the input of generate_ms_input"""
+    seqs = ms_data.loc[:, 'sgrna_34mer'].values
+    pp = ms_data.loc[:, 'Percent Peptide'].values / 100
+    gc = gc_content([x[4:-10] for x in seqs])
+    rank_score = ms_data.loc[:, 'score_drug_gene_rank'].values
+    genes = ms_data.loc[:, gene_col].values if gene_col else None
+    return build_dataset(path, seqs, [pp, gc], rank_score, genes, **kwargs)
+
+
+def build_clean_df_dataset(path, clean_df, gene_col=None, **kwargs):
+    """Dataset of the input of generate_input_from_clean_df"""
+    seqs = clean_df.loc[:, 'deep_rank'].values
+    pp = clean_df.loc[:, 'peptide_ratio'].values
+    gc = clean_df.loc[:, 'gc'].values
+    rank_score = clean_df.loc[:, 'rank_score'].values
+    genes = clean_df.loc[:, gene_col].values if gene_col else None
+    return build_dataset(path, seqs, [pp, gc], rank_score, genes, **kwargs)
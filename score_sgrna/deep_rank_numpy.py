@@ -0,0 +1,142 @@
+"""Deep rank inference in pure NumPy
+
+The weights exported by deep_rank.export_numpy_model are loaded from an .npz
+file and the forward pass of deep_rank.inference (conv1, conv2, dense layer
+and readout) is reproduced with NumPy, so scoring does not need TensorFlow.
+"""
+
+import os
+import numpy as np
+from genome_editing.utils.sequence import gc_content, one_hot_encode
+from genome_editing.score_sgrna.score_cache import file_version
+
+DEEP_RANK_NPZ = os.getenv('DEEP_RANK_NPZ')
+# 4bp + 20bp spacer + PAM + 7bp
+SEQ_LEN = 34
+SPACER_START = 4
+SPACER_LEN = 20
+WEIGHT_NAMES = ('conv1_kernel', 'conv1_bias', 'conv2_kernel', 'conv2_bias',
+                'fc1_weights', 'fc1_biases', 'readout_weights',
+                'readout_biases')
+
+
+def conv2d_same(x, kernel, bias):
+    """2D convolution with stride 1 and SAME padding as tf.nn.conv2d
+
+    Args:
+        x: np.ndarray, NHWC
+        kernel: np.ndarray, (height, width, in_channel, out_channel)
+        bias: np.ndarray, (out_channel, )
+
+    Returns:
+        np.ndarray, NHWC
+    """
+    n, height, width, channel = x.shape
+    kh, kw = kernel.shape[:2]
+    # TensorFlow puts the extra padding at the bottom and the right
+    pad_top = (kh - 1) // 2
+    pad_left = (kw - 1) // 2
+    padded = np.pad(x, ((0, 0), (pad_top, kh - 1 - pad_top),
+                        (pad_left, kw - 1 - pad_left), (0, 0)),
+                    mode='constant')
+    padded = np.ascontiguousarray(padded)
+    s = padded.strides
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=(n, height, width, kh, kw, channel),
+        strides=(s[0], s[1], s[2], s[1], s[2], s[3]), writeable=False)
+    return np.tensordot(windows, kernel, axes=([3, 4, 5], [0, 1, 2])) + bias
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def inference(cnn_input, dnn_input, weights):
+    """Forward pass of deep rank
+
+    Args:
+        cnn_input: np.ndarray, (n, 4, seq_len, 1)
+        dnn_input: np.ndarray, (n, n_features)
+        weights: dict of exported weights
+
+    Returns:
+        np.ndarray, (n, 1)
+    """
+    conv1 = relu(conv2d_same(cnn_input, weights['conv1_kernel'],
+                             weights['conv1_bias']))
+    conv2 = relu(conv2d_same(conv1, weights['conv2_kernel'],
+                             weights['conv2_bias']))
+    conv_flat = conv2.reshape(conv2.shape[0], -1)
+    hidden1_input = np.hstack((conv_flat, dnn_input))
+    hidden1 = relu(np.dot(hidden1_input, weights['fc1_weights']) +
+                   weights['fc1_biases'])
+    y = np.dot(hidden1, weights['readout_weights']) + \
+        weights['readout_biases']
+    return sigmoid(y)
+
+
+class NumpyDeepRankScorer:
+    """Deep rank scorer running on NumPy, same interface as
+    deep_rank.DeepRankScorer"""
+
+    def __init__(self, npz_path=DEEP_RANK_NPZ, batch_size=1000, version=None):
+        """
+
+        Args:
+            npz_path: the weights exported by deep_rank.export_numpy_model
+            batch_size: the number of sgRNAs computed at a time
+            version: the model version used by score cache, the digest of the
+             .npz if None
+        """
+        assert npz_path is not None, 'Please set DEEP_RANK_NPZ'
+        self.npz_path = npz_path
+        self.version = file_version([npz_path]) if version is None \
+            else version
+        self.batch_size = batch_size
+        with np.load(npz_path) as data:
+            self.weights = {name: data[name].astype(np.float32)
+                            for name in WEIGHT_NAMES}
+            self.seq_len = int(data['seq_len'])
+
+    def __repr__(self):
+        return 'NumpyDeepRankScorer({})'.format(self.npz_path)
+
+    def predict(self, seqs, percent_peptide, gc=None):
+        """Score sgRNAs
+
+        Args:
+            seqs: array of sequences, 4bp + 20bp spacer + PAM + 7bp
+            percent_peptide: array of percent peptide of cutting sites, 0 - 1
+            gc: array of GC content of spacers, computed from seqs if None
+
+        Returns:
+            np.ndarray, deep rank scores
+        """
+        seqs = list(seqs)
+        if gc is None:
+            gc = gc_content([x[SPACER_START:(SPACER_START + SPACER_LEN)]
+                             for x in seqs])
+        feats = np.column_stack((percent_peptide, gc)).astype(np.float32)
+        scores = np.zeros(len(seqs), dtype=np.float32)
+        for start in range(0, len(seqs), self.batch_size):
+            end = start + self.batch_size
+            cnn = one_hot_encode(seqs[start:end], alphabet='ATCG',
+                                 dtype=np.float32)[..., np.newaxis]
+            scores[start:end] = inference(cnn, feats[start:end],
+                                          self.weights)[:, 0]
+        return scores
+
+
+_SCORER = None
+
+
+def get_numpy_deep_rank_scorer(npz_path=DEEP_RANK_NPZ):
+    """The NumpyDeepRankScorer shared by the process"""
+    global _SCORER
+    if (_SCORER is None) or (_SCORER.npz_path != npz_path):
+        _SCORER = NumpyDeepRankScorer(npz_path)
+    return _SCORER
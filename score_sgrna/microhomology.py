@@ -0,0 +1,93 @@
+"""Microhomology and out-of-frame scores of Bae et al. 2014
+
+Deletions repaired by microhomology-mediated end joining remove the sequence
+between two identical stretches on both sides of the cut. For every deletion
+distance d, the microhomologies are the maximal runs of matches between the
+sequence and itself shifted by d, with the left copy upstream of the cut and
+the right copy downstream. The score of a microhomology is
+
+    100 * round(exp(-d / 20), 3) * (#AT + 2 * #GC)
+
+and the out-of-frame score is the percentage of the total score from
+deletions with d not divisible by 3. Whole arrays of sequences are scored at
+once, with a loop over d only.
+"""
+
+import math
+import numpy as np
+import pandas as pd
+from genome_editing.utils.sequence import encode_sequences
+
+LENGTH_WEIGHT = 20.0
+NUCLEOTIDES = 'ACGT'
+
+
+def microhomology_scores(seqs, left, length_weight=LENGTH_WEIGHT):
+    """Compute microhomology and out-of-frame scores
+
+    Args:
+        seqs: list of sequences with the same length, the cut site is between
+         seq[left - 1] and seq[left]
+        left: the length of sequence upstream of the cut site
+        length_weight: the deletion length penalty
+
+    Returns:
+        np.ndarray of microhomology scores and np.ndarray of out-of-frame
+        scores, the out-of-frame score is NaN if there is no microhomology
+    """
+    codes = encode_sequences(seqs, alphabet=NUCLEOTIDES)
+    n, seq_len = codes.shape
+    assert 0 < left < seq_len, 'Wrong cut site'
+    # N never matches
+    valid = codes < len(NUCLEOTIDES)
+    gc = ((codes == NUCLEOTIDES.index('C')) |
+          (codes == NUCLEOTIDES.index('G'))).astype(np.int64)
+    in_frame = np.zeros(n)
+    frameshift = np.zeros(n)
+    for d in range(2, seq_len):
+        # the left copy starts at p, the right copy starts at p + d
+        lo = max(0, left - d)
+        hi = min(left, seq_len - d)
+        if hi - lo < 2:
+            continue
+        match = (codes[:, lo:hi] == codes[:, (lo + d):(hi + d)]) & \
+            valid[:, lo:hi]
+        # a match belongs to a microhomology if one of its neighbours matches
+        padded = np.pad(match, ((0, 0), (1, 1)), mode='constant')
+        member = match & (padded[:, :-2] | padded[:, 2:])
+        # #AT + 2 * #GC = length + #GC
+        weight = 100 * round(1 / math.exp(d / length_weight), 3)
+        score = weight * np.sum(member * (1 + gc[:, lo:hi]), axis=1)
+        if d % 3 == 0:
+            in_frame += score
+        else:
+            frameshift += score
+    mh_score = in_frame + frameshift
+    with np.errstate(invalid='ignore', divide='ignore'):
+        oof_score = np.where(mh_score > 0, frameshift * 100 / mh_score, np.nan)
+    return mh_score, oof_score
+
+
+def compute_microhomology(seqs, left=None, length_weight=LENGTH_WEIGHT):
+    """Compute microhomology and out-of-frame scores
+
+    Args:
+        seqs: list of sequences with the same length
+        left: the length of sequence upstream of the cut site, the middle of
+         sequences if None
+        length_weight: the deletion length penalty
+
+    Returns:
+        DataFrame, seqs, microhomology score and out-of-frame score
+    """
+    seqs = list(seqs)
+    if left is None:
+        left = len(seqs[0]) // 2 if len(seqs) > 0 else 1
+    if len(seqs) > 0:
+        mh_score, oof_score = microhomology_scores(seqs, left, length_weight)
+    else:
+        mh_score = oof_score = np.zeros(0)
+    out = pd.DataFrame({'seq': seqs, 'mh_score': mh_score,
+                        'oof_score': oof_score},
+                       columns=['seq', 'mh_score', 'oof_score'])
+    return out
@@ -1,10 +1,9 @@
-import numpy as np
 import os
 import pandas as pd
 import subprocess
 import tempfile
 from genome_editing.utils.alignment import bowtie_alignment
-from genome_editing.utils.utilities import reverse_complement
+from genome_editing.utils.sequence import reverse_complement_batch
 
 """
 1. map the sequence without PAM to genome
@@ -82,16 +81,13 @@ def sgrna_off_targets_batch(seqs, pam='NGG', seed=20, num_mismatch=1,
     alignment_out = sgrna_alignment_batch(seqs=sub_seqs,
                                           bowtie_index_path=bowtie_index,
                                           num_mismatch=num_mismatch)
-    alignment_out_seqs = alignment_out.iloc[:, 4]
-    off_targets = []
-    for seq in sub_seqs:
-        target_num = np.sum(alignment_out_seqs == seq) + \
-                     np.sum(alignment_out_seqs == reverse_complement(seq))
-        if target_num > 1:
-            off_targets.append(True)
-        else:
-            off_targets.append(False)
-    return off_targets
+    # count the alignments of each sequence once, instead of scanning the
+    # alignments for every input
+    seq_counts = alignment_out.iloc[:, 4].value_counts()
+    target_nums = seq_counts.reindex(sub_seqs, fill_value=0).values + \
+        seq_counts.reindex(reverse_complement_batch(sub_seqs),
+                           fill_value=0).values
+    return (target_nums > 1).tolist()
 
 
 def sgrna_alignment_batch(seqs, bowtie_index_path=HG38_BOWTIE_INDEX_PATH,
@@ -2,53 +2,245 @@
 
 Optimized sgRNA design to maximize activity and minimize off-target effects of
 CRISPR-Cas9. Nature Biotechnology, 1–12. http://doi.org/10.1038/nbt.3437
+
+The gradient-boosted models are loaded once per process and the features of
+all 30mers (4bp + 20bp spacer + NGG + 3bp) are computed together with NumPy,
+so a whole design table is scored with a single predict call.
 """
 import os
+import pickle
 import numpy as np
 import pandas as pd
-import subprocess
+from genome_editing.utils.sequence import encode_sequences
+from genome_editing.score_sgrna.score_cache import cached_scores
+from genome_editing.score_sgrna.score_cache import file_version
 
-PYTHON2 = os.getenv('ANACONDA_PYTHON2')
 RS2 = os.getenv('RS2_CALCULATOR')
+RS2_MODEL_DIR = os.getenv('RS2_MODEL_DIR')
+if RS2_MODEL_DIR is None and RS2 is not None:
+    RS2_MODEL_DIR = os.path.join(os.path.dirname(RS2), 'saved_models')
+RS2_MODEL_NOPOS = 'V3_model_nopos.pickle'
+RS2_MODEL_FULL = 'V3_model_full.pickle'
+
+SEQ_LEN = 30
+# the alphabet of Azimuth nucleotide features, one-hot and dinucleotide
+# columns are in this order
+NUCLEOTIDES = 'ATCG'
+# feature blocks, concatenated in the order of the Python 2 dict of feature
+# sets of Azimuth featurize_data, which the models were fitted with
+FEATURE_BLOCKS = ('gc_count', 'nuc_pd_order2', 'nuc_pd_order1',
+                  'gc_above_10', 'nuc_pi_order1', 'nuc_pi_order2', 'tm',
+                  'gc_below_10', 'nggx_pd_order2')
+FULL_FEATURE_BLOCKS = ('gc_count', 'aa_cut', 'nuc_pd_order2',
+                       'nuc_pd_order1', 'gc_above_10', 'nuc_pi_order1',
+                       'nuc_pi_order2', 'percent_peptide_below_50', 'tm',
+                       'gc_below_10', 'nggx_pd_order2', 'percent_peptide')
+
+# nearest neighbor parameters of Allawi and SantaLucia (1997), indexed by the
+# dinucleotide code 4 * first + second in ATCG order
+NN_DH = np.array([7.9, 7.2, 8.4, 7.8,
+                  7.2, 7.9, 8.2, 8.5,
+                  8.5, 7.8, 8.0, 10.6,
+                  8.2, 8.4, 9.8, 8.0])
+NN_DS = np.array([22.2, 20.4, 22.4, 21.0,
+                  21.3, 22.2, 22.2, 22.7,
+                  22.7, 21.0, 19.9, 27.2,
+                  22.2, 22.4, 24.4, 19.9])
+# terminal corrections of A, T, C, G and others, with the signs of tercorr of
+# Tm_staluc
+TERMINAL_DH = np.array([-2.3, -2.3, -0.1, -0.1, 0])
+TERMINAL_DS = np.array([-4.1, -4.1, 2.8, 2.8, 0])
+# (start, end) of the 5mer proximal to PAM, the middle 8mer and the 5mer start
+TM_SEGMENTS = ((19, 24), (11, 19), (6, 11))
+
+
+def encode_30mers(seqs):
+    """Encode 30mers to integer codes, A: 0, T: 1, C: 2, G: 3, others: 4
+
+    Args:
+        seqs: list of 30mers
+
+    Returns:
+        np.ndarray, uint8, shape (n, 30)
+    """
+    return encode_sequences(seqs, alphabet=NUCLEOTIDES)
+
+
+def _one_hot(codes, depth):
+    return (codes[..., np.newaxis] ==
+            np.arange(depth, dtype=codes.dtype)).astype(np.float64)
+
+
+def _dinucleotide_codes(codes):
+    valid = (codes[:, :-1] < 4) & (codes[:, 1:] < 4)
+    dinuc = codes[:, :-1].astype(np.int64) * 4 + codes[:, 1:]
+    return np.where(valid, dinuc, 255), valid
+
+
+def melting_temperature(codes, dnac=50, saltc=50):
+    """DNA/DNA Tm by nearest neighbor thermodynamics (Tm_staluc of Biopython)
+
+    Args:
+        codes: np.ndarray, encoded sequences with the same length
+        dnac: DNA concentration [nM]
+        saltc: salt concentration [mM]
+
+    Returns:
+        np.ndarray, Tm of each sequence
+    """
+    r = 1.987
+    k = (dnac / 4.0) * 1e-9
+    first = np.minimum(codes[:, 0], 4)
+    last = np.minimum(codes[:, -1], 4)
+    dh = TERMINAL_DH[first] + TERMINAL_DH[last]
+    ds = TERMINAL_DS[first] + TERMINAL_DS[last]
+    dinuc, valid = _dinucleotide_codes(codes)
+    dinuc = np.where(valid, dinuc, 0)
+    dh += np.where(valid, NN_DH[dinuc], 0).sum(axis=1)
+    ds += np.where(valid, NN_DS[dinuc], 0).sum(axis=1)
+    ds -= 0.368 * (codes.shape[1] - 1) * np.log(saltc / 1e3)
+    return (1000 * (-dh)) / (-ds + r * np.log(k)) - 273.15
+
+
+def featurize(seqs, aa_cut=None, per_peptide=None):
+    """Rule set 2 features of 30mers
+
+    Args:
+        seqs: list of 30mers, 4bp + 20bp spacer + PAM + 3bp
+        aa_cut: array of amino acid cut positions, or None
+        per_peptide: array of peptide percentages, or None
 
+    Returns:
+        np.ndarray, shape (n, n_features)
+    """
+    codes = encode_30mers(seqs)
+    n = codes.shape[0]
+    order1 = _one_hot(codes, 4)
+    dinuc, _ = _dinucleotide_codes(codes)
+    order2 = _one_hot(dinuc, 16)
+    gc_count = ((codes[:, 4:24] == 2) | (codes[:, 4:24] == 3)).sum(axis=1)
+    # the NGGX columns of Azimuth are sorted by name by pandas.concat, so
+    # they are in ACGT order
+    acgt = np.array([0, 3, 1, 2, 255])[np.minimum(codes[:, [24, 27]], 4)]
+    nggx = acgt[:, 0] * 4 + acgt[:, 1]
+    nggx[(acgt[:, 0] > 3) | (acgt[:, 1] > 3)] = 255
 
-def compute_rs2(seq, aa_cut=None, per_peptide=None,
-                python_path=PYTHON2, rs2_calculator_path=RS2):
-    if aa_cut is None:
-        aa_cut = -1
-    if per_peptide is None:
-        per_peptide = -1
-    cmd = python_path + ' ' + rs2_calculator_path + \
-          ' --seq {} --aa-cut {} --per-peptide {}'.format(
-              seq, aa_cut, per_peptide)
-    rs2_score = subprocess.check_output(cmd, shell=True).decode('utf-8')
-    return float(rs2_score.strip().split(' ')[-1])
+    blocks = {
+        'nuc_pd_order1': order1.reshape(n, -1),
+        'nuc_pi_order1': order1.sum(axis=1),
+        'nuc_pd_order2': order2.reshape(n, -1),
+        'nuc_pi_order2': order2.sum(axis=1),
+        'gc_above_10': (gc_count > 10)[:, np.newaxis],
+        'gc_below_10': (gc_count < 10)[:, np.newaxis],
+        'gc_count': gc_count[:, np.newaxis],
+        'nggx_pd_order2': _one_hot(nggx, 16),
+        # global, the 5mer proximal to PAM, the middle 8mer and the 5mer start
+        'tm': np.stack([melting_temperature(codes)] +
+                       [melting_temperature(codes[:, start:end])
+                        for start, end in TM_SEGMENTS], axis=1),
+    }
+    if (aa_cut is not None) and (per_peptide is not None):
+        per_peptide = np.reshape(per_peptide, (n, 1)).astype(np.float64)
+        blocks['aa_cut'] = np.reshape(aa_cut, (n, 1))
+        blocks['percent_peptide'] = per_peptide
+        blocks['percent_peptide_below_50'] = per_peptide < 50
+        block_names = FULL_FEATURE_BLOCKS
+    else:
+        block_names = FEATURE_BLOCKS
+    return np.hstack([blocks[name] for name in block_names]) \
+        .astype(np.float64)
+
+
+class RS2Scorer:
+    """Rule set 2 scorer, the models are loaded on first use and kept"""
+
+    def __init__(self, model_dir=RS2_MODEL_DIR, version=None):
+        """
+
+        Args:
+            model_dir: the directory containing V3_model_nopos.pickle and
+             V3_model_full.pickle
+            version: the model version used by score cache, the digest of the
+             pickles if None
+        """
+        assert model_dir is not None, 'Please set RS2_MODEL_DIR'
+        self.model_dir = model_dir
+        if version is None:
+            version = file_version([os.path.join(model_dir, x) for x in
+                                    (RS2_MODEL_NOPOS, RS2_MODEL_FULL)])
+        self.version = version
+        self.models = {}
+
+    def __repr__(self):
+        return 'RS2Scorer({})'.format(self.model_dir)
+
+    def _get_model(self, with_position):
+        model_name = RS2_MODEL_FULL if with_position else RS2_MODEL_NOPOS
+        if model_name not in self.models:
+            with open(os.path.join(self.model_dir, model_name), 'rb') as f:
+                model = pickle.load(f, encoding='latin1')
+            # the published pickles store (model, learn_options)
+            if isinstance(model, tuple):
+                model = model[0]
+            self.models[model_name] = model
+        return self.models[model_name]
+
+    def score(self, seqs, aa_cut=None, per_peptide=None):
+        """Score 30mers in one batch
+
+        Args:
+            seqs: list of 30mers
+            aa_cut: array of amino acid cut positions, or None
+            per_peptide: array of peptide percentages, or None
 
+        Returns:
+            np.ndarray, rs2 scores
+        """
+        seqs = list(seqs)
+        if len(seqs) == 0:
+            return np.zeros(0)
+        assert all(len(seq) == SEQ_LEN for seq in seqs), \
+            'Have to provide 30mers'
+        with_position = (aa_cut is not None) and (per_peptide is not None)
+        features = featurize(seqs, aa_cut, per_peptide)
+        return self._get_model(with_position).predict(features)
 
-def compute_rs2_batch(seqs, python_path=PYTHON2, rs2_calculator_path=RS2):
+
+_SCORER = None
+
+
+def get_rs2_scorer(model_dir=RS2_MODEL_DIR):
+    """The RS2Scorer shared by the process"""
+    global _SCORER
+    if (_SCORER is None) or (_SCORER.model_dir != model_dir):
+        _SCORER = RS2Scorer(model_dir)
+    return _SCORER
+
+
+def compute_rs2(seq, aa_cut=None, per_peptide=None, scorer=None):
+    if aa_cut is None or aa_cut == -1 or per_peptide is None or \
+            per_peptide == -1:
+        aa_cut = None
+        per_peptide = None
+    else:
+        aa_cut = [aa_cut]
+        per_peptide = [per_peptide]
+    if scorer is None:
+        scorer = get_rs2_scorer()
+    return float(scorer.score([seq], aa_cut, per_peptide)[0])
+
+
+def compute_rs2_batch(seqs, scorer=None, cache=None):
     if type(seqs) is not list:
         seqs = [seqs]
-    flag = True
-    seq_num = 0
-    for seq in seqs:
-        if (seq == '') or (len(seq) < 30):
-            continue
-        seq = seq[:30]
-        seq_score = compute_rs2(seq, python_path=python_path,
-                                rs2_calculator_path=rs2_calculator_path)
-        if flag:
-            seq_num += 1
-            out = np.asarray([seq, seq_score])
-            flag = False
-        else:
-            seq_num += 1
-            temp = np.asarray([seq, seq_score])
-            out = np.vstack((out, temp))
-    if seq_num < 2:
-        out = pd.DataFrame(out).transpose()
-    else:
-        out = pd.DataFrame(out)
-    out.columns = ['seq', 'rs2_score']
+    seqs = [seq[:30] for seq in seqs if (seq != '') and (len(seq) >= 30)]
+    if scorer is None:
+        scorer = get_rs2_scorer()
+    scores = cached_scores(cache, 'rs2', scorer.version, seqs,
+                           lambda index: scorer.score([seqs[i]
+                                                       for i in index]))
+    out = pd.DataFrame({'seq': seqs, 'rs2_score': scores},
+                       columns=['seq', 'rs2_score'])
     return out
 
 
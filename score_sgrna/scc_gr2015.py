@@ -1,55 +1,111 @@
-"""Compute SCC score from GR2015"""
+"""Compute SCC score from GR2015
+
+SSC is a position weight linear model: the score of a sequence is the
+intercept plus the weight of the nucleotide at each position. The matrices
+under SSC0.1/matrix are parsed once and whole arrays of spacers are scored
+with a single einsum, which is cheaper than a cache lookup, so SSC scores
+are not cached.
+"""
 
 import os
+import numpy as np
 import pandas as pd
-import subprocess
-import tempfile
+from genome_editing.utils.sequence import one_hot_encode
+
+SSC_MATRIX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'SSC0.1', 'matrix')
+KO_MATRIX_PATH = os.path.join(SSC_MATRIX_DIR,
+                              'human_mouse_CRISPR_KO_30bp.matrix')
+NUCLEOTIDES = 'ACGT'
+
+_MATRICES = {}
+
+
+def read_matrix(mat_path):
+    """Read SSC score matrix
+
+    Args:
+        mat_path: the path of SSC score matrix
+
+    Returns:
+        intercept and np.ndarray of weights, shape (seq_len, 4) in ACGT order
+    """
+    with open(mat_path) as f:
+        intercept = float(f.readline().split()[1])
+        header = f.readline().split()
+        weights = np.array([[float(x) for x in line.split()] for line in f
+                            if line.strip() != ''])
+    columns = [header.index(bp) for bp in NUCLEOTIDES]
+    return intercept, weights[:, columns]
+
+
+def load_matrix(mat_path):
+    """Read SSC score matrix, each matrix is parsed once per process"""
+    if mat_path not in _MATRICES:
+        _MATRICES[mat_path] = read_matrix(mat_path)
+    return _MATRICES[mat_path]
+
+
+def one_hot_spacers(seqs, seq_len):
+    """One-hot encode spacers, bases other than ACGT are all zero
+
+    Args:
+        seqs: list of sequences with length seq_len
+        seq_len: the length of sequences
+
+    Returns:
+        np.ndarray, uint8, shape (n, seq_len, 4)
+    """
+    encoding = one_hot_encode(seqs, alphabet=NUCLEOTIDES, dtype=np.uint8)
+    assert encoding.shape[2] == seq_len, 'Wrong sequence length'
+    return encoding.transpose((0, 2, 1))
+
+
+def score_spacers(seqs, mat_path, logistic=False):
+    """Score sequences by SSC matrix
+
+    Args:
+        seqs: list of sequences, the length should match the matrix
+        mat_path: the path of SSC score matrix
+        logistic: whether transform scores by logistic function
+
+    Returns:
+        np.ndarray, SSC scores
+    """
+    intercept, weights = load_matrix(mat_path)
+    if len(seqs) == 0:
+        return np.zeros(0)
+    encoding = one_hot_spacers(seqs, weights.shape[0])
+    scores = intercept + np.einsum('nlk,lk->n', encoding, weights)
+    if logistic:
+        scores = 1 / (1 + np.exp(-scores))
+    return scores
 
 
-def compute_scc(seqs,
-                scc_path='/Users/yinan/PycharmProjects/genome_editing/score_sgrna/SSC0.1/bin/SSC',
-                mat_path='/Users/yinan/PycharmProjects/genome_editing/score_sgrna/SSC0.1/matrix/human_mouse_CRISPR_KO_30bp.matrix'):
+def compute_scc(seqs, mat_path=KO_MATRIX_PATH):
     """Compute SCC score
 
     Args:
         seqs: list, input sequence, 20mer + PAM + 7mer
-        scc_path: the path of SCC bin
         mat_path: the path of SCC score matrix
 
     Returns:
         DataFrame, seqs and SSC score
     """
-    temp_input = tempfile.NamedTemporaryFile(mode='a', delete=False)
-    temp_output = tempfile.NamedTemporaryFile(mode='a', delete=False)
-    for seq in seqs:
-        temp_input.write(seq + '\n')
-    temp_input.close()
-    cmd = '{} -l 30 -m {} -i {} -o {}'.format(scc_path, mat_path,
-                                              temp_input.name, temp_output.name)
-    temp_output.close()
-    subprocess.run(cmd, shell=True)
-    scc = pd.read_table(temp_output.name, header=None)
-    scc.columns = ['seq_with_context', 'scc_score']
-    os.remove(temp_input.name)
-    os.remove(temp_output.name)
+    seq_len = load_matrix(mat_path)[1].shape[0]
+    # as SSC, sequences with other length are skipped
+    seqs = [seq for seq in seqs if len(seq) == seq_len]
+    scc = pd.DataFrame({'seq_with_context': seqs,
+                        'scc_score': score_spacers(seqs, mat_path)},
+                       columns=['seq_with_context', 'scc_score'])
     return scc
 
 
-def compute_scc_crispr_ia(seqs, spacer_len,
-                scc_path='/Users/yinan/PycharmProjects/genome_editing/score_sgrna/SSC0.1/bin/SSC',
-                mat_path_prefix='/Users/yinan/PycharmProjects/genome_editing/score_sgrna/SSC0.1/matrix/'):
-    temp_input = tempfile.NamedTemporaryFile(mode='a', delete=False)
-    temp_output = tempfile.NamedTemporaryFile(mode='a', delete=False)
-    for seq in seqs:
-        temp_input.write(seq + '\n')
-    temp_input.close()
-    mat_path = mat_path_prefix + 'human_CRISPRi_{}bp.matrix'.format(spacer_len)
-    cmd = '{} -l {} -m {} -i {} -o {}'.format(scc_path, spacer_len, mat_path,
-                                              temp_input.name, temp_output.name)
-    temp_output.close()
-    subprocess.run(cmd, shell=True)
-    scc = pd.read_table(temp_output.name, header=None)
-    scc.columns = ['spacer_seq', 'scc_score']
-    os.remove(temp_input.name)
-    os.remove(temp_output.name)
+def compute_scc_crispr_ia(seqs, spacer_len, mat_path_prefix=SSC_MATRIX_DIR):
+    mat_path = os.path.join(mat_path_prefix,
+                            'human_CRISPRi_{}bp.matrix'.format(spacer_len))
+    seqs = [seq for seq in seqs if len(seq) == spacer_len]
+    scc = pd.DataFrame({'spacer_seq': seqs,
+                        'scc_score': score_spacers(seqs, mat_path)},
+                       columns=['spacer_seq', 'scc_score'])
     return scc
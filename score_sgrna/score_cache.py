@@ -0,0 +1,220 @@
+"""Persistent per-sequence score cache shared by RS2 and deep rank
+
+Scores are stored in a local SQLite database keyed by (scorer name, model
+version, sequence, extra features). Arrays of sequences are looked up in bulk
+through a temporary table join, only the misses are computed and written
+back. The default model versions are digests of the model files, so a model
+retrained into the same path does not get stale scores. Worker processes
+share one database, so connections wait for the write lock instead of
+failing at once.
+"""
+import glob
+import hashlib
+import os
+import sqlite3
+import numpy as np
+
+SCORE_CACHE_PATH = os.getenv('SCORE_CACHE_PATH')
+# seconds a connection waits for the lock of another process
+SCORE_CACHE_TIMEOUT = float(os.getenv('SCORE_CACHE_TIMEOUT', '60'))
+
+
+def format_extras(extras, n):
+    """Convert extra features to keys, one str per sequence
+
+    Args:
+        extras: None, or array of features, shape (n, ) or (n, k)
+        n: the number of sequences
+
+    Returns:
+        list of str, the features are written by repr, so different float64
+        values have different keys
+    """
+    if extras is None:
+        return [''] * n
+    extras = np.asarray(extras, dtype=np.float64).reshape(n, -1)
+    return [','.join(repr(float(x)) for x in row) for row in extras]
+
+
+class ScoreCache:
+    """Scores of sequences in an embedded SQLite database"""
+
+    def __init__(self, path=SCORE_CACHE_PATH, timeout=SCORE_CACHE_TIMEOUT):
+        """
+
+        Args:
+            path: the path of the SQLite database, created if not exists
+            timeout: seconds waiting for the lock of another connection
+        """
+        assert path is not None, 'Please set SCORE_CACHE_PATH'
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS scores ('
+            'scorer TEXT NOT NULL, version TEXT NOT NULL, seq TEXT NOT NULL, '
+            'extra TEXT NOT NULL, score REAL, '
+            'PRIMARY KEY (scorer, version, seq, extra)) WITHOUT ROWID')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def __repr__(self):
+        return 'ScoreCache({}, hits={}, misses={}, writes={})'.format(
+            self.path, self.hits, self.misses, self.writes)
+
+    def close(self):
+        self.conn.close()
+
+    def stats(self):
+        """Counters for monitoring"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes,
+                'hit_ratio': self.hits / lookups if lookups else np.nan}
+
+    def lookup(self, scorer, version, seqs, extras=None):
+        """Look up scores of sequences
+
+        Args:
+            scorer: the name of scorer, e.g. 'rs2'
+            version: the version of the model
+            seqs: list of sequences
+            extras: None, or array of extra features of each sequence
+
+        Returns:
+            np.ndarray, scores, NaN for misses
+        """
+        seqs = list(seqs)
+        keys = format_extras(extras, len(seqs))
+        scores = np.full(len(seqs), np.nan)
+        if len(seqs) == 0:
+            return scores
+        cursor = self.conn.cursor()
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS query '
+                       '(i INTEGER, seq TEXT, extra TEXT)')
+        cursor.execute('DELETE FROM query')
+        cursor.executemany('INSERT INTO query VALUES (?, ?, ?)',
+                           zip(range(len(seqs)), seqs, keys))
+        cursor.execute(
+            'SELECT query.i, scores.score FROM query JOIN scores '
+            'ON scores.scorer = ? AND scores.version = ? '
+            'AND scores.seq = query.seq AND scores.extra = query.extra',
+            (scorer, str(version)))
+        for i, score in cursor.fetchall():
+            if score is not None:
+                scores[i] = score
+        cursor.execute('DELETE FROM query')
+        self.conn.commit()
+        hit_num = int(np.sum(~np.isnan(scores)))
+        self.hits += hit_num
+        self.misses += len(seqs) - hit_num
+        return scores
+
+    def store(self, scorer, version, seqs, scores, extras=None):
+        """Write scores of sequences, NaN scores are skipped"""
+        seqs = list(seqs)
+        keys = format_extras(extras, len(seqs))
+        records = [(scorer, str(version), seq, key, float(score))
+                   for seq, key, score in zip(seqs, keys, scores)
+                   if not np.isnan(score)]
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)', records)
+        self.conn.commit()
+        self.writes += len(records)
+
+    def get_or_compute(self, scorer, version, seqs, compute, extras=None):
+        """Look up hits, compute only misses and write them back
+
+        Args:
+            scorer: the name of scorer
+            version: the version of the model
+            seqs: list of sequences
+            compute: function taking the indices of misses and returning
+             their scores
+            extras: None, or array of extra features of each sequence
+
+        Returns:
+            np.ndarray, scores
+        """
+        seqs = list(seqs)
+        scores = self.lookup(scorer, version, seqs, extras)
+        miss_index = np.where(np.isnan(scores))[0]
+        if len(miss_index) > 0:
+            scores[miss_index] = compute(miss_index)
+            miss_extras = None
+            if extras is not None:
+                miss_extras = np.asarray(extras, dtype=np.float64).reshape(
+                    len(seqs), -1)[miss_index]
+            self.store(scorer, version, [seqs[i] for i in miss_index],
+                       scores[miss_index], miss_extras)
+        return scores
+
+
+_CACHE = None
+_FILE_VERSIONS = {}
+
+
+def file_version(paths):
+    """The version of model files, a SHA-1 of their content, files are hashed
+    again only when their size or mtime changes
+
+    Args:
+        paths: the model files, the ones not existing are skipped
+
+    Returns:
+        str
+    """
+    key = []
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            key.append((path, stat.st_size, stat.st_mtime_ns))
+    key = tuple(key)
+    if key not in _FILE_VERSIONS:
+        digest = hashlib.sha1()
+        for path, _, _ in key:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        _FILE_VERSIONS[key] = digest.hexdigest()
+    return _FILE_VERSIONS[key]
+
+
+def checkpoint_files(model_save_path):
+    """The files of a TensorFlow checkpoint, e.g. .index and .data-*"""
+    return [model_save_path] + glob.glob(glob.escape(model_save_path) + '.*')
+
+
+def get_score_cache(path=SCORE_CACHE_PATH):
+    """The ScoreCache shared by the process, None if path is None"""
+    global _CACHE
+    if path is None:
+        return None
+    if (_CACHE is None) or (_CACHE.path != path):
+        _CACHE = ScoreCache(path)
+    return _CACHE
+
+
+def cached_scores(cache, scorer, version, seqs, compute, extras=None):
+    """Scores through cache, the shared cache is used if cache is None and
+    computed directly if there is no cache
+
+    Args:
+        cache: ScoreCache or None
+        scorer: the name of scorer
+        version: the version of the model
+        seqs: list of sequences
+        compute: function taking indices and returning their scores
+        extras: None, or array of extra features of each sequence
+
+    Returns:
+        np.ndarray, scores
+    """
+    if cache is None:
+        cache = get_score_cache()
+    if cache is None:
+        return np.asarray(compute(np.arange(len(seqs))), dtype=np.float64)
+    return cache.get_or_compute(scorer, version, seqs, compute, extras)
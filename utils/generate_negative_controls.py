@@ -1,9 +1,19 @@
+import itertools
 import os
 import numpy as np
 from genome_editing.utils import alignment
+from genome_editing.utils.sequence import _encode_table
 
 
 HG38_BOWTIE_INDEX_PATH = os.getenv('HG38_BOWTIE_INDEX_PATH')
+KMER_SET_PATH = os.getenv('KMER_SET_PATH')
+NUCLEOTIDES = 'ACGT'
+# 4 ** 16 bits = 512MB, longer k-mers are kept in a sorted array
+DIRECT_MAX_K = 16
+CHUNK_SIZE = 10000000
+BATCH_SIZE = 10000
+# batches in a row without any candidate absent from the genome
+MAX_EMPTY_BATCHES = 100
 
 
 def generate_random_sgrna(upstream=20, downstream=0):
@@ -76,3 +86,320 @@ def generate_neg_control(num, length, seed_len, num_mismatch=2,
     if f:
         f.close()
     return neg_controls
+
+
+class KmerBitmap:
+    """The presence of k-mers of a genome as a bitmap, direct-addressed by the
+    2-bit code of k-mers, 4 ** k bits"""
+
+    def __init__(self, k, bits=None):
+        """
+
+        Args:
+            k: the length of k-mers, at most DIRECT_MAX_K
+            bits: np.ndarray, uint8, the packed bitmap, empty if None
+        """
+        assert 0 < k <= DIRECT_MAX_K, 'Wrong k'
+        self.k = k
+        self.size = 4 ** k
+        if bits is None:
+            bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+
+    def __repr__(self):
+        return 'KmerBitmap(k={})'.format(self.k)
+
+    @property
+    def fill_ratio(self):
+        """The ratio of all 4 ** k k-mers present"""
+        return np.unpackbits(self.bits).sum() / self.size
+
+    def add(self, codes):
+        """Add k-mers by their codes"""
+        codes = np.asarray(codes, dtype=np.uint64)
+        np.bitwise_or.at(self.bits, (codes >> np.uint64(3)).astype(np.int64),
+                         np.left_shift(1, codes & np.uint64(7))
+                         .astype(np.uint8))
+
+    def contains(self, codes):
+        """Whether k-mers are present, codes of any shape"""
+        codes = np.asarray(codes, dtype=np.uint64)
+        byte = self.bits[(codes >> np.uint64(3)).astype(np.int64)]
+        return ((byte >> (codes & np.uint64(7)).astype(np.uint8)) & 1) \
+            .astype(bool)
+
+    def add_sequence(self, seq, chunk_size=CHUNK_SIZE):
+        """Add the k-mers of a sequence, k-mers with N are skipped"""
+        for codes in iter_kmer_codes(seq, self.k, chunk_size):
+            self.add(codes)
+
+    def save(self, path):
+        np.savez(path, bits=self.bits, k=self.k)
+
+
+class KmerArray:
+    """The k-mers of a genome as a sorted array of their 2-bit codes, exact
+    for k > DIRECT_MAX_K, 8 bytes per distinct k-mer (about 20GB for 20-mers
+    of hg38)"""
+
+    def __init__(self, k, codes=None):
+        """
+
+        Args:
+            k: the length of k-mers, at most 32
+            codes: sorted np.ndarray of unique k-mer codes, uint64, empty if
+             None
+        """
+        assert 0 < k <= 32, 'Wrong k'
+        self.k = k
+        if codes is None:
+            codes = np.zeros(0, dtype=np.uint64)
+        self.codes = codes
+        self._chunks = []
+
+    def __repr__(self):
+        return 'KmerArray(k={}, n={})'.format(self.k, len(self.codes))
+
+    def _merge(self):
+        """Merge the added chunks into codes, one sort of all of them"""
+        if len(self._chunks) > 0:
+            self.codes = np.unique(np.concatenate([self.codes] +
+                                                  self._chunks))
+            self._chunks = []
+
+    @property
+    def fill_ratio(self):
+        """The ratio of all 4 ** k k-mers present"""
+        self._merge()
+        return len(self.codes) / 4.0 ** self.k
+
+    def add(self, codes):
+        """Add k-mers by their codes, merged on the next lookup"""
+        self._chunks.append(np.unique(np.asarray(codes, dtype=np.uint64)))
+
+    def contains(self, codes):
+        """Whether k-mers are present, codes of any shape"""
+        self._merge()
+        codes = np.asarray(codes, dtype=np.uint64)
+        if len(self.codes) == 0:
+            return np.zeros(codes.shape, dtype=bool)
+        index = np.searchsorted(self.codes, codes)
+        index = np.minimum(index, len(self.codes) - 1)
+        return self.codes[index] == codes
+
+    def add_sequence(self, seq, chunk_size=CHUNK_SIZE):
+        """Add the k-mers of a sequence, k-mers with N are skipped, merged
+        on the next lookup"""
+        start = len(self._chunks)
+        for codes in iter_kmer_codes(seq, self.k, chunk_size):
+            self.add(codes)
+        # the unique k-mers of a sequence are kept as one chunk, so the
+        # accumulated codes are not sorted again for every sequence
+        if len(self._chunks) > start + 1:
+            self._chunks[start:] = [np.unique(np.concatenate(
+                self._chunks[start:]))]
+
+    def save(self, path):
+        self._merge()
+        np.savez(path, codes=self.codes, k=self.k)
+
+
+def load_kmer_set(path):
+    """Load a KmerBitmap or KmerArray saved as .npz"""
+    data = np.load(path)
+    if 'bits' in data:
+        return KmerBitmap(int(data['k']), data['bits'])
+    return KmerArray(int(data['k']), data['codes'])
+
+
+def kmer_codes(codes, k):
+    """The codes of k-mers of a sequence
+
+    Args:
+        codes: np.ndarray of base codes, ACGT as 0-3, other bases as 4
+        k: the length of k-mers
+
+    Returns:
+        np.ndarray, uint64, the codes of k-mers without N
+    """
+    kmer_num = len(codes) - k + 1
+    if kmer_num <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:] == invalid[:kmer_num]
+    kmers = np.zeros(kmer_num, dtype=np.uint64)
+    for j in range(k):
+        kmers = (kmers << np.uint64(2)) | \
+            (codes[j:(j + kmer_num)] & 3).astype(np.uint64)
+    return kmers[valid]
+
+
+def iter_kmer_codes(seq, k, chunk_size=CHUNK_SIZE):
+    """The codes of k-mers of a sequence, chunk_size k-mers at a time"""
+    table = _encode_table(NUCLEOTIDES)
+    for start in range(0, max(len(seq) - k + 1, 0), chunk_size):
+        chunk = seq[start:(start + chunk_size + k - 1)]
+        codes = table[np.frombuffer(chunk.encode('ascii'), dtype=np.uint8)]
+        yield kmer_codes(codes, k)
+
+
+def iter_fasta(path):
+    """Read the sequences of a FASTA file one record at a time"""
+    seq = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('>'):
+                if len(seq) > 0:
+                    yield ''.join(seq)
+                seq = []
+            else:
+                seq.append(line.strip())
+    if len(seq) > 0:
+        yield ''.join(seq)
+
+
+def iter_genome(ref_genome='hg38', chroms=None):
+    """Query the sequences of chromosomes from the database"""
+    from genome_editing.design_sgRNA.design import get_chrom_seq
+    from genome_editing.utils.utilities import CHROMS
+
+    for chrom in (CHROMS if chroms is None else chroms):
+        print('Read {}'.format(chrom))
+        yield get_chrom_seq(ref_genome, chrom)
+
+
+def get_kmer_set(k, fasta_path=None, ref_genome='hg38',
+                 kmer_path=KMER_SET_PATH):
+    """Load the k-mers of a genome, they are collected and saved at kmer_path
+    if not there
+
+    Args:
+        k: the length of k-mers
+        fasta_path: the FASTA file of the genome, the chromosomes in the
+         database if None
+        ref_genome: reference genome in the database
+        kmer_path: the .npz file of the k-mers, not saved if None
+
+    Returns:
+        KmerBitmap for k <= DIRECT_MAX_K, KmerArray otherwise
+    """
+    if kmer_path is not None and os.path.exists(kmer_path):
+        kmers = load_kmer_set(kmer_path)
+        assert kmers.k == k, 'The k-mer set has k = {}'.format(kmers.k)
+    else:
+        kmers = KmerBitmap(k) if k <= DIRECT_MAX_K else KmerArray(k)
+        seqs = iter_fasta(fasta_path) if fasta_path is not None else \
+            iter_genome(ref_genome)
+        for seq in seqs:
+            kmers.add_sequence(seq)
+        if kmer_path is not None:
+            kmers.save(kmer_path)
+    print('{}: {:.4%} of {}-mers present'.format(kmers, kmers.fill_ratio, k))
+    return kmers
+
+
+def mismatch_masks(k, num_mismatch):
+    """The XOR masks changing at most num_mismatch bases of a k-mer code"""
+    masks = [0]
+    for n in range(1, num_mismatch + 1):
+        for positions in itertools.combinations(range(k), n):
+            for changes in itertools.product((1, 2, 3), repeat=n):
+                mask = 0
+                for pos, change in zip(positions, changes):
+                    mask |= change << (2 * (k - 1 - pos))
+                masks.append(mask)
+    return np.array(masks, dtype=np.uint64)
+
+
+def seed_absent(codes, kmers, num_mismatch=2):
+    """Whether the seeds on both strands, and their neighbors with at most
+    num_mismatch mismatches, are absent from the genome
+
+    Args:
+        codes: np.ndarray, the base codes of seeds, n x k
+        kmers: KmerBitmap or KmerArray
+        num_mismatch: the number of mismatches
+
+    Returns:
+        np.ndarray, bool
+    """
+    masks = mismatch_masks(kmers.k, num_mismatch)
+    absent = np.ones(codes.shape[0], dtype=bool)
+    for strand_codes in (codes, 3 - codes[:, ::-1]):
+        seed_codes = np.zeros(codes.shape[0], dtype=np.uint64)
+        for j in range(kmers.k):
+            seed_codes = (seed_codes << np.uint64(2)) | \
+                strand_codes[:, j].astype(np.uint64)
+        present = kmers.contains(seed_codes[:, np.newaxis] ^
+                                 masks[np.newaxis, :])
+        absent &= ~present.any(axis=1)
+    return absent
+
+
+def generate_kmer_neg_controls(num, length, kmers, num_mismatch=2,
+                          gc_range=(0.2, 0.8), seed=0, file_path=None,
+                          batch_size=BATCH_SIZE,
+                          max_empty_batches=MAX_EMPTY_BATCHES):
+    """Generate negative controls in batches, the kmers.k bp upstream of
+    PAM is absent from the genome, checked against a k-mer set instead of
+    one bowtie alignment per candidate as generate_neg_control
+
+    Args:
+        num: the number of negative controls
+        length: the length of negative controls
+        kmers: KmerBitmap or KmerArray of the genome, see get_kmer_set
+        num_mismatch: seeds within num_mismatch mismatches of a genome k-mer
+         are removed, 2 as bowtie -v 2 of generate_neg_control
+        gc_range: the range of GC content
+        seed: the random seed
+        file_path: the negative controls are appended to the file if not None
+        batch_size: the number of candidates drawn at a time
+        max_empty_batches: ValueError is raised after this number of batches
+         in a row without any seed absent from the genome
+
+    Returns:
+        list of negative controls
+    """
+    assert kmers.k <= length, 'The seed is longer than negative controls'
+    rng = np.random.RandomState(seed)
+    letters = np.frombuffer(NUCLEOTIDES.encode('ascii'), dtype=np.uint8)
+    t_code = NUCLEOTIDES.index('T')
+    gc_codes = [NUCLEOTIDES.index('G'), NUCLEOTIDES.index('C')]
+    neg_controls = []
+    found = set()
+    empty_num = 0
+    f = open(file_path, 'a') if file_path is not None else None
+    while len(neg_controls) < num:
+        codes = rng.randint(0, 4, size=(batch_size, length)).astype(np.uint8)
+        # remove sgRNAs containing TTTT
+        is_t = codes == t_code
+        tttt = np.any(is_t[:, :-3] & is_t[:, 1:-2] & is_t[:, 2:-1] &
+                      is_t[:, 3:], axis=1)
+        gc = np.isin(codes, gc_codes).mean(axis=1)
+        keep = ~tttt & (gc >= gc_range[0]) & (gc <= gc_range[1])
+        codes = codes[keep]
+        codes = codes[seed_absent(codes[:, -kmers.k:], kmers,
+                                  num_mismatch)]
+        empty_num = empty_num + 1 if len(codes) == 0 else 0
+        if empty_num >= max_empty_batches:
+            if f:
+                f.close()
+            raise ValueError(
+                'No seed absent from the genome in {} batches, {:.4%} of '
+                '{}-mers are present, use longer seeds or fewer '
+                'mismatches'.format(empty_num, kmers.fill_ratio, kmers.k))
+        seqs = letters[codes].view('S{}'.format(length)).ravel()
+        new_controls = []
+        for seq in seqs:
+            seq = seq.decode('ascii')
+            if seq not in found:
+                found.add(seq)
+                new_controls.append(seq)
+        new_controls = new_controls[:(num - len(neg_controls))]
+        neg_controls += new_controls
+        if f:
+            f.write(''.join(x + '\n' for x in new_controls))
+        print('Generate {} negative controls'.format(len(neg_controls)))
+    if f:
+        f.close()
+    return neg_controls
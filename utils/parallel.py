@@ -0,0 +1,38 @@
+"""Thread limits of worker processes
+
+BLAS, OpenMP and TensorFlow read their thread numbers from the environment
+when they are loaded, so the limit is set in the parent before a spawn pool
+is created, and the fresh workers inherit it.
+"""
+import contextlib
+import os
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS',
+                   'TF_NUM_INTEROP_THREADS')
+
+
+@contextlib.contextmanager
+def limit_threads(num_threads):
+    """Set the thread numbers of the processes started in the context, the
+    environment is restored at exit
+
+    Example:
+        with limit_threads(1), context.Pool(processes) as pool:
+            results = pool.map(func, tasks)
+
+    Args:
+        num_threads: the max number of CPU threads, no limit if None
+    """
+    old = {x: os.environ.get(x) for x in THREAD_ENV_VARS}
+    if num_threads is not None:
+        for name in THREAD_ENV_VARS:
+            os.environ[name] = str(num_threads)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
@@ -0,0 +1,150 @@
+"""Parquet output of design and library tables
+
+Tables are written as Arrow record batches into one Parquet file, a row
+group at a time, so a whole-genome design never has to be in memory at once.
+Gene, chromosome, strand, PAM and site type columns are dictionary-encoded
+and coordinates are stored as int32. Tables written in genomic order can be
+read back by gene or chromosome, skipping row groups by their statistics.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DICTIONARY_COLS = ('gene_symbol', 'refseq_id', 'chrom', 'strand', 'pam_type',
+                   'cutting_site_type')
+INT32_COLS = ('exon_id', 'start', 'end', 'sgrna_id', 'rank', 'filter_num',
+              'off_target_num')
+ROW_GROUP_SIZE = 100000
+
+
+def to_record_batch(df, schema=None):
+    """Convert a design table into an Arrow record batch
+
+    Args:
+        df: DataFrame, e.g. the output of Designer
+        schema: pa.Schema, inferred from df if None
+
+    Returns:
+        pa.RecordBatch
+    """
+    df = df.copy()
+    for col in INT32_COLS:
+        if col in df.columns:
+            df[col] = df.loc[:, col].values.astype(np.int32)
+    return pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
+
+
+class ParquetTableWriter:
+    """Write design tables into a Parquet file incrementally
+
+    Example:
+        with ParquetTableWriter('library.parquet') as writer:
+            for df in outputs:
+                writer.write(df)
+    """
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE,
+                 compression='snappy'):
+        """
+
+        Args:
+            path: the output path
+            row_group_size: the number of rows of each row group
+            compression: the compression codec of Parquet
+        """
+        self.path = path
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.schema = None
+        self.writer = None
+        self.batches = []
+        self.buffer_num = 0
+        self.row_num = 0
+
+    def __repr__(self):
+        return 'ParquetTableWriter({}, rows={})'.format(self.path,
+                                                        self.row_num)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, df):
+        """Append rows, a row group is written when enough rows are
+        buffered"""
+        if df.shape[0] == 0:
+            return
+        batch = to_record_batch(df, self.schema)
+        if self.schema is None:
+            self.schema = batch.schema
+            use_dictionary = [x for x in DICTIONARY_COLS
+                              if x in self.schema.names]
+            self.writer = pq.ParquetWriter(self.path, self.schema,
+                                           compression=self.compression,
+                                           use_dictionary=use_dictionary)
+        self.batches.append(batch)
+        self.buffer_num += batch.num_rows
+        self.row_num += batch.num_rows
+        if self.buffer_num >= self.row_group_size:
+            self.flush(complete_only=True)
+
+    def flush(self, complete_only=False):
+        """Write the buffered rows
+
+        Args:
+            complete_only: only write whole row groups, the remaining rows
+             are kept in the buffer
+        """
+        if len(self.batches) == 0:
+            return
+        table = pa.Table.from_batches(self.batches)
+        write_num = table.num_rows
+        if complete_only:
+            write_num -= write_num % self.row_group_size
+        if write_num > 0:
+            self.writer.write_table(table.slice(0, write_num),
+                                    row_group_size=self.row_group_size)
+        rest = table.slice(write_num)
+        self.batches = rest.to_batches() if rest.num_rows > 0 else []
+        self.buffer_num = rest.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+
+
+def write_table(df, path, row_group_size=ROW_GROUP_SIZE):
+    """Write a design table into a Parquet file"""
+    with ParquetTableWriter(path, row_group_size) as writer:
+        writer.write(df)
+
+
+def read_table(path, genes=None, refseq_ids=None, chroms=None,
+               columns=None):
+    """Read a design table from a Parquet file
+
+    Args:
+        path: the Parquet file
+        genes: gene symbols to read, all genes if None
+        refseq_ids: refseq IDs to read, all transcripts if None
+        chroms: chromosomes to read, all chromosomes if None
+        columns: the columns to read, all columns if None
+
+    Returns:
+        DataFrame, dictionary-encoded columns are categorical
+    """
+    filters = []
+    for col, values in (('gene_symbol', genes), ('refseq_id', refseq_ids),
+                        ('chrom', chroms)):
+        if values is not None:
+            filters.append((col, 'in', list(values)))
+    schema_names = pq.read_schema(path).names
+    read_dictionary = [x for x in DICTIONARY_COLS if x in schema_names]
+    table = pq.read_table(path, columns=columns,
+                          filters=filters if filters else None,
+                          read_dictionary=read_dictionary)
+    return table.to_pandas()
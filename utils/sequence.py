@@ -0,0 +1,129 @@
+"""Vectorized utilities for DNA sequences"""
+import numpy as np
+
+_ENCODE_TABLES = {}
+
+
+def _encode_table(alphabet):
+    if alphabet not in _ENCODE_TABLES:
+        table = np.full(256, len(alphabet), dtype=np.uint8)
+        for i, bp in enumerate(alphabet):
+            table[ord(bp.upper())] = i
+            table[ord(bp.lower())] = i
+        _ENCODE_TABLES[alphabet] = table
+    return _ENCODE_TABLES[alphabet]
+
+
+def encode_sequences(seqs, alphabet='ATCG'):
+    """Encode sequences with the same length to integer codes
+
+    Args:
+        seqs: array of sequences
+        alphabet: the bases, the code of a base is its index in alphabet and
+         bases not in alphabet (e.g. N) get len(alphabet)
+
+    Returns:
+        np.ndarray, uint8, shape (n, seq_len)
+    """
+    seqs = list(seqs)
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    seq_len = len(seqs[0])
+    assert all(len(seq) == seq_len for seq in seqs), \
+        'Sequences have different lengths'
+    buffer = ''.join(seqs).encode('ascii')
+    codes = _encode_table(alphabet)[np.frombuffer(buffer, dtype=np.uint8)]
+    return codes.reshape(len(seqs), seq_len)
+
+
+def one_hot_encode(seqs, alphabet='ATCG', dtype=np.float32):
+    """One-hot encode sequences with the same length, bases not in alphabet
+    (e.g. N) are all zero
+
+    Args:
+        seqs: array of sequences
+        alphabet: the bases, in the order of rows
+        dtype: the dtype of output, e.g. np.float32 or np.uint8
+
+    Returns:
+        np.ndarray, shape (n, len(alphabet), seq_len)
+    """
+    codes = encode_sequences(seqs, alphabet)
+    bases = np.arange(len(alphabet), dtype=np.uint8)
+    return (codes[:, np.newaxis, :] ==
+            bases[np.newaxis, :, np.newaxis]).astype(dtype)
+
+
+_IUPAC = 'ACGTRYKMSWBDHVNacgtrykmswbdhvn'
+_IUPAC_COMPLEMENT = 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn'
+_COMPLEMENT = str.maketrans(_IUPAC, _IUPAC_COMPLEMENT)
+_COMPLEMENT_TABLE = np.arange(256, dtype=np.uint8)
+_COMPLEMENT_TABLE[np.frombuffer(_IUPAC.encode('ascii'), dtype=np.uint8)] = \
+    np.frombuffer(_IUPAC_COMPLEMENT.encode('ascii'), dtype=np.uint8)
+_GC_TABLE = np.zeros(256, dtype=np.int64)
+_GC_TABLE[np.frombuffer(b'GCgc', dtype=np.uint8)] = 1
+
+
+def reverse_complement(seq):
+    """Reverse complement of a sequence, IUPAC codes and case are kept"""
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def reverse_complement_batch(seqs):
+    """Reverse complement of sequences, sequences with the same length are
+    processed as one byte array
+
+    Args:
+        seqs: array of sequences
+
+    Returns:
+        list of sequences
+    """
+    seqs = list(seqs)
+    if len(seqs) == 0:
+        return []
+    seq_len = len(seqs[0])
+    if any(len(seq) != seq_len for seq in seqs) or seq_len == 0:
+        return [reverse_complement(seq) for seq in seqs]
+    codes = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    codes = _COMPLEMENT_TABLE[codes].reshape(len(seqs), seq_len)[:, ::-1]
+    buffer = codes.tobytes().decode('ascii')
+    return [buffer[i:(i + seq_len)]
+            for i in range(0, len(buffer), seq_len)]
+
+
+def gc_content(seqs):
+    """GC content of sequences, the length of sequences can be different
+
+    Args:
+        seqs: array of sequences
+
+    Returns:
+        np.ndarray, the fraction of G and C of each sequence, NaN if empty
+    """
+    seqs = list(seqs)
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    if lengths.sum() == 0:
+        return np.full(len(seqs), np.nan)
+    codes = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    cum_gc = np.concatenate(([0], np.cumsum(_GC_TABLE[codes])))
+    ends = np.cumsum(lengths)
+    gc = cum_gc[ends] - cum_gc[ends - lengths]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(lengths > 0, gc / lengths, np.nan)
+
+
+def has_homopolymer(seqs, base='T', length=4):
+    """Whether sequences contain a run of base, e.g. TTTT terminating Pol III
+    transcription
+
+    Args:
+        seqs: array of sequences
+        base: the base of the run
+        length: the min length of the run
+
+    Returns:
+        np.ndarray, bool
+    """
+    run = base.upper() * length
+    return np.array([run in seq.upper() for seq in seqs], dtype=bool)
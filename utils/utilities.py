@@ -1,14 +1,69 @@
-from Bio.Seq import Seq
 import numpy as np
 import pandas as pd
 import sqlalchemy
 import os
-import PIL.Image as Im
+from genome_editing.utils.sequence import reverse_complement
 
 GENOME_EDITING_URI = os.environ.get('GENOME_EDITING_URI')
 UPSTREAM = 4
 DOWNSTREAM = 3
 SGRNA_LEN = 20
+CHROMS = ['chr' + str(x) for x in range(1, 23)]
+CHROMS += ['chrX', 'chrY', 'chrM']
+# below the limit of host parameters of SQLite
+QUERY_CHUNK_SIZE = 900
+
+
+def resolve_genes(genes, table_name='igenome_ucsc_hg38_refgene',
+                  column='name2', canonical=True, uri=GENOME_EDITING_URI,
+                  engine=None):
+    """Find the transcripts of genes with bulk IN queries, one query per
+    QUERY_CHUNK_SIZE genes
+
+    Args:
+        genes: gene symbols (column='name2') or refseq IDs (column='name')
+        table_name: table storing gene info
+        column: the column matched against genes
+        canonical: whether only keep transcripts on CHROMS
+        uri: sqla URI
+        engine: sqla engine, created from uri if None
+
+    Returns:
+        DataFrame of gene_symbol, refseq_id and chrom in the order of genes,
+        and list of unresolved genes
+    """
+    assert column in ('name2', 'name'), 'Wrong column'
+    if engine is None:
+        engine = sqlalchemy.create_engine(uri)
+    genes = list(pd.unique(np.asarray(genes, dtype=object)))
+    query = sqlalchemy.text(
+        'SELECT name, name2, chrom FROM {} WHERE {} IN :genes'.format(
+            table_name, column)).bindparams(
+        sqlalchemy.bindparam('genes', expanding=True))
+    gene_info = []
+    for start in range(0, len(genes), QUERY_CHUNK_SIZE):
+        chunk = genes[start:(start + QUERY_CHUNK_SIZE)]
+        gene_info.append(pd.read_sql_query(query, engine,
+                                           params={'genes': chunk}))
+    if len(gene_info) > 0:
+        gene_info = pd.concat(gene_info, ignore_index=True)
+    else:
+        gene_info = pd.DataFrame(columns=['name', 'name2', 'chrom'])
+    if canonical:
+        gene_info = gene_info[gene_info.chrom.isin(CHROMS)]
+    gene_info = gene_info.drop_duplicates()
+
+    # keep the order of input genes
+    order = pd.Series(np.arange(len(genes)), index=genes)
+    gene_info = gene_info.iloc[np.argsort(
+        order.loc[gene_info.loc[:, column].values].values, kind='mergesort')]
+    out = pd.DataFrame({'gene_symbol': gene_info.name2.values,
+                        'refseq_id': gene_info.name.values,
+                        'chrom': gene_info.chrom.values},
+                       columns=['gene_symbol', 'refseq_id', 'chrom'])
+    resolved = set(gene_info.loc[:, column].values)
+    unresolved = [x for x in genes if x not in resolved]
+    return out, unresolved
 
 
 def gene_symbol_to_refseq(
@@ -25,12 +80,12 @@ def gene_symbol_to_refseq(
     Returns:
         Refseq IDs
     """
-    engine = sqlalchemy.create_engine(uri)
-    gene_refseq = {}
-    for gene in genes:
-        query = "SELECT * FROM {} WHERE name2='{}'".format(table_name, gene)
-        gene_info = pd.read_sql_query(query, engine).drop_duplicates()
-        gene_refseq[gene] = gene_info.name.values
+    transcripts, _ = resolve_genes(genes, table_name, canonical=False,
+                                   uri=uri)
+    refseq_ids = transcripts.drop_duplicates(
+        subset=['gene_symbol', 'refseq_id']).groupby('gene_symbol').refseq_id
+    gene_refseq = {gene: np.array([], dtype=object) for gene in genes}
+    gene_refseq.update({gene: x.values for gene, x in refseq_ids})
     return gene_refseq
 
 
@@ -58,52 +113,50 @@ def model_to_df(query_out):
 
 
 def coordinate_sgrna(df, my_up, my_down, my_sgrna_len):
-    for i in range(df.shape[0]):
-        record = df.iloc[i, :]
-        if record['pam_type'] in ['NGG', 'NAG']:
-            old_start = int(record['start'])
-            new_start = old_start - (my_sgrna_len - SGRNA_LEN)
-            old_raw_seq = record['raw_sequence']
-            new_raw_seq = old_raw_seq[-my_sgrna_len:]
-            old_sgrna_full_seq = record['sgrna_full_seq']
-
-            start_index = SGRNA_LEN + UPSTREAM - my_sgrna_len - my_up
-            end_index = DOWNSTREAM - my_down
-            if end_index == 0:
-                end_index = None
-            new_sgrna_full_seq = old_sgrna_full_seq[start_index:-end_index]
-
-            df.loc[i, 'start'] = new_start
-            df.loc[i, 'raw_sequence'] = new_raw_seq
-            df.loc[i, 'sgrna_seq'] = new_raw_seq
-            df.loc[i, 'sgrna_full_seq'] = new_sgrna_full_seq
-        else:
-            old_end = int(record['end'])
-            new_end = old_end - (SGRNA_LEN - my_sgrna_len)
-            old_raw_seq = record['raw_sequence']
-            new_raw_seq = old_raw_seq[:my_sgrna_len]
-            old_sgrna_seq = record['sgrna_seq']
-            new_sgrna_seq = old_sgrna_seq[(SGRNA_LEN - my_sgrna_len):]
-            old_sgrna_full_seq = record['sgrna_full_seq']
-
-            start_index = DOWNSTREAM - my_down
-            end_index = SGRNA_LEN + UPSTREAM - my_sgrna_len - my_up
-            if end_index == 0:
-                end_index = None
-            new_sgrna_full_seq = old_sgrna_full_seq[start_index:-end_index]
-
-            df.loc[i, 'end'] = new_end
-            df.loc[i, 'raw_sequence'] = new_raw_seq
-            df.loc[i, 'sgrna_seq'] = new_sgrna_seq
-            df.loc[i, 'sgrna_full_seq'] = new_sgrna_full_seq
-    return df
+    """Re-trim stored sgRNAs (UPSTREAM, SGRNA_LEN, DOWNSTREAM) to a shorter
+    spacer and context, whole columns are sliced at once
 
+    Args:
+        df: DataFrame of stored designs, e.g. from SgrnaDesign
+        my_up: the length of upstream base pairs, <= UPSTREAM
+        my_down: the length of downstream base pairs, <= DOWNSTREAM
+        my_sgrna_len: the length of sgRNA, <= SGRNA_LEN
 
-def reverse_complement(nt_seq):
-    return str(Seq(nt_seq).reverse_complement())
+    Returns:
+        DataFrame, df updated in place
+    """
+    forward = df.loc[:, 'pam_type'].isin(['NGG', 'NAG']).values
+    reverse = ~forward
+    # the number of bases removed from the PAM-distal and PAM-proximal ends
+    distal_trim = SGRNA_LEN + UPSTREAM - my_sgrna_len - my_up
+    proximal_trim = DOWNSTREAM - my_down
+
+    def trim(col, mask, head, tail):
+        return df.loc[mask, col].str.slice(head, -tail if tail else None)
+
+    if forward.any():
+        df.loc[forward, 'start'] = df.loc[forward, 'start'].astype(int) - \
+            (my_sgrna_len - SGRNA_LEN)
+        raw_seq = trim('raw_sequence', forward, SGRNA_LEN - my_sgrna_len, 0)
+        df.loc[forward, 'sgrna_full_seq'] = trim('sgrna_full_seq', forward,
+                                                 distal_trim, proximal_trim)
+        df.loc[forward, 'raw_sequence'] = raw_seq
+        df.loc[forward, 'sgrna_seq'] = raw_seq
+    if reverse.any():
+        df.loc[reverse, 'end'] = df.loc[reverse, 'end'].astype(int) - \
+            (SGRNA_LEN - my_sgrna_len)
+        df.loc[reverse, 'sgrna_seq'] = trim('sgrna_seq', reverse,
+                                            SGRNA_LEN - my_sgrna_len, 0)
+        df.loc[reverse, 'sgrna_full_seq'] = trim('sgrna_full_seq', reverse,
+                                                 proximal_trim, distal_trim)
+        df.loc[reverse, 'raw_sequence'] = trim('raw_sequence', reverse, 0,
+                                               SGRNA_LEN - my_sgrna_len)
+    return df
 
 
 def resize_fig(fig_path, new_size, output_path):
+    import PIL.Image as Im
+
     fig = Im.open(fig_path)
     fig = fig.resize(new_size)
     fig.save(output_path)